@@ -0,0 +1,224 @@
+"""Set-based admin actions: approve/reject many transactions, verify many users.
+
+Each action costs a fixed number of round trips however many ids it gets:
+
+    approve: claim (update_many) -> read claimed -> classify the rest ->
+             withdrawable check for every affected user (3 aggregations + 1 find) ->
+             revert failures (update_many) -> users bulk_write -> analytics
+    reject:  claim -> read claimed -> classify the rest -> users update_many -> analytics
+    verify:  read -> update_many
+
+Claims use the same `status: 'pending'` guard as the single-item routes and
+tag the claimed rows with a batch id, so a batch racing a single approval
+(or another batch) never processes a transaction twice.
+"""
+from collections import defaultdict
+from datetime import datetime
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+
+import analytics
+import events
+import money
+
+MAX_BATCH_SIZE = 1000
+
+
+class BatchError(ValueError):
+    pass
+
+
+def parse_ids(raw_ids):
+    """Validated, de-duplicated ObjectIds in request order, plus per-item errors for bad ones"""
+    if not isinstance(raw_ids, list) or not raw_ids:
+        raise BatchError('ids must be a non-empty list')
+    if len(raw_ids) > MAX_BATCH_SIZE:
+        raise BatchError(f'At most {MAX_BATCH_SIZE} ids per request')
+
+    ids, results = [], {}
+    for raw in raw_ids:
+        try:
+            object_id = ObjectId(str(raw))
+        except InvalidId:
+            results[str(raw)] = {'id': str(raw), 'ok': False, 'error': 'invalid_id'}
+            continue
+        if object_id not in ids:
+            ids.append(object_id)
+    return ids, results
+
+
+def _owner(transaction):
+    return transaction.get('user_id') or transaction.get('userId')
+
+
+def earnings_headroom(db, user_ids):
+    """ROI + referral earnings + signup bonus minus approved/pending earnings
+    withdrawals, per user, in four queries. Negative means over-committed."""
+    user_ids = list(user_ids)
+    headroom = defaultdict(lambda: money.ZERO)
+    for row in db.investments.aggregate([
+        {'$match': {'userId': {'$in': user_ids}, 'status': 'active'}},
+        {'$group': {'_id': '$userId', 'total': {'$sum': '$profit'}}}
+    ]):
+        headroom[row['_id']] += money.to_decimal(row['total'])
+    for row in db.referral_history.aggregate([
+        {'$match': {'referrerId': {'$in': user_ids}}},
+        {'$group': {'_id': '$referrerId', 'total': {'$sum': '$amount'}}}
+    ]):
+        headroom[row['_id']] += money.to_decimal(row['total'])
+    for user in db.users.find({'_id': {'$in': user_ids}}, {'signupBonus': 1}):
+        headroom[user['_id']] += money.to_decimal(user.get('signupBonus'))
+    for row in db.transactions.aggregate([
+        {'$match': {
+            'user_id': {'$in': user_ids},
+            'type': 'withdrawal',
+            'withdrawalType': 'earnings',
+            'status': {'$in': ['approved', 'pending']}
+        }},
+        {'$group': {'_id': '$user_id', 'total': {'$sum': '$amount'}}}
+    ]):
+        headroom[row['_id']] -= money.to_decimal(row['total'])
+    return {user_id: headroom[user_id] for user_id in user_ids}
+
+
+def _claim(db, ids, status):
+    """Move pending transactions to `status`; returns the claimed documents"""
+    batch_id = ObjectId()
+    db.transactions.update_many(
+        {'_id': {'$in': ids}, 'status': 'pending'},
+        {'$set': {'status': status, 'batchId': batch_id, 'updatedAt': datetime.utcnow()}}
+    )
+    claimed = list(db.transactions.find(
+        {'batchId': batch_id},
+        {'type': 1, 'amount': 1, 'user_id': 1, 'userId': 1, 'withdrawalType': 1}
+    ))
+    return batch_id, claimed
+
+
+def _classify_unclaimed(db, ids, claimed_ids, results):
+    rest = [i for i in ids if i not in claimed_ids]
+    if not rest:
+        return
+    existing = {t['_id'] for t in db.transactions.find({'_id': {'$in': rest}}, {'_id': 1})}
+    for object_id in rest:
+        error = 'already_processed' if object_id in existing else 'not_found'
+        results[str(object_id)] = {'id': str(object_id), 'ok': False, 'error': error}
+
+
+def _record(db, transactions, status):
+    counters = defaultdict(lambda: [0, money.ZERO])
+    for transaction in transactions:
+        cell = counters[f"transactions.{transaction['type']}.{status}"]
+        cell[0] += 1
+        cell[1] += money.to_decimal(transaction['amount'])
+    analytics.record(db, datetime.utcnow(), {path: tuple(cell) for path, cell in counters.items()})
+
+
+def approve_transactions(db, raw_ids):
+    ids, results = parse_ids(raw_ids)
+    batch_id, claimed = _claim(db, ids, 'approved')
+    _classify_unclaimed(db, ids, {t['_id'] for t in claimed}, results)
+
+    failed = {}
+    for transaction in claimed:
+        if not _owner(transaction):
+            failed[transaction['_id']] = 'no_user_id'
+
+    # Every earnings withdrawal of a user passes or fails together: the
+    # user's pending withdrawals are all already counted against them, as
+    # in the single-item check
+    earnings = [t for t in claimed if t['_id'] not in failed
+                and t['type'] == 'withdrawal' and t.get('withdrawalType') == 'earnings']
+    if earnings:
+        headroom = earnings_headroom(db, {_owner(t) for t in earnings})
+        for transaction in earnings:
+            if headroom[_owner(transaction)] < 0:
+                failed[transaction['_id']] = 'insufficient_withdrawable'
+
+    if failed:
+        db.transactions.update_many(
+            {'_id': {'$in': list(failed)}, 'batchId': batch_id, 'status': 'approved'},
+            {'$set': {'status': 'pending'}, '$unset': {'batchId': ''}}
+        )
+
+    approved = [t for t in claimed if t['_id'] not in failed]
+    deposits = defaultdict(lambda: money.ZERO)
+    touched = set()
+    for transaction in approved:
+        touched.add(_owner(transaction))
+        if transaction['type'] == 'deposit':
+            deposits[_owner(transaction)] += money.to_decimal(transaction['amount'])
+    if touched:
+        db.users.bulk_write([
+            UpdateOne({'_id': user_id}, {'$inc': {'balance': money.to_bson(deposits[user_id]), 'dataVersion': 1}}
+                      if user_id in deposits else {'$inc': {'dataVersion': 1}})
+            for user_id in touched
+        ], ordered=False)
+        _record(db, approved, 'approved')
+        events.publish(
+            'transactions.approved',
+            {'ids': [t['_id'] for t in approved]},
+            {'pendingTransactions': -len(approved),
+             'totalTransactions': money.to_bson(sum(money.to_decimal(t['amount']) for t in approved))}
+        )
+
+    for transaction in claimed:
+        key = str(transaction['_id'])
+        if transaction['_id'] in failed:
+            results[key] = {'id': key, 'ok': False, 'error': failed[transaction['_id']]}
+        else:
+            results[key] = {'id': key, 'ok': True, 'status': 'approved'}
+    return _ordered(raw_ids, results)
+
+
+def reject_transactions(db, raw_ids):
+    ids, results = parse_ids(raw_ids)
+    _, claimed = _claim(db, ids, 'rejected')
+    _classify_unclaimed(db, ids, {t['_id'] for t in claimed}, results)
+
+    owners = {_owner(t) for t in claimed if _owner(t)}
+    if owners:
+        db.users.update_many({'_id': {'$in': list(owners)}}, {'$inc': {'dataVersion': 1}})
+    if claimed:
+        _record(db, claimed, 'rejected')
+        events.publish('transactions.rejected', {'ids': [t['_id'] for t in claimed]},
+                       {'pendingTransactions': -len(claimed)})
+
+    for transaction in claimed:
+        key = str(transaction['_id'])
+        results[key] = {'id': key, 'ok': True, 'status': 'rejected'}
+    return _ordered(raw_ids, results)
+
+
+def verify_users(db, raw_ids):
+    ids, results = parse_ids(raw_ids)
+    found = {u['_id']: u.get('isVerified', False) for u in db.users.find({'_id': {'$in': ids}}, {'isVerified': 1})}
+    pending = [i for i in ids if i in found and not found[i]]
+    if pending:
+        db.users.update_many(
+            {'_id': {'$in': pending}, 'isVerified': {'$ne': True}},
+            {'$set': {'isVerified': True}, '$inc': {'dataVersion': 1}}
+        )
+        events.publish('users.verified', {'ids': pending}, {'pendingVerifications': -len(pending)})
+
+    for object_id in ids:
+        key = str(object_id)
+        if object_id not in found:
+            results[key] = {'id': key, 'ok': False, 'error': 'not_found'}
+        elif found[object_id]:
+            results[key] = {'id': key, 'ok': False, 'error': 'already_verified'}
+        else:
+            results[key] = {'id': key, 'ok': True, 'status': 'verified'}
+    return _ordered(raw_ids, results)
+
+
+def _ordered(raw_ids, results):
+    seen, ordered = set(), []
+    for raw in raw_ids:
+        key = str(ObjectId(str(raw))) if ObjectId.is_valid(str(raw)) else str(raw)
+        if key not in seen and key in results:
+            seen.add(key)
+            ordered.append(results[key])
+    return ordered
@@ -0,0 +1,162 @@
+"""Platform cashflow analytics backed by time-bucketed counters.
+
+Write paths call record() with a few counters; each call is one bulk_write
+that upserts the matching hourly and daily bucket in `cashflow_buckets`:
+
+    {'granularity': 'day', 'start': datetime(2025, 1, 2),
+     'transactions': {'deposit': {'pending': {'count': 3, 'amount': 4500.0}}},
+     'investments': {'EUR/USD': {'count': 1, 'amount': 1000.0}},
+     'roi': {'EUR/USD': {'count': 40, 'amount': 800.0}},
+     'commissions': {'level1': {'count': 12, 'amount': 80.0}}}
+
+Transaction counters are status transitions (created as pending, then
+approved/rejected/completed) recorded when they happen. Range queries read
+a handful of bucket documents and never touch the source collections.
+
+    python analytics.py --rebuild --from 2025-01-01 [--to 2025-02-01]
+"""
+import argparse
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, UpdateOne
+
+import history_store
+import money
+
+COLLECTION = 'cashflow_buckets'
+SECTIONS = ('transactions', 'investments', 'roi', 'commissions')
+GRANULARITIES = ('hour', 'day', 'week', 'month')
+
+
+def ensure_indexes(db):
+    db[COLLECTION].create_index([('granularity', ASCENDING), ('start', ASCENDING)], unique=True)
+
+
+def _truncate(moment, granularity):
+    if granularity == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return datetime(moment.year, moment.month, moment.day)
+
+
+def _inc_document(counters):
+    inc = {}
+    for path, (count, amount) in counters.items():
+        inc[f'{path}.count'] = count
+        inc[f'{path}.amount'] = money.to_bson(amount)
+    return {'$inc': inc}
+
+
+def _operations(moment, counters):
+    update = _inc_document(counters)
+    return [
+        UpdateOne({'granularity': g, 'start': _truncate(moment, g)}, update, upsert=True)
+        for g in ('hour', 'day')
+    ]
+
+
+def record(db, moment, counters):
+    """Add counters to the hour and day buckets containing `moment`.
+
+    counters maps 'section.key[.subkey]' -> (count, amount), e.g.
+    {'transactions.deposit.pending': (1, Decimal('500.00'))}; amounts may be
+    anything money.to_decimal() accepts
+    """
+    if counters:
+        db[COLLECTION].bulk_write(_operations(moment, counters), ordered=False)
+
+
+def record_transaction(db, moment, txn_type, status, amount):
+    record(db, moment, {f'transactions.{txn_type}.{status}': (1, amount)})
+
+
+def _merge(target, source):
+    for key, value in source.items():
+        if isinstance(value, dict):
+            _merge(target.setdefault(key, {}), value)
+        elif key == 'amount':
+            target[key] = money.to_decimal(target.get(key)) + money.to_decimal(value)
+        else:
+            target[key] = target.get(key, 0) + value
+
+
+def _period_start(start, granularity):
+    if granularity == 'week':
+        return start - timedelta(days=start.weekday())
+    if granularity == 'month':
+        return start.replace(day=1)
+    return start
+
+
+def query(db, start, end, granularity='day'):
+    """Series of bucket totals in [start, end) at the requested granularity"""
+    source = 'hour' if granularity == 'hour' else 'day'
+    periods = {}
+    cursor = db[COLLECTION].find(
+        {'granularity': source, 'start': {'$gte': start, '$lt': end}},
+        {'_id': 0, 'granularity': 0}
+    ).sort('start', ASCENDING)
+    for bucket in cursor:
+        period = _period_start(bucket.pop('start'), granularity)
+        _merge(periods.setdefault(period, {section: {} for section in SECTIONS}), bucket)
+    return [{'period': period.isoformat(), **values} for period, values in periods.items()]
+
+
+def rebuild(db, start, end):
+    """Recompute buckets in [start, end) from the source collections.
+
+    Approval/rejection times aren't stored on transactions, so rebuilt
+    transaction counters are attributed to createdAt with the current status.
+    """
+    db[COLLECTION].delete_many({'start': {'$gte': start, '$lt': end}})
+    counters = defaultdict(lambda: defaultdict(lambda: [0, money.ZERO]))
+
+    def add(moment, path, amount, count=1):
+        for g in ('hour', 'day'):
+            cell = counters[(g, _truncate(moment, g))][path]
+            cell[0] += count
+            cell[1] += money.to_decimal(amount)
+
+    for txn in db.transactions.find({'createdAt': {'$gte': start, '$lt': end}},
+                                    {'type': 1, 'status': 1, 'amount': 1, 'createdAt': 1}):
+        add(txn['createdAt'], f"transactions.{txn.get('type')}.{txn.get('status')}", txn.get('amount', 0))
+
+    pairs = {}
+    for inv in db.investments.find({}, {'forexPair': 1, 'amount': 1, 'createdAt': 1}):
+        pairs[inv['_id']] = inv.get('forexPair', 'unknown')
+        created_at = inv.get('createdAt')
+        if isinstance(created_at, datetime) and start <= created_at < end:
+            add(created_at, f"investments.{pairs[inv['_id']]}", inv.get('amount', 0))
+
+    day = datetime(start.year, start.month, start.day)
+    while day < end:
+        for entry in history_store.get_entries_for_date(db, day.date().isoformat(), 'roi_earning'):
+            add(entry['createdAt'], f"roi.{pairs.get(entry['investmentId'], 'unknown')}", entry.get('amount', 0))
+        day += timedelta(days=1)
+
+    for reward in db.referral_history.find({'createdAt': {'$gte': start, '$lt': end}},
+                                           {'type': 1, 'level': 1, 'amount': 1, 'createdAt': 1}):
+        key = 'oneTime' if reward.get('type') == 'one_time_reward' else f"level{reward.get('level')}"
+        add(reward['createdAt'], f"commissions.{key}", reward.get('amount', 0))
+
+    operations = [
+        UpdateOne({'granularity': granularity, 'start': bucket_start}, _inc_document(paths), upsert=True)
+        for (granularity, bucket_start), paths in counters.items()
+    ]
+    if operations:
+        db[COLLECTION].bulk_write(operations, ordered=False)
+    return len(operations)
+
+
+if __name__ == '__main__':
+    from database import db
+
+    parser = argparse.ArgumentParser(description='Rebuild cashflow analytics buckets')
+    parser.add_argument('--rebuild', action='store_true', required=True)
+    parser.add_argument('--from', dest='start', required=True, help='YYYY-MM-DD')
+    parser.add_argument('--to', dest='end', help='YYYY-MM-DD, exclusive (default: now)')
+    args = parser.parse_args()
+
+    ensure_indexes(db)
+    end = datetime.fromisoformat(args.end) if args.end else datetime.utcnow()
+    print(f"Rebuilt {rebuild(db, datetime.fromisoformat(args.start), end)} buckets")
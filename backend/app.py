@@ -1,18 +1,43 @@
-from flask import Flask, request, jsonify, session
-from flask_cors import CORS
+from flask import Flask, Response, request, jsonify, session, g
 from flask_session import Session
+from flask.json.provider import DefaultJSONProvider
 from datetime import timedelta, datetime
 import os
 from dotenv import load_dotenv
-from functools import wraps
+from functools import partial, wraps
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+import time
+import contextvars
+from compression import CompressionMiddleware
+from middleware import PreflightMiddleware, PublicRouteSessionInterface, build_cors_headers, public_route
+from data_version import bump_data_version, bump_referral_chain, conditional_get
+import history_store
+import earnings_rollups
+import analytics
+import projection
+import config_store
+import user_snapshots
+import admin_batch
+import events
+import user_deletion
+import jobs
+import referral_codes
+import reconciliation
+import slow_queries
+import request_profiler
+import money
+from cache import LRUCache
+from fieldsets import Fieldset
+from identity_map import WriteListener, find_by_id
 import jwt
 import bcrypt
 import json
-from pymongo import MongoClient
 from bson.objectid import ObjectId
+import pymongo
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
 import random
 import string
-import time
 
 def custom_json_encoder(obj):
     if isinstance(obj, ObjectId):
@@ -30,74 +55,129 @@ class CustomJSONProvider(json.JSONEncoder):
         except TypeError:
             return super().default(obj)
 
+class MoneyJSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider, with stored amounts (Decimal128/Decimal) as numbers"""
+    @staticmethod
+    def default(obj):
+        if money.is_money(obj):
+            return money.to_number(obj)
+        return DefaultJSONProvider.default(obj)
+
+    def dumps(self, obj, **kwargs):
+        # Only measured while an admin is profiling the request (see request_profiler.py)
+        with request_profiler.timing('serialization'):
+            return super().dumps(obj, **kwargs)
+
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
 
-# Configure JSON encoder
-app.json_encoder = CustomJSONProvider
-
-# Create session directory if it doesn't exist
-session_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sessions')
-if not os.path.exists(session_dir):
-    os.makedirs(session_dir, exist_ok=True)
-
-# Configure session
-app.config['SESSION_TYPE'] = 'filesystem'
-app.config['SESSION_FILE_DIR'] = session_dir
-app.config['SESSION_COOKIE_NAME'] = 'session'
-app.config['SESSION_COOKIE_HTTPONLY'] = True
-app.config['SESSION_COOKIE_SECURE'] = True  # Enable secure cookies
-app.config['SESSION_COOKIE_SAMESITE'] = 'None'  # Required for cross-site cookies
-app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)
-app.config['SESSION_REFRESH_EACH_REQUEST'] = True
-app.secret_key = os.environ.get('JWT_SECRET', 'secure-auth-glass-secret-key-2025')
-
-# Set cookie domain based on environment
-if os.getenv('FLASK_ENV') == 'production':
-    app.config['SESSION_COOKIE_DOMAIN'] = '.onrender.com'  # Allow cookies across Render subdomains
-
-Session(app)
-
-# CORS configuration
-CORS(app, 
-     resources={
-         r"/api/*": {
-             "origins": [
-                 os.environ.get('FRONTEND_URL', 'http://localhost:5173'),
-                 'https://pos-t7fi.onrender.com',
-                 'https://post-t7fi.onrender.com'
-             ],
-             "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-             "allow_headers": ["Content-Type", "Authorization", "X-Requested-With"],
-             "supports_credentials": True,
-             "max_age": 86400
-         }
-     },
-     supports_credentials=True)
-
-# Update after_request handler
+# CORS configuration, computed once at startup
+ALLOWED_ORIGINS = frozenset([
+    os.environ.get('FRONTEND_URL', 'http://localhost:5173'),
+    'https://pos-t7fi.onrender.com',
+    'https://post-t7fi.onrender.com'
+])
+CORS_HEADERS = build_cors_headers(
+    ALLOWED_ORIGINS,
+    methods=["GET", "PUT", "POST", "DELETE", "OPTIONS"],
+    headers=["Content-Type", "Authorization", "X-Requested-With", request_profiler.HEADER],
+    max_age=86400  # 24 hours
+)
+
+def create_app():
+    """Configure and return the Flask app.
+
+    Nothing here touches MongoDB: the client is created lazily on first use
+    in each process (see database.py), so gunicorn workers boot instantly and
+    never share a client across fork.
+    """
+    if app.config.get('APP_CONFIGURED'):
+        return app
+
+    # Configure JSON encoder
+    app.json_encoder = CustomJSONProvider
+    app.json = MoneyJSONProvider(app)
+
+    # Create session directory if it doesn't exist
+    session_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sessions')
+    if not os.path.exists(session_dir):
+        os.makedirs(session_dir, exist_ok=True)
+
+    # Configure session
+    app.config['SESSION_TYPE'] = 'filesystem'
+    app.config['SESSION_FILE_DIR'] = session_dir
+    app.config['SESSION_COOKIE_NAME'] = 'session'
+    app.config['SESSION_COOKIE_HTTPONLY'] = True
+    app.config['SESSION_COOKIE_SECURE'] = True  # Enable secure cookies
+    app.config['SESSION_COOKIE_SAMESITE'] = 'None'  # Required for cross-site cookies
+    app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)
+    app.config['SESSION_REFRESH_EACH_REQUEST'] = True
+    app.secret_key = os.environ.get('JWT_SECRET', 'secure-auth-glass-secret-key-2025')
+
+    # Set cookie domain based on environment
+    if os.getenv('FLASK_ENV') == 'production':
+        app.config['SESSION_COOKIE_DOMAIN'] = '.onrender.com'  # Allow cookies across Render subdomains
+
+    Session(app)
+    # Public routes and OPTIONS requests skip session load/save entirely
+    app.session_interface = PublicRouteSessionInterface(app.session_interface)
+
+    # gzip/brotli for large responses (nginx only compresses the static frontend)
+    app.wsgi_app = CompressionMiddleware(app.wsgi_app)
+    # Answer /api/* preflights at the WSGI layer
+    app.wsgi_app = PreflightMiddleware(app.wsgi_app, CORS_HEADERS)
+
+    app.config['APP_CONFIGURED'] = True
+    return app
+
 @app.after_request
 def after_request(response):
-    frontend_url = request.headers.get('Origin')
-    if frontend_url in [
-        os.environ.get('FRONTEND_URL', 'http://localhost:5173'),
-        'https://pos-t7fi.onrender.com',
-        'https://post-t7fi.onrender.com'
-    ]:
-        response.headers['Access-Control-Allow-Origin'] = frontend_url
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Requested-With'
-        response.headers['Access-Control-Allow-Methods'] = 'GET, PUT, POST, DELETE, OPTIONS'
-        response.headers['Access-Control-Allow-Credentials'] = 'true'
-        response.headers['Access-Control-Max-Age'] = '86400'  # 24 hours
-        
-        # Ensure cookie settings
-        if 'Set-Cookie' in response.headers:
-            response.headers['Set-Cookie'] = response.headers['Set-Cookie'].replace('SameSite=Lax', 'SameSite=None; Secure')
-    
+    cors_headers = CORS_HEADERS.get(request.headers.get('Origin'))
+    if cors_headers:
+        response.headers.extend(cors_headers)
+    return response
+
+@app.before_request
+def start_request_profile():
+    """Run this request under cProfile when an admin asks for it (X-Profile: 1 or ?_profile=1)"""
+    if not request_profiler.requested(request) or 'user_id' not in session:
+        return
+    # Same lookup as admin_required, so an admin route reuses it from the identity map
+    user = find_by_id(mongo_client.pos.users, ObjectId(session['user_id']))
+    if not user or not user.get('isAdmin', False):
+        return
+    profile = request_profiler.RequestProfile(request.method, request.full_path)
+    try:
+        profile.start()
+    except request_profiler.ProfilerBusy:
+        return jsonify({'message': 'Another request is being profiled on this worker, retry shortly'}), 409
+    g.request_profile = profile
+
+@app.after_request
+def finish_request_profile(response):
+    profile = g.pop('request_profile', None)
+    if profile is None:
+        return response
+    profile.stop()
+    try:
+        report_id = request_profiler.save(db, profile, response.status_code, ObjectId(session['user_id']))
+        response.headers['X-Profile-Report'] = f'/api/admin/profiles/{report_id}'
+        response.headers['Server-Timing'] = profile.server_timing()
+        response.headers['Access-Control-Expose-Headers'] = 'X-Profile-Report, Server-Timing'
+        response.headers['Timing-Allow-Origin'] = request.headers.get('Origin', '*')
+    except Exception as e:
+        print(f"Could not store request profile: {str(e)}")
     return response
 
+@app.teardown_request
+def discard_request_profile(error=None):
+    # The view raised before after_request ran; don't leave the profiler on
+    profile = g.pop('request_profile', None)
+    if profile is not None:
+        profile.stop()
+
 # Login required decorator
 def login_required(f):
     @wraps(f)
@@ -122,7 +202,7 @@ def admin_required(f):
             user_id = session['user_id']
             print(f"Checking admin status for user: {user_id}")
             
-            user = mongo_client.pos.users.find_one({'_id': ObjectId(user_id)})
+            user = find_by_id(mongo_client.pos.users, ObjectId(user_id))
             print(f"Found user: {user is not None}")
             print(f"User admin status: {user.get('isAdmin') if user else None}")
             
@@ -137,43 +217,6 @@ def admin_required(f):
             return jsonify({'message': 'Admin check failed'}), 500
     return decorated_function
 
-# Add OPTIONS handlers for all admin routes
-@app.route('/api/admin/transactions/<transaction_id>/approve', methods=['OPTIONS'])
-def approve_transaction_options(transaction_id):
-    response = app.make_default_options_response()
-    return response
-
-@app.route('/api/admin/transactions/<transaction_id>/reject', methods=['OPTIONS'])
-def reject_transaction_options(transaction_id):
-    response = app.make_default_options_response()
-    return response
-
-@app.route('/api/admin/users/<user_id>/verify', methods=['OPTIONS'])
-def verify_user_options(user_id):
-    response = app.make_default_options_response()
-    return response
-
-@app.route('/api/admin/reset-password', methods=['OPTIONS'])
-def admin_reset_password_options():
-    print("\n=== Handling OPTIONS request for admin reset password ===")
-    response = app.make_default_options_response()
-    return response
-
-@app.route('/api/admin/users', methods=['OPTIONS'])
-def get_all_users_options():
-    response = app.make_default_options_response()
-    return response
-
-@app.route('/api/admin/users/<user_id>', methods=['OPTIONS'])
-def delete_user_options(user_id):
-    response = app.make_default_options_response()
-    return response
-
-@app.route('/api/admin/reset-password/history', methods=['OPTIONS'])
-def get_password_reset_history_options():
-    response = app.make_default_options_response()
-    return response
-
 # Admin routes
 @app.route('/api/admin/transactions/<transaction_id>/approve', methods=['POST'])
 @admin_required
@@ -181,66 +224,87 @@ def approve_transaction(transaction_id):
     try:
         print(f"\n=== Approving transaction: {transaction_id} ===")
         
-        # Find the transaction
-        transaction = mongo_client.pos.transactions.find_one({
-            '_id': ObjectId(transaction_id)
-        })
-        
+        # Claim the transaction: only one approve/reject can move it out of pending
+        transaction = mongo_client.pos.transactions.find_one_and_update(
+            {'_id': ObjectId(transaction_id), 'status': 'pending'},
+            {'$set': {'status': 'approved'}}
+        )
+
         if not transaction:
+            if mongo_client.pos.transactions.count_documents({'_id': ObjectId(transaction_id)}, limit=1):
+                print(f"Transaction already processed: {transaction_id}")
+                return jsonify({'message': 'Transaction has already been processed'}), 409
             print(f"Transaction not found: {transaction_id}")
             return jsonify({'message': 'Transaction not found'}), 404
 
         print(f"Found transaction: {transaction}")
 
-        # Get user ID (handle both field names)
-        user_id = None
-        if 'user_id' in transaction:
-            user_id = transaction['user_id']
-        elif 'userId' in transaction:
-            user_id = transaction['userId']
-            
-        if not user_id:
-            print("No user ID found in transaction")
-            return jsonify({'message': 'Invalid transaction: no user ID'}), 400
+        def revert():
+            mongo_client.pos.transactions.update_one(
+                {'_id': ObjectId(transaction_id), 'status': 'approved'},
+                {'$set': {'status': 'pending'}}
+            )
 
-        print(f"Processing transaction for user: {user_id}")
+        def settle():
+            """Check and credit; returns (user_id, None) or (None, error response)"""
+            # Get user ID (handle both field names)
+            user_id = transaction.get('user_id') or transaction.get('userId')
+            if not user_id:
+                print("No user ID found in transaction")
+                return None, (jsonify({'message': 'Invalid transaction: no user ID'}), 400)
 
-        # For withdrawals, verify sufficient withdrawable amount
-        if transaction['type'] == 'withdrawal' and transaction.get('withdrawalType') == 'earnings':
-            withdrawable = calculate_withdrawable_amount(str(user_id), transaction_id)
-            amount = float(transaction['amount'])
-            print(f"Withdrawal check - Amount: {amount}, Withdrawable: {withdrawable}")
-            
-            if amount > withdrawable:
-                print(f"Insufficient withdrawable amount. Required: {amount}, Available: {withdrawable}")
-                return jsonify({'message': 'Insufficient withdrawable amount'}), 400
+            print(f"Processing transaction for user: {user_id}")
 
-            # We don't need to deduct from profits/earnings here because:
-            # 1. The transaction is already in 'pending' status
-            # 2. calculate_withdrawable_amount already accounts for pending withdrawals
-            # 3. This was causing a double deduction
+            # For withdrawals, verify sufficient withdrawable amount
+            if transaction['type'] == 'withdrawal' and transaction.get('withdrawalType') == 'earnings':
+                withdrawable = calculate_withdrawable_amount(str(user_id), transaction_id)
+                amount = money.to_decimal(transaction['amount'])
+                print(f"Withdrawal check - Amount: {amount}, Withdrawable: {withdrawable}")
 
-        # Update transaction status
-        update_result = mongo_client.pos.transactions.update_one(
-            {'_id': ObjectId(transaction_id)},
-            {'$set': {'status': 'approved'}}
-        )
-        
-        if update_result.modified_count == 0:
-            print("Transaction status update failed")
-            return jsonify({'message': 'Failed to update transaction'}), 500
+                if amount > withdrawable:
+                    print(f"Insufficient withdrawable amount. Required: {amount}, Available: {withdrawable}")
+                    return None, (jsonify({'message': 'Insufficient withdrawable amount'}), 400)
+
+                # We don't need to deduct from profits/earnings here because:
+                # 1. The transaction was already counted while 'pending'
+                # 2. calculate_withdrawable_amount already accounts for approved withdrawals
+                # 3. This was causing a double deduction
 
-        # Handle deposits and withdrawals differently
-        if transaction['type'] == 'deposit':
             # For deposits, increase user's balance
-            balance_result = mongo_client.pos.users.update_one(
-                {'_id': user_id},
-                {'$inc': {'balance': float(transaction['amount'])}}
+            if transaction['type'] == 'deposit':
+                balance_result = mongo_client.pos.users.update_one(
+                    {'_id': user_id},
+                    {'$inc': {'balance': money.to_bson(transaction['amount']), 'dataVersion': 1}}
+                )
+                if balance_result.modified_count == 0:
+                    print("User balance update failed")
+                    return None, (jsonify({'message': 'Failed to update user balance'}), 500)
+            return user_id, None
+
+        # Until the credit has gone through, any failure puts the transaction
+        # back to pending so it can be approved again
+        try:
+            user_id, error = settle()
+        except Exception:
+            revert()
+            raise
+        if error:
+            revert()
+            return error
+
+        # The approval is complete from here on; bookkeeping failures are
+        # logged, not reported as a failed approval
+        try:
+            if transaction['type'] != 'deposit':
+                bump_data_version(user_id)
+            analytics.record_transaction(mongo_client.pos, datetime.utcnow(), transaction['type'], 'approved', transaction['amount'])
+            events.publish(
+                'transaction.approved',
+                {'id': transaction_id, 'type': transaction['type'], 'amount': transaction['amount'], 'userId': user_id},
+                {'pendingTransactions': -1, 'totalTransactions': money.to_bson(transaction['amount'])}
             )
-            
-            if balance_result.modified_count == 0:
-                print("User balance update failed")
-                return jsonify({'message': 'Failed to update user balance'}), 500
+        except Exception as e:
+            print(f"Post-approval bookkeeping failed for {transaction_id}: {str(e)}")
 
         print("Transaction approved successfully")
         return jsonify({'message': 'Transaction approved successfully'}), 200
@@ -255,33 +319,100 @@ def approve_transaction(transaction_id):
 @admin_required
 def reject_transaction(transaction_id):
     try:
-        # Find the transaction first to get details
-        transaction = mongo_client.pos.transactions.find_one({
-            '_id': ObjectId(transaction_id)
-        })
-        
-        if not transaction:
-            return jsonify({'message': 'Transaction not found'}), 404
-            
-        # Update transaction status
-        result = mongo_client.pos.transactions.update_one(
-            {'_id': ObjectId(transaction_id)},
+        # Move the transaction out of pending in a single guarded update
+        transaction = mongo_client.pos.transactions.find_one_and_update(
+            {'_id': ObjectId(transaction_id), 'status': 'pending'},
             {'$set': {'status': 'rejected'}}
         )
 
-        if result.modified_count == 0:
-            return jsonify({'message': 'Failed to update transaction'}), 500
+        if not transaction:
+            if mongo_client.pos.transactions.count_documents({'_id': ObjectId(transaction_id)}, limit=1):
+                return jsonify({'message': 'Transaction has already been processed'}), 409
+            return jsonify({'message': 'Transaction not found'}), 404
+
+        bump_data_version(transaction.get('user_id', transaction.get('userId')))
+        analytics.record_transaction(mongo_client.pos, datetime.utcnow(), transaction['type'], 'rejected', transaction['amount'])
             
         # For withdrawals, no additional action is needed
         # The calculate_withdrawable_amount function already excludes rejected withdrawals,
         # so the funds will automatically become available again
         
+        events.publish(
+            'transaction.rejected',
+            {'id': transaction_id, 'type': transaction['type'], 'amount': transaction['amount']},
+            {'pendingTransactions': -1}
+        )
         return jsonify({'message': 'Transaction rejected successfully'}), 200
 
     except Exception as e:
         print('Error in reject_transaction:', str(e))
         return jsonify({'message': 'Failed to reject transaction'}), 500
 
+@app.route('/api/admin/events', methods=['GET'])
+@admin_required
+def admin_event_stream():
+    subscriber = events.hub.subscribe()
+    if subscriber is None:
+        return jsonify({'message': 'Too many event stream clients, retry later'}), 503
+
+    response = Response(
+        events.stream(subscriber, request.headers.get('Last-Event-ID')),
+        mimetype='text/event-stream'
+    )
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # don't let a proxy buffer the stream
+    return response
+
+@app.route('/api/admin/transactions/batch', methods=['POST'])
+@admin_required
+def batch_transactions():
+    try:
+        data = request.get_json() or {}
+        action = data.get('action')
+        if action == 'approve':
+            results = admin_batch.approve_transactions(mongo_client.pos, data.get('ids'))
+        elif action == 'reject':
+            results = admin_batch.reject_transactions(mongo_client.pos, data.get('ids'))
+        else:
+            return jsonify({'message': "action must be 'approve' or 'reject'"}), 400
+
+        succeeded = sum(1 for r in results if r['ok'])
+        print(f"Batch {action}: {succeeded}/{len(results)} transactions")
+        return jsonify({
+            'message': f'{succeeded} of {len(results)} transactions {action}d',
+            'succeeded': succeeded,
+            'failed': len(results) - succeeded,
+            'results': results
+        }), 200
+
+    except admin_batch.BatchError as e:
+        return jsonify({'message': str(e)}), 400
+    except Exception as e:
+        print(f"Error in batch_transactions: {str(e)}")
+        import traceback
+        print(f"Traceback: {traceback.format_exc()}")
+        return jsonify({'message': 'Failed to process transactions'}), 500
+
+@app.route('/api/admin/users/verify/batch', methods=['POST'])
+@admin_required
+def batch_verify_users():
+    try:
+        data = request.get_json() or {}
+        results = admin_batch.verify_users(mongo_client.pos, data.get('ids'))
+        succeeded = sum(1 for r in results if r['ok'])
+        return jsonify({
+            'message': f'{succeeded} of {len(results)} users verified',
+            'succeeded': succeeded,
+            'failed': len(results) - succeeded,
+            'results': results
+        }), 200
+
+    except admin_batch.BatchError as e:
+        return jsonify({'message': str(e)}), 400
+    except Exception as e:
+        print('Error in batch_verify_users:', str(e))
+        return jsonify({'message': 'Failed to verify users'}), 500
+
 @app.route('/api/admin/users/<user_id>/verify', methods=['POST'])
 @admin_required
 def verify_user(user_id):
@@ -289,12 +420,13 @@ def verify_user(user_id):
         # Update user verification status
         result = mongo_client.pos.users.update_one(
             {'_id': ObjectId(user_id)},
-            {'$set': {'isVerified': True}}
+            {'$set': {'isVerified': True}, '$inc': {'dataVersion': 1}}
         )
 
         if result.modified_count == 0:
             return jsonify({'message': 'User not found'}), 404
 
+        events.publish('user.verified', {'id': user_id}, {'pendingVerifications': -1})
         return jsonify({'message': 'User verified successfully'}), 200
 
     except Exception as e:
@@ -349,6 +481,7 @@ def admin_reset_password():
             'isUsed': False
         }
         mongo_client.pos.password_resets.insert_one(reset_record)
+        events.publish('password_reset.created', {'userId': user['_id'], 'username': user.get('username', ''), 'phone': phone})
 
         print("Password reset successful")
         return jsonify({
@@ -417,7 +550,7 @@ def get_admin_stats():
             }
         ]
         total_investments = list(mongo_client.pos.investments.aggregate(investments_pipeline))
-        total_investments_amount = total_investments[0]['total'] if total_investments else 0
+        total_investments_amount = money.to_decimal(total_investments[0]['total'] if total_investments else 0)
         print(f"Total investments: {total_investments_amount}")
         
         # Get total transactions (deposits and withdrawals)
@@ -434,7 +567,7 @@ def get_admin_stats():
                 }
             }
         ]
-        transaction_totals = {doc['_id']: doc['total'] 
+        transaction_totals = {doc['_id']: money.to_decimal(doc['total'])
                             for doc in mongo_client.pos.transactions.aggregate(transactions_pipeline)}
         print(f"Transaction totals by type: {transaction_totals}")
         
@@ -497,6 +630,98 @@ def get_admin_stats():
         print(f"Traceback: {traceback.format_exc()}")
         return jsonify({'message': 'Failed to fetch admin stats'}), 500
 
+@app.route('/api/admin/analytics/cashflow', methods=['GET'])
+@admin_required
+def get_cashflow_analytics():
+    try:
+        granularity = request.args.get('granularity', 'day')
+        if granularity not in analytics.GRANULARITIES:
+            return jsonify({'message': f"granularity must be one of {', '.join(analytics.GRANULARITIES)}"}), 400
+        try:
+            end = datetime.fromisoformat(request.args['to']) if request.args.get('to') else datetime.utcnow()
+            default_span = timedelta(days=2) if granularity == 'hour' else timedelta(days=30)
+            start = datetime.fromisoformat(request.args['from']) if request.args.get('from') else end - default_span
+        except ValueError:
+            return jsonify({'message': 'from/to must be ISO dates'}), 400
+        if start >= end:
+            return jsonify({'message': 'Invalid date range'}), 400
+
+        series = analytics.query(db, start, end, granularity)
+        return jsonify({
+            'granularity': granularity,
+            'from': start.isoformat(),
+            'to': end.isoformat(),
+            'series': series
+        }), 200
+
+    except Exception as e:
+        print('Error in get_cashflow_analytics:', str(e))
+        import traceback
+        print(f"Traceback: {traceback.format_exc()}")
+        return jsonify({'message': 'Failed to fetch cashflow analytics'}), 500
+
+@app.route('/api/admin/config', methods=['GET'])
+@admin_required
+def get_platform_config():
+    return jsonify(config_store.get(db).as_dict()), 200
+
+@app.route('/api/admin/config', methods=['PUT'])
+@admin_required
+def update_platform_config():
+    try:
+        data = request.get_json() or {}
+        changes = {}
+        for section in config_store.SECTIONS:
+            values = data.get(section)
+            if values is None:
+                continue
+            if not isinstance(values, dict):
+                return jsonify({'message': f'{section} must be an object'}), 400
+            for key, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                    return jsonify({'message': f'{section}.{key} must be a non-negative number'}), 400
+            if section == 'daily_commission' and not set(values) <= {'level1', 'level2', 'level3'}:
+                return jsonify({'message': 'daily_commission only has level1, level2 and level3'}), 400
+            changes[section] = values
+
+        if not changes:
+            return jsonify({'message': f"Nothing to update, expected one of {', '.join(config_store.SECTIONS)}"}), 400
+
+        snapshot = config_store.store.update(
+            db, changes,
+            expected_version=data.get('version'),
+            updated_by=ObjectId(session['user_id'])
+        )
+        print(f"Platform config updated to version {snapshot.version}: {changes}")
+        return jsonify(snapshot.as_dict()), 200
+
+    except config_store.ConfigConflict:
+        return jsonify({'message': 'Config was changed by someone else, reload and retry'}), 409
+    except Exception as e:
+        print('Error in update_platform_config:', str(e))
+        return jsonify({'message': 'Failed to update config'}), 500
+
+@app.route('/api/admin/projections/liability', methods=['GET'])
+@admin_required
+def get_liability_projection():
+    try:
+        days = int(request.args.get('days', 30))
+        if days < 1 or days > 260:
+            return jsonify({'message': 'days must be between 1 and 260'}), 400
+
+        book = projection.load_book(db)
+        result = projection.project(book, projection.current_rates(db), days=days)
+        print(f"Projected {days} business days over {result['investments']} active investments")
+        return jsonify(result), 200
+
+    except ValueError:
+        return jsonify({'message': 'days must be an integer'}), 400
+    except Exception as e:
+        print('Error in get_liability_projection:', str(e))
+        import traceback
+        print(f"Traceback: {traceback.format_exc()}")
+        return jsonify({'message': 'Failed to project liabilities'}), 500
+
 @app.route('/api/admin/users', methods=['GET'])
 @admin_required
 def get_all_users():
@@ -592,23 +817,33 @@ def get_all_users():
 def delete_user(user_id):
     try:
         # Check if user exists
-        user = mongo_client.pos.users.find_one({'_id': ObjectId(user_id)})
+        user = find_by_id(mongo_client.pos.users, ObjectId(user_id))
         if not user:
             return jsonify({'message': 'User not found'}), 404
 
-        # Delete user's transactions
-        mongo_client.pos.transactions.delete_many({'userId': ObjectId(user_id)})
-        
-        # Delete user's investments
-        mongo_client.pos.investments.delete_many({'userId': ObjectId(user_id)})
-        
-        # Delete the user
-        result = mongo_client.pos.users.delete_one({'_id': ObjectId(user_id)})
-        
-        if result.deleted_count == 0:
-            return jsonify({'message': 'Failed to delete user'}), 500
-            
-        return jsonify({'message': 'User deleted successfully'}), 200
+        referrals = request.args.get('referrals', 'tombstone')
+        if referrals not in user_deletion.REFERRAL_MODES:
+            return jsonify({'message': f"referrals must be one of {', '.join(user_deletion.REFERRAL_MODES)}"}), 400
+
+        # The upline's referral stats count this user
+        bump_referral_chain(user_id)
+
+        # Disable the account now and remove its data in the background
+        deletion = user_deletion.request_deletion(
+            mongo_client.pos, ObjectId(user_id),
+            requested_by=ObjectId(session['user_id']),
+            referrals=referrals
+        )
+
+        job = user_deletion.schedule(mongo_client.pos, deletion)
+
+        print(f"Deletion {deletion['_id']} of user {user_id} queued as job {job['_id']}")
+        return jsonify({
+            'message': 'User deletion started',
+            'deletionId': str(deletion['_id']),
+            'jobId': str(job['_id']),
+            'status': deletion['status']
+        }), 202
 
     except Exception as e:
         print('Error in delete_user:', str(e))
@@ -616,32 +851,142 @@ def delete_user(user_id):
         print(f"Traceback: {traceback.format_exc()}")
         return jsonify({'message': 'Failed to delete user'}), 500
 
+@app.route('/api/admin/deletions/<deletion_id>', methods=['GET'])
+@admin_required
+def get_deletion_progress(deletion_id):
+    try:
+        progress = user_deletion.get_progress(mongo_client.pos, deletion_id)
+        if not progress:
+            return jsonify({'message': 'Deletion not found'}), 404
+        return jsonify(progress), 200
+    except Exception as e:
+        print('Error in get_deletion_progress:', str(e))
+        return jsonify({'message': 'Failed to fetch deletion progress'}), 500
+
+@app.route('/api/admin/jobs', methods=['GET'])
+@admin_required
+def get_job_queue_status():
+    try:
+        return jsonify(jobs.stats(mongo_client.pos)), 200
+    except Exception as e:
+        print('Error in get_job_queue_status:', str(e))
+        return jsonify({'message': 'Failed to fetch job queue status'}), 500
+
+@app.route('/api/admin/jobs/<job_id>', methods=['GET'])
+@admin_required
+def get_job(job_id):
+    try:
+        job = jobs.get_job(mongo_client.pos, job_id)
+        if not job:
+            return jsonify({'message': 'Job not found'}), 404
+        return jsonify(job), 200
+    except Exception as e:
+        print('Error in get_job:', str(e))
+        return jsonify({'message': 'Failed to fetch job'}), 500
+
+@app.route('/api/admin/jobs/<job_id>/retry', methods=['POST'])
+@admin_required
+def retry_job(job_id):
+    try:
+        job = jobs.retry(mongo_client.pos, job_id)
+    except DuplicateKeyError:
+        return jsonify({'message': 'The same work is already queued'}), 409
+    except Exception as e:
+        print('Error in retry_job:', str(e))
+        return jsonify({'message': 'Failed to retry job'}), 500
+    if not job:
+        return jsonify({'message': 'Only failed jobs can be retried'}), 409
+    return jsonify(jobs.serialize(job)), 200
+
+@app.route('/api/admin/slow-queries', methods=['GET'])
+@admin_required
+def get_slow_queries():
+    try:
+        hours = min(request.args.get('hours', 24, type=int), 24 * 30)
+        limit = min(request.args.get('limit', 20, type=int), 100)
+        return jsonify({
+            'thresholdMs': slow_queries.THRESHOLD_MS,
+            'hours': hours,
+            'shapes': slow_queries.worst_shapes(mongo_client.pos, hours, limit)
+        }), 200
+    except Exception as e:
+        print('Error in get_slow_queries:', str(e))
+        return jsonify({'message': 'Failed to fetch slow queries'}), 500
+
+@app.route('/api/admin/profiles', methods=['GET'])
+@admin_required
+def get_request_profiles():
+    try:
+        limit = min(request.args.get('limit', 50, type=int), 200)
+        return jsonify({'profiles': request_profiler.recent(mongo_client.pos, limit)}), 200
+    except Exception as e:
+        print('Error in get_request_profiles:', str(e))
+        return jsonify({'message': 'Failed to fetch request profiles'}), 500
+
+@app.route('/api/admin/profiles/<profile_id>', methods=['GET'])
+@admin_required
+def get_request_profile(profile_id):
+    try:
+        report = request_profiler.get_report(mongo_client.pos, profile_id)
+        if not report:
+            return jsonify({'message': 'Profile not found'}), 404
+        return jsonify(report), 200
+    except Exception as e:
+        print('Error in get_request_profile:', str(e))
+        return jsonify({'message': 'Failed to fetch request profile'}), 500
+
+@app.route('/api/admin/reconciliation', methods=['POST'])
+@admin_required
+def start_reconciliation():
+    data = request.get_json(silent=True) or {}
+    kinds = data.get('kinds') or list(reconciliation.KINDS)
+    repair = data.get('repair') or []
+    for field, values in (('kinds', kinds), ('repair', repair)):
+        if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+            return jsonify({'message': f'{field} must be a list of figure names'}), 400
+    unknown = set(kinds + repair) - set(reconciliation.KINDS)
+    if unknown:
+        return jsonify({'message': f"Unknown figures: {', '.join(sorted(unknown))}"}), 400
+    try:
+        # One audit at a time; asking again returns the queued/running one
+        job = jobs.enqueue(
+            mongo_client.pos, 'reconciliation',
+            {'runId': str(ObjectId()), 'kinds': kinds, 'repair': repair},
+            max_attempts=2, dedupe_key='reconciliation'
+        )
+        return jsonify({'runId': job['payload']['runId'], 'jobId': str(job['_id'])}), 202
+    except Exception as e:
+        print('Error in start_reconciliation:', str(e))
+        return jsonify({'message': 'Failed to start reconciliation'}), 500
+
+@app.route('/api/admin/reconciliation/<run_id>', methods=['GET'])
+@admin_required
+def get_reconciliation(run_id):
+    try:
+        report = reconciliation.get_report(
+            mongo_client.pos, run_id,
+            kind=request.args.get('kind'),
+            limit=min(request.args.get('limit', 100, type=int), 1000)
+        )
+        if not report:
+            return jsonify({'message': 'Reconciliation run not found'}), 404
+        return jsonify(report), 200
+    except Exception as e:
+        print('Error in get_reconciliation:', str(e))
+        return jsonify({'message': 'Failed to fetch reconciliation report'}), 500
+
 # Admin routes for fetching data
 @app.route('/api/admin/transactions/pending', methods=['GET'])
 @admin_required
 def get_pending_transactions():
     try:
-        # Get all pending transactions with user details
+        # Get all pending transactions; username/phone are snapshotted on each row
         pipeline = [
             {
                 '$match': {
                     'status': 'pending'
                 }
             },
-            {
-                '$lookup': {
-                    'from': 'users',
-                    'localField': 'userId',
-                    'foreignField': '_id',
-                    'as': 'user'
-                }
-            },
-            {
-                '$unwind': {
-                    'path': '$user',
-                    'preserveNullAndEmptyArrays': True
-                }
-            },
             {
                 '$project': {
                     '_id': 1,
@@ -649,14 +994,15 @@ def get_pending_transactions():
                     'amount': 1,
                     'status': 1,
                     'createdAt': 1,
-                    'userId': 1,
-                    'username': '$user.username',
-                    'phone': '$user.phone'
+                    'userId': {'$ifNull': ['$user_id', '$userId']},
+                    'username': 1,
+                    'phone': 1
                 }
             }
         ]
         
         transactions = list(mongo_client.pos.transactions.aggregate(pipeline))
+        user_snapshots.fill_missing(mongo_client.pos, transactions)
         
         # Format the transactions for JSON serialization
         formatted_transactions = []
@@ -664,12 +1010,12 @@ def get_pending_transactions():
             formatted_transaction = {
                 '_id': str(transaction['_id']),
                 'type': transaction.get('type', ''),
-                'amount': float(transaction.get('amount', 0)),
+                'amount': money.to_number(transaction.get('amount')),
                 'status': transaction.get('status', ''),
                 'createdAt': transaction.get('createdAt', datetime.utcnow()).isoformat() if isinstance(transaction.get('createdAt'), datetime) else str(transaction.get('createdAt', '')),
                 'userId': str(transaction.get('userId', '')),
-                'username': transaction.get('username', ''),
-                'phone': transaction.get('phone', '')
+                'username': transaction.get('username') or '',
+                'phone': transaction.get('phone') or ''
             }
             formatted_transactions.append(formatted_transaction)
 
@@ -746,43 +1092,23 @@ def get_all_transactions():
             print(f"Error counting documents: {str(e)}")
             raise
 
-        try:
-            # First get a sample transaction to debug the userId format
-            sample_transaction = mongo_client.pos.transactions.find_one()
-            if sample_transaction:
-                print(f"Sample transaction fields: {list(sample_transaction.keys())}")
-                user_id = sample_transaction.get('user_id')  # Using get() with no default
-                print(f"Sample transaction user_id: {user_id} ({type(user_id).__name__ if user_id is not None else 'None'})")
-        except Exception as e:
-            print(f"Error getting sample transaction: {str(e)}")
-            raise
-            
-        # Get transactions with user details
+        # Get transactions; username/phone are snapshotted on each row
         pipeline = [
             {'$match': query},
             {'$sort': {'createdAt': -1}},
             {'$skip': skip},
             {'$limit': limit},
-            {
-                '$lookup': {
-                    'from': 'users',
-                    'localField': 'user_id',
-                    'foreignField': '_id',
-                    'as': 'user'
-                }
-            },
-            {'$unwind': {'path': '$user', 'preserveNullAndEmptyArrays': True}},
             {
                 '$project': {
                     '_id': {'$toString': '$_id'},
-                    'userId': {'$toString': '$user_id'},
+                    'userId': {'$ifNull': ['$user_id', '$userId']},
                     'type': 1,
                     'amount': 1,
                     'status': 1,
                     'createdAt': {'$toString': '$createdAt'},
                     'updatedAt': {'$toString': '$updatedAt'},
-                    'username': {'$ifNull': ['$user.username', 'Unknown User']},
-                    'phone': {'$ifNull': ['$user.phone', '-']},
+                    'username': 1,
+                    'phone': 1,
                     'paymentMethod': 1,
                     'transactionId': 1,
                     'reference': 1
@@ -794,6 +1120,13 @@ def get_all_transactions():
         try:
             transactions = list(mongo_client.pos.transactions.aggregate(pipeline))
             print(f"Found {len(transactions)} transactions for current page")
+
+            # Rows written before the snapshot backfill ran
+            user_snapshots.fill_missing(mongo_client.pos, transactions)
+            for transaction in transactions:
+                transaction['userId'] = str(transaction['userId']) if transaction.get('userId') else None
+                transaction['username'] = transaction.get('username') or 'Unknown User'
+                transaction['phone'] = transaction.get('phone') or '-'
             
             # Debug first transaction's user info
             if transactions:
@@ -818,82 +1151,73 @@ def get_all_transactions():
         print(f"Traceback: {traceback.format_exc()}")
         return jsonify({'message': 'Failed to fetch transactions', 'error': str(e)}), 500
 
-# MongoDB connection with retry
-def connect_to_mongodb():
-    mongo_uri = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/pos')
-    max_retries = 5
-    retry_delay = 5  # seconds
+# MongoDB connection (created lazily per process, see database.py)
+from database import connection as mongo_connection, mongo_client, db
+mongo_connection.add_event_listener(WriteListener())
+mongo_connection.add_event_listener(slow_queries.SlowQueryListener())
+mongo_connection.add_event_listener(request_profiler.MongoRoundTrips())
 
-    for attempt in range(max_retries):
+# Initialize commission rates if not exists
+@mongo_connection.on_first_connect
+def init_commission_rates(db=db):
+    config_store.ensure_indexes(db)
+    config_store.ensure_defaults(db)
+
+@mongo_connection.on_first_connect
+def init_history_indexes(db=db):
+    history_store.ensure_indexes(db)
+    earnings_rollups.ensure_indexes(db)
+    analytics.ensure_indexes(db)
+    user_snapshots.ensure_indexes(db)
+    events.ensure_collection(db)
+    user_deletion.ensure_indexes(db)
+    jobs.ensure_indexes(db)
+    referral_codes.ensure_indexes(db)
+    reconciliation.ensure_indexes(db)
+    slow_queries.ensure_collection(db)
+    request_profiler.ensure_indexes(db)
+
+# One one-time reward per referrer and referee, one daily commission per
+# referrer, referee and day: concurrent requests or a re-run nightly job
+# then fail with DuplicateKeyError instead of crediting twice
+REFERRAL_HISTORY_UNIQUE = (
+    ('one_time_reward', [('referrerId', 1), ('userId', 1)]),
+    ('daily_commission', [('referrerId', 1), ('referredId', 1), ('date', 1)]),
+)
+
+@mongo_connection.on_first_connect
+def init_referral_history_indexes(db=db):
+    for kind, keys in REFERRAL_HISTORY_UNIQUE:
         try:
-            print(f"Connecting to MongoDB at: {mongo_uri} (attempt {attempt + 1}/{max_retries})")
-            client = MongoClient(mongo_uri, serverSelectionTimeoutMS=5000)
-            # Test the connection
-            client.server_info()
-            print("Successfully connected to MongoDB")
-            return client
-        except Exception as e:
-            print(f"MongoDB connection error (attempt {attempt + 1}): {str(e)}")
-            if attempt < max_retries - 1:
-                print(f"Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
-            else:
-                print("Max retries reached. Could not connect to MongoDB.")
-                raise
-
-try:
-    mongo_client = connect_to_mongodb()
-    db = mongo_client.pos
-except Exception as e:
-    print(f"Fatal: Could not connect to MongoDB: {str(e)}")
-    raise
+            db.referral_history.create_index(
+                keys, unique=True, name=f'unique_{kind}',
+                partialFilterExpression={'type': kind}
+            )
+        except OperationFailure as e:
+            # Existing duplicates; crediting still works, but without the guarantee
+            print(f"referral_history {kind} unique index not built: {str(e)}")
 
-# Initialize commission rates if not exists
-def init_commission_rates():
-    if db.commission_rates.count_documents({}) == 0:
-        db.commission_rates.insert_one({
-            'forex_rewards': {
-                'EUR/USD': 100,
-                'GBP/USD': 300,
-                'USD/JPY': 500,
-                'USD/CHF': 600,
-                'AUD/USD': 700,
-                'EUR/GBP': 1000,
-                'EUR/AUD': 1500,
-                'USD/CAD': 2500,
-                'NZD/USD': 5000
-            },
-            'daily_commission': {
-                'level1': 0.10,  # 10% ROI
-                'level2': 0.05,  # 5% ROI
-                'level3': 0.02   # 2% ROI
-            },
-            'created_at': datetime.utcnow(),
-            'updated_at': datetime.utcnow()
+def credit_daily_commission(referrer_id, referred_id, level, commission, base_amount, rate, day, created_at):
+    """Record and credit one daily commission; False if it was already recorded for that day"""
+    try:
+        db.referral_history.insert_one({
+            'referrerId': referrer_id,
+            'referredId': referred_id,
+            'level': level,
+            'type': 'daily_commission',
+            'amount': money.to_bson(commission),
+            'rate': rate,
+            'baseAmount': money.to_bson(base_amount),
+            'date': day,
+            'createdAt': created_at
         })
-
-# Call initialization when app starts
-init_commission_rates()
-
-# Forex referral rewards
-FOREX_REFERRAL_REWARDS = {
-    'EUR/USD': 100,
-    'GBP/USD': 300,
-    'USD/JPY': 500,
-    'USD/CHF': 600,
-    'AUD/USD': 700,
-    'EUR/GBP': 1000,
-    'EUR/AUD': 1500,
-    'USD/CAD': 2500,
-    'NZD/USD': 5000
-}
-
-def generate_referral_code():
-    import random
-    import string
-    # Generate a 6-character referral code using uppercase letters and numbers
-    characters = string.ascii_uppercase + string.digits
-    return ''.join(random.choices(characters, k=6))
+    except DuplicateKeyError:
+        return False
+    db.users.update_one(
+        {'_id': referrer_id},
+        {'$inc': {'referralEarnings': money.to_bson(commission), 'dataVersion': 1}}
+    )
+    return True
 
 def calculate_referral_earnings(user_id):
     """Calculate earnings from referrals based on levels"""
@@ -910,7 +1234,7 @@ def calculate_referral_earnings(user_id):
         ]).next()
         
         return {
-            'total': round(total_rewards.get('total', 0), 2)
+            'total': money.to_decimal(total_rewards.get('total'))
         }
     except Exception as e:
         print(f"Error calculating referral earnings: {str(e)}")
@@ -923,12 +1247,7 @@ def calculate_daily_referral_commissions():
         print(f"Time: {datetime.utcnow()}")
         
         # Get current commission rates
-        commission_rates = db.commission_rates.find_one({}, sort=[('created_at', -1)])
-        if not commission_rates:
-            print("No commission rates found")
-            return
-            
-        daily_rates = commission_rates['daily_commission']
+        daily_rates = config_store.get(db).daily_commission
         print(f"Commission rates: {daily_rates}")
         
         # Get today's date (UTC)
@@ -938,20 +1257,18 @@ def calculate_daily_referral_commissions():
         print(f"Calculating commissions for date: {current_time.date()}")
         
         # Get all investment history entries from today
-        today_earnings = list(db.investment_history.find({
-            'type': 'roi_earning',
-            'date': current_time.date().isoformat()
-        }))
+        today_earnings = history_store.get_entries_for_date(db, current_time.date().isoformat(), 'roi_earning')
         print(f"Found {len(today_earnings)} ROI earnings for today")
         
         # Track processed commissions
         processed_commissions = set()
-        total_commissions = {'level1': 0, 'level2': 0, 'level3': 0}
+        total_commissions = {'level1': money.ZERO, 'level2': money.ZERO, 'level3': money.ZERO}
+        commission_counts = {'level1': 0, 'level2': 0, 'level3': 0}
         
         for earning in today_earnings:
             try:
                 user_id = earning['userId']
-                daily_roi_earnings = earning['amount']
+                daily_roi_earnings = money.to_decimal(earning['amount'])
                 print(f"\nProcessing ROI earning: {daily_roi_earnings} for user {user_id}")
                 
                 # Get user's referral chain
@@ -964,33 +1281,19 @@ def calculate_daily_referral_commissions():
                 commission_key = f"{str(level1_referrer_id)}_{str(user_id)}_{current_time.date()}"
                 
                 if commission_key not in processed_commissions:
-                    level1_commission = daily_roi_earnings * daily_rates['level1']
-                    
-                    # Record commission
-                    db.referral_history.insert_one({
-                        'referrerId': level1_referrer_id,
-                        'referredId': user_id,
-                        'level': 1,
-                        'type': 'daily_commission',
-                        'amount': level1_commission,
-                        'rate': daily_rates['level1'],
-                        'baseAmount': daily_roi_earnings,
-                        'date': today_start,
-                        'createdAt': current_time
-                    })
+                    level1_commission = money.share(daily_roi_earnings, daily_rates['level1'])
                     
-                    # Update user's earnings and balance
-                    db.users.update_one(
-                        {'_id': level1_referrer_id},
-                        {
-                            '$inc': {
-                                'referralEarnings': level1_commission
-                            }
-                        }
+                    # Record and credit the commission (once per day, even across runs)
+                    credited = credit_daily_commission(
+                        level1_referrer_id, user_id, 1, level1_commission, daily_roi_earnings,
+                        daily_rates['level1'], today_start, current_time
                     )
                     
                     processed_commissions.add(commission_key)
-                    print(f"Level 1 commission: {level1_commission} credited to {level1_referrer_id}")
+                    if credited:
+                        total_commissions['level1'] += level1_commission
+                        commission_counts['level1'] += 1
+                        print(f"Level 1 commission: {level1_commission} credited to {level1_referrer_id}")
                     
                     # Process Level 2
                     level1_user = db.users.find_one({'_id': level1_referrer_id})
@@ -999,31 +1302,18 @@ def calculate_daily_referral_commissions():
                         level2_commission_key = f"{str(level2_referrer_id)}_{str(user_id)}_{current_time.date()}"
                         
                         if level2_commission_key not in processed_commissions:
-                            level2_commission = daily_roi_earnings * daily_rates['level2']
+                            level2_commission = money.share(daily_roi_earnings, daily_rates['level2'])
                             
-                            db.referral_history.insert_one({
-                                'referrerId': level2_referrer_id,
-                                'referredId': user_id,
-                                'level': 2,
-                                'type': 'daily_commission',
-                                'amount': level2_commission,
-                                'rate': daily_rates['level2'],
-                                'baseAmount': daily_roi_earnings,
-                                'date': today_start,
-                                'createdAt': current_time
-                            })
-                            
-                            db.users.update_one(
-                                {'_id': level2_referrer_id},
-                                {
-                                    '$inc': {
-                                        'referralEarnings': level2_commission
-                                    }
-                                }
+                            credited = credit_daily_commission(
+                                level2_referrer_id, user_id, 2, level2_commission, daily_roi_earnings,
+                                daily_rates['level2'], today_start, current_time
                             )
                             
                             processed_commissions.add(level2_commission_key)
-                            print(f"Level 2 commission: {level2_commission} credited to {level2_referrer_id}")
+                            if credited:
+                                total_commissions['level2'] += level2_commission
+                                commission_counts['level2'] += 1
+                                print(f"Level 2 commission: {level2_commission} credited to {level2_referrer_id}")
                             
                             # Process Level 3
                             level2_user = db.users.find_one({'_id': level2_referrer_id})
@@ -1032,36 +1322,28 @@ def calculate_daily_referral_commissions():
                                 level3_commission_key = f"{str(level3_referrer_id)}_{str(user_id)}_{current_time.date()}"
                                 
                                 if level3_commission_key not in processed_commissions:
-                                    level3_commission = daily_roi_earnings * daily_rates['level3']
-                                    
-                                    db.referral_history.insert_one({
-                                        'referrerId': level3_referrer_id,
-                                        'referredId': user_id,
-                                        'level': 3,
-                                        'type': 'daily_commission',
-                                        'amount': level3_commission,
-                                        'rate': daily_rates['level3'],
-                                        'baseAmount': daily_roi_earnings,
-                                        'date': today_start,
-                                        'createdAt': current_time
-                                    })
+                                    level3_commission = money.share(daily_roi_earnings, daily_rates['level3'])
                                     
-                                    db.users.update_one(
-                                        {'_id': level3_referrer_id},
-                                        {
-                                            '$inc': {
-                                                'referralEarnings': level3_commission
-                                            }
-                                        }
+                                    credited = credit_daily_commission(
+                                        level3_referrer_id, user_id, 3, level3_commission, daily_roi_earnings,
+                                        daily_rates['level3'], today_start, current_time
                                     )
                                     
                                     processed_commissions.add(level3_commission_key)
-                                    print(f"Level 3 commission: {level3_commission} credited to {level3_referrer_id}")
+                                    if credited:
+                                        total_commissions['level3'] += level3_commission
+                                        commission_counts['level3'] += 1
+                                        print(f"Level 3 commission: {level3_commission} credited to {level3_referrer_id}")
             
             except Exception as e:
                 print(f"Error processing commission for earning {earning.get('_id')}: {str(e)}")
                 continue
         
+        analytics.record(db, current_time, {
+            f'commissions.{level}': (commission_counts[level], total)
+            for level, total in total_commissions.items() if commission_counts[level]
+        })
+        
         print("\n=== Commission Calculation Summary ===")
         print(f"Total Level 1 Commissions: {total_commissions['level1']}")
         print(f"Total Level 2 Commissions: {total_commissions['level2']}")
@@ -1091,9 +1373,11 @@ def calculate_daily_roi_earnings():
         active_investments = list(db.investments.find({'status': 'active'}))
         print(f"Found {len(active_investments)} active investments")
         
-        total_roi = 0
+        total_roi = money.ZERO
         processed_count = 0
         expired_count = 0
+        touched_users = set()
+        roi_by_pair = {}
         
         for investment in active_investments:
             try:
@@ -1107,8 +1391,8 @@ def calculate_daily_roi_earnings():
                     print(f"\nInvestment {investment['_id']} has expired (age: {age_days} days)")
                     
                     # Update investment status to expired
-                    db.investments.update_one(
-                        {'_id': investment['_id']},
+                    expired = db.investments.update_one(
+                        {'_id': investment['_id'], 'status': 'active'},
                         {
                             '$set': {
                                 'status': 'expired',
@@ -1117,64 +1401,77 @@ def calculate_daily_roi_earnings():
                             }
                         }
                     )
+                    if expired.modified_count == 0:
+                        continue
+                    release_investment(investment['userId'], investment.get('forexPair'))
                     
                     # Record the expiry in history
-                    db.investment_history.insert_one({
-                        'investmentId': investment['_id'],
-                        'userId': investment['userId'],
-                        'type': 'investment_expired',
-                        'amount': float(investment.get('amount', 0)),
-                        'date': current_time.date().isoformat(),
-                        'createdAt': current_time,
-                        'balance': float(investment.get('profit', 0))
-                    })
+                    history_store.record_entry(
+                        db,
+                        investment_id=investment['_id'],
+                        user_id=investment['userId'],
+                        entry_type='investment_expired',
+                        amount=money.to_decimal(investment.get('amount')),
+                        date=current_time.date().isoformat(),
+                        created_at=current_time,
+                        balance=money.to_decimal(investment.get('profit'))
+                    )
                     
                     expired_count += 1
+                    touched_users.add(investment['userId'])
                     continue
                 
                 # Get investment details
                 user_id = investment['userId']
-                amount = float(investment.get('amount', 0))
-                daily_roi = float(investment.get('dailyROI', 0))
-                current_profit = float(investment.get('profit', 0))
+                amount = investment.get('amount')
+                daily_roi = investment.get('dailyROI', 0)
                 
-                # Calculate today's earnings
-                daily_earnings = amount * (daily_roi / 100)
-                new_profit = current_profit + daily_earnings
+                # Calculate today's earnings, in cents
+                daily_earnings = money.percent(amount, daily_roi)
                 total_roi += daily_earnings
                 processed_count += 1
                 
                 print(f"\nProcessing investment {investment['_id']}:")
                 print(f"Amount: {amount}, ROI: {daily_roi}%, Earnings: {daily_earnings}")
                 
-                # Update investment profit
-                db.investments.update_one(
+                # Update investment profit; $inc keeps the stored total exact
+                updated = db.investments.find_one_and_update(
                     {'_id': investment['_id']},
                     {
-                        '$set': {
-                            'profit': new_profit,
-                            'lastProfitUpdate': current_time
-                        }
-                    }
+                        '$inc': {'profit': money.to_bson(daily_earnings)},
+                        '$set': {'lastProfitUpdate': current_time}
+                    },
+                    projection={'profit': 1},
+                    return_document=ReturnDocument.AFTER
                 )
+                new_profit = money.to_decimal(updated['profit'])
                 
                 # Record the earnings in history
-                db.investment_history.insert_one({
-                    'investmentId': investment['_id'],
-                    'userId': user_id,
-                    'type': 'roi_earning',
-                    'amount': daily_earnings,
-                    'date': current_time.date().isoformat(),
-                    'createdAt': current_time,
-                    'balance': new_profit
-                })
+                history_store.record_entry(
+                    db,
+                    investment_id=investment['_id'],
+                    user_id=user_id,
+                    entry_type='roi_earning',
+                    amount=daily_earnings,
+                    date=current_time.date().isoformat(),
+                    created_at=current_time,
+                    balance=new_profit
+                )
                 
+                touched_users.add(user_id)
+                pair = investment.get('forexPair', 'unknown')
+                count, pair_total = roi_by_pair.get(pair, (0, money.ZERO))
+                roi_by_pair[pair] = (count + 1, pair_total + daily_earnings)
                 print(f"Added {daily_earnings} to investment {investment['_id']}, new profit: {new_profit}")
                 
             except Exception as inv_error:
                 print(f"Error processing investment {investment.get('_id')}: {str(inv_error)}")
                 continue
         
+        # One round trip to invalidate every affected user's cached views
+        bump_data_version(*touched_users)
+        analytics.record(db, current_time, {f'roi.{pair}': totals for pair, totals in roi_by_pair.items()})
+        
         print("\n=== ROI Calculation Summary ===")
         print(f"Processed {processed_count} investments")
         print(f"Expired {expired_count} investments")
@@ -1202,11 +1499,6 @@ def register():
         if db.users.find_one({'phone': phone}):
             return jsonify({'error': 'Phone number already registered'}), 400
 
-        # Generate a unique referral code for the new user
-        new_referral_code = generate_referral_code()
-        while db.users.find_one({'referralCode': new_referral_code}):
-            new_referral_code = generate_referral_code()
-
         # Find referrer if referral code was provided
         referrer = None
         if referral_code:
@@ -1219,9 +1511,8 @@ def register():
             'username': username,
             'phone': phone,
             'password': bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8'),
-            'balance': 0,
-            'signupBonus': 100,  # Add 100 KSH signup bonus to withdrawable amount
-            'referralCode': new_referral_code,
+            'balance': money.to_bson(0),
+            'signupBonus': money.to_bson(100),  # Add 100 KSH signup bonus to withdrawable amount
             'referredBy': ObjectId(referrer['_id']) if referrer else None,
             'isActive': True,
             'createdAt': current_time,
@@ -1229,8 +1520,12 @@ def register():
             '__v': 0
         }
         
-        result = db.users.insert_one(user)
-        user_id = result.inserted_id
+        # The unique index on referralCode makes the insert pick the code
+        new_referral_code = referral_codes.insert_user(db, user)
+        user_id = user['_id']
+        if referrer:
+            bump_referral_chain(user_id)
+        events.publish('user.registered', {'id': user_id, 'username': username, 'phone': phone}, {'totalUsers': 1})
         
         session_user = {
             '_id': str(user_id),
@@ -1273,7 +1568,7 @@ def login():
             print(f"Database error: {str(db_error)}")
             return jsonify({'error': 'Database error'}), 500
 
-        if not user:
+        if not user or user.get('deletionId'):
             return jsonify({'error': 'Invalid credentials'}), 401
 
         stored_password = user.get('password')
@@ -1338,15 +1633,77 @@ def login():
         print("Traceback:", traceback.format_exc())
         return jsonify({'error': 'Login failed'}), 500
 
-def calculate_withdrawable_amount(user_id, exclude_transaction_id=None):
+MAX_INVESTMENTS_PER_PAIR = 2
+
+def reserve_investment(user_id, forex_pair, amount):
+    """Debit the balance and take a slot for forex_pair in one guarded update.
+
+    users.activePairs.<pair> counts active investments per pair so the balance
+    check and the per-pair limit are enforced by the same write. Users created
+    before the counter existed get it seeded from the investments collection.
+    Returns (user after the update, None) or (None, error response).
+    """
+    slot = f'activePairs.{forex_pair}'
+    amount = money.to_decimal(amount)
+    stake, debit = money.to_bson(amount), money.to_bson(-amount)
+    for _ in range(2):
+        user = db.users.find_one_and_update(
+            {'_id': user_id, 'balance': {'$gte': stake}, slot: {'$lt': MAX_INVESTMENTS_PER_PAIR}},
+            {'$inc': {'balance': debit, slot: 1, 'dataVersion': 1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if user:
+            return user, None
+
+        current = db.users.find_one({'_id': user_id}, {'balance': 1, 'activePairs': 1})
+        if not current:
+            return None, (jsonify({'error': 'User not found'}), 404)
+        if amount > money.to_decimal(current.get('balance')):
+            return None, (jsonify({'error': 'Insufficient balance'}), 400)
+
+        existing = current.get('activePairs', {}).get(forex_pair)
+        if existing is None:
+            existing = db.investments.count_documents({
+                'userId': user_id,
+                'forexPair': forex_pair,
+                'status': 'active'
+            })
+            if existing < MAX_INVESTMENTS_PER_PAIR:
+                user = db.users.find_one_and_update(
+                    {'_id': user_id, 'balance': {'$gte': stake}, slot: {'$exists': False}},
+                    {'$inc': {'balance': debit, 'dataVersion': 1}, '$set': {slot: existing + 1}},
+                    return_document=ReturnDocument.AFTER
+                )
+                if user:
+                    return user, None
+                # Lost a race with another request; go round again
+                continue
+
+        if existing >= MAX_INVESTMENTS_PER_PAIR:
+            return None, (jsonify({'error': f'Maximum of {MAX_INVESTMENTS_PER_PAIR} active investments allowed per forex pair. You already have {existing} active investments in {forex_pair}'}), 400)
+
+    return None, (jsonify({'error': 'Investment could not be placed, please retry'}), 409)
+
+def release_investment(user_id, forex_pair, refund=0):
+    """Give back a pair slot (and optionally refund the amount).
+
+    Returns False if the user had no slot counted for the pair, in which case
+    nothing (not even the refund) was written.
+    """
+    update = {'$inc': {f'activePairs.{forex_pair}': -1, 'dataVersion': 1}}
+    if refund:
+        update['$inc']['balance'] = money.to_bson(refund)
+    return db.users.update_one({'_id': user_id, f'activePairs.{forex_pair}': {'$gt': 0}}, update).modified_count > 0
+
+def calculate_withdrawable_amount(user_id, exclude_transaction_id=None, user=None):
     """Calculate total withdrawable amount (ROI + referral earnings + signup bonus) for a user"""
     try:
-        # Get only active investments and their profits
-        investments = list(db.investments.find({
-            'userId': ObjectId(user_id),
-            'status': 'active'  # Only consider active investments
-        }))
-        total_roi = sum(float(inv.get('profit', 0)) for inv in investments)
+        # Profits of active investments only, summed in the database
+        profits = db.investments.aggregate([
+            {'$match': {'userId': ObjectId(user_id), 'status': 'active'}},
+            {'$group': {'_id': None, 'total': {'$sum': '$profit'}}}
+        ])
+        total_roi = money.to_decimal(next(profits, {'total': 0})['total'])
         
         # Get all referral earnings
         referral_rewards = db.referral_history.aggregate([
@@ -1357,11 +1714,12 @@ def calculate_withdrawable_amount(user_id, exclude_transaction_id=None):
             }}
         ])
         
-        total_referrals = next(referral_rewards, {'total': 0})['total']
+        total_referrals = money.to_decimal(next(referral_rewards, {'total': 0})['total'])
         
         # Get user's signup bonus (if any)
-        user = db.users.find_one({'_id': ObjectId(user_id)})
-        signup_bonus = float(user.get('signupBonus', 0)) if user else 0
+        if user is None:
+            user = find_by_id(db.users, ObjectId(user_id), {'signupBonus': 1})
+        signup_bonus = money.to_decimal(user.get('signupBonus')) if user else money.ZERO
         
         # Build withdrawal query
         withdrawal_query = {
@@ -1388,18 +1746,59 @@ def calculate_withdrawable_amount(user_id, exclude_transaction_id=None):
             }
         ])
         
-        total_withdrawals = next(withdrawals, {'total': 0})['total']
+        total_withdrawals = money.to_decimal(next(withdrawals, {'total': 0})['total'])
         
         # Calculate final withdrawable amount (now including signup bonus)
-        withdrawable = float(total_roi + total_referrals + signup_bonus - total_withdrawals)
-        return max(withdrawable, 0)  # Ensure we don't return negative values
+        withdrawable = total_roi + total_referrals + signup_bonus - total_withdrawals
+        return max(withdrawable, money.ZERO)  # Ensure we don't return negative values
         
     except Exception as e:
+        if isinstance(e, PyMongoError) and e.timeout:
+            # Out of time budget (dashboard bootstrap): fail, don't report 0
+            raise
         print(f"Error calculating withdrawable amount: {str(e)}")
-        return 0.0
+        return money.ZERO
+
+# Per-worker cache of /api/auth/verify payloads, keyed by user id and
+# stored with the dataVersion they were built from
+profile_cache = LRUCache(int(os.getenv('PROFILE_CACHE_SIZE', '10000')))
+
+def load_profile(user_id, version=None):
+    """Profile and wallet summary for /api/auth/verify, or None if the user is gone or being deleted"""
+    # The cached payload is still current if nothing bumped dataVersion since
+    cached = profile_cache.get(user_id)
+    if version is not None and cached and cached[0] == version:
+        print(f"Serving cached profile (dataVersion {version})")
+        return cached[1]
+
+    user = find_by_id(db.users, ObjectId(user_id))
+    print(f"Found user: {user is not None}")
+    if not user or user.get('deletionId'):
+        return None
+
+    # Calculate withdrawable amount
+    withdrawable = calculate_withdrawable_amount(user_id)
+    print(f"Calculated withdrawable amount: {withdrawable}")
+
+    user_response = {
+        '_id': str(user['_id']),
+        'username': user.get('username'),
+        'phone': user.get('phone'),
+        'balance': user.get('balance', 0),
+        'withdrawable': withdrawable,
+        'referralCode': user.get('referralCode'),
+        'isActive': user.get('isActive', True),
+        'isAdmin': user.get('isAdmin', False),
+        'createdAt': user.get('createdAt'),
+        'updatedAt': user.get('updatedAt')
+    }
+    if version is not None:
+        profile_cache.put(user_id, (version, user_response))
+    return user_response
 
 @app.route('/api/auth/verify', methods=['GET'])
 @login_required
+@conditional_get
 def verify():
     try:
         print("\n=== Verify Request ===")
@@ -1414,30 +1813,14 @@ def verify():
             print("No user_id in session")
             return jsonify({'error': 'Unauthorized'}), 401
 
-        user = db.users.find_one({'_id': ObjectId(user_id)})
-        print(f"Found user: {user is not None}")
-
-        if not user:
+        # dataVersion was read by @conditional_get
+        user_response = load_profile(user_id, g.get('data_version'))
+        if not user_response:
             print("User not found in database")
+            # Don't keep a session alive for a deleted (or deleting) account
+            session.clear()
             return jsonify({'error': 'User not found'}), 401
 
-        # Calculate withdrawable amount
-        withdrawable = calculate_withdrawable_amount(user_id)
-        print(f"Calculated withdrawable amount: {withdrawable}")
-
-        user_response = {
-            '_id': str(user['_id']),
-            'username': user.get('username'),
-            'phone': user.get('phone'),
-            'balance': user.get('balance', 0),
-            'withdrawable': withdrawable,
-            'referralCode': user.get('referralCode'),
-            'isActive': user.get('isActive', True),
-            'isAdmin': user.get('isAdmin', False),
-            'createdAt': user.get('createdAt'),
-            'updatedAt': user.get('updatedAt')
-        }
-
         response = jsonify({'user': user_response})
         print("\n=== Verify Response ===")
         print(f"Response Headers: {dict(response.headers)}")
@@ -1449,11 +1832,6 @@ def verify():
         print("Traceback:", traceback.format_exc())
         return jsonify({'error': 'Verification failed'}), 500
 
-@app.route('/api/auth/logout', methods=['OPTIONS'])
-def logout_options():
-    response = app.make_default_options_response()
-    return response
-
 @app.route('/api/auth/logout', methods=['POST'])
 def logout():
     try:
@@ -1466,54 +1844,122 @@ def logout():
         print(f"Logout error: {str(e)}")
         return jsonify({'error': 'Logout failed'}), 500
 
+def _timestamp(value):
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+# fields= whitelists (see fieldsets.py): response field -> (stored fields, formatter)
+PROFILE_FIELDS = Fieldset({
+    '_id': (('_id',), lambda user: str(user['_id'])),
+    'username': (('username',), lambda user: user.get('username')),
+    'phone': (('phone',), lambda user: user.get('phone')),
+    'balance': (('balance',), lambda user: user.get('balance', 0)),
+    'signupBonus': (('signupBonus',), lambda user: user.get('signupBonus', 0)),
+    'referralEarnings': (('referralEarnings',), lambda user: user.get('referralEarnings', 0)),
+    'referralCode': (('referralCode',), lambda user: user.get('referralCode')),
+    'isActive': (('isActive',), lambda user: user.get('isActive', True)),
+    'isAdmin': (('isAdmin',), lambda user: user.get('isAdmin', False)),
+    'createdAt': (('createdAt',), lambda user: user.get('createdAt')),
+    'updatedAt': (('updatedAt',), lambda user: user.get('updatedAt'))
+})
+
+TRANSACTION_FIELDS = Fieldset({
+    '_id': (('_id',), lambda t: str(t['_id'])),
+    'user_id': (('user_id', 'userId'), lambda t: str(t.get('user_id', t.get('userId')))),
+    'type': (('type',), lambda t: t['type']),
+    'amount': (('amount',), lambda t: money.to_number(t['amount'])),
+    'status': (('status',), lambda t: t['status']),
+    'withdrawalType': (('withdrawalType',), lambda t: t.get('withdrawalType')),
+    'createdAt': (('createdAt',), lambda t: _timestamp(t.get('createdAt', ''))),
+    'updatedAt': (('updatedAt',), lambda t: _timestamp(t.get('updatedAt', '')))
+})
+
+# Both field name formats are still around on older investments
+INVESTMENT_FIELDS = Fieldset({
+    'id': (('_id',), lambda inv: str(inv['_id'])),
+    'userId': (('userId', 'user_id'), lambda inv: str(inv.get('userId', inv.get('user_id')))),
+    'forexPair': (('forexPair', 'pair'), lambda inv: inv.get('forexPair', inv.get('pair', ''))),
+    'amount': (('amount',), lambda inv: money.to_number(inv.get('amount'))),
+    'dailyROI': (('dailyROI', 'daily_roi'), lambda inv: float(inv.get('dailyROI', inv.get('daily_roi', 0)))),
+    'entryPrice': (('entryPrice', 'entry_price'), lambda inv: float(inv.get('entryPrice', inv.get('entry_price', 0)))),
+    'currentPrice': (
+        ('currentPrice', 'current_price', 'entryPrice', 'entry_price'),
+        lambda inv: float(inv.get('currentPrice', inv.get('current_price', inv.get('entryPrice', inv.get('entry_price', 0)))))
+    ),
+    'status': (('status',), lambda inv: inv.get('status', 'active')),
+    'profit': (('profit',), lambda inv: money.to_number(inv.get('profit'))),
+    'createdAt': (('createdAt', 'created_at'), lambda inv: _timestamp(inv.get('createdAt', inv.get('created_at', datetime.utcnow()))))
+})
+
+# History entries are unpacked from buckets by history_store; stored names are entry keys
+HISTORY_FIELDS = Fieldset({
+    'date': (('date',), lambda entry: entry['date']),
+    'amount': (('amount',), lambda entry: money.to_number(entry.get('amount'))),
+    'type': (('type',), lambda entry: entry.get('type', '')),
+    'balance': (('balance',), lambda entry: money.to_number(entry.get('balance')))
+})
+
 # User routes
+# The only fields a user may change on their own profile; balances, counters
+# and dataVersion are maintained by the server
+EDITABLE_PROFILE_FIELDS = ('username', 'phone')
+
 @app.route('/api/users/profile', methods=['PUT'])
 @login_required
 def update_profile():
-    data = request.get_json()
+    try:
+        fields = PROFILE_FIELDS.select(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not data:
+        return jsonify({'error': f"Nothing to update (editable: {', '.join(EDITABLE_PROFILE_FIELDS)})"}), 400
+    not_editable = [key for key in data if key not in EDITABLE_PROFILE_FIELDS]
+    if not_editable:
+        return jsonify({'error': f"Fields cannot be updated: {', '.join(not_editable)} "
+                                 f"(editable: {', '.join(EDITABLE_PROFILE_FIELDS)})"}), 400
+    if not all(isinstance(value, str) and value.strip() for value in data.values()):
+        return jsonify({'error': 'Profile fields must be non-empty strings'}), 400
+
     user = db.users.find_one_and_update(
         {'_id': ObjectId(session['user_id'])},
-        {'$set': data},
+        {'$set': data, '$inc': {'dataVersion': 1}},
+        # Never more than the public profile, whatever `fields=` asked for
+        projection=PROFILE_FIELDS.projection(fields),
         return_document=True
     )
     
     if not user:
         return jsonify({'error': 'User not found'}), 404
+
+    # Keep the username/phone copies on transactions and investments in step
+    user_snapshots.fan_out(db, ObjectId(session['user_id']), data)
     
-    user['_id'] = str(user['_id'])
-    session_user = user.copy()
-    del session_user['password']
-    return jsonify({'user': session_user})
+    return jsonify({'user': PROFILE_FIELDS.format(user, fields)})
 
 # Transaction routes
+def load_transactions(user_id, fields=TRANSACTION_FIELDS.all):
+    """The user's transactions, newest first, as returned by GET /api/transactions"""
+    # Get all transactions for the user, handling both field names
+    transactions = db.transactions.find({
+        '$or': [
+            {'user_id': ObjectId(user_id)},
+            {'userId': ObjectId(user_id)}
+        ]
+    }, TRANSACTION_FIELDS.projection(fields)).sort('createdAt', -1)  # Sort by newest first
+
+    return [TRANSACTION_FIELDS.format(transaction, fields) for transaction in transactions]
+
 @app.route('/api/transactions', methods=['GET'])
 @login_required
+@conditional_get
 def get_transactions():
     try:
-        # Get all transactions for the user, handling both field names
-        transactions = list(db.transactions.find({
-            '$or': [
-                {'user_id': ObjectId(session['user_id'])},
-                {'userId': ObjectId(session['user_id'])}
-            ]
-        }).sort('createdAt', -1))  # Sort by newest first
-        
-        # Format transactions for response
-        formatted_transactions = []
-        for transaction in transactions:
-            formatted_transaction = {
-                '_id': str(transaction['_id']),
-                'user_id': str(transaction.get('user_id', transaction.get('userId'))),
-                'type': transaction['type'],
-                'amount': float(transaction['amount']),
-                'status': transaction['status'],
-                'withdrawalType': transaction.get('withdrawalType'),  # Include withdrawalType if present
-                'createdAt': transaction['createdAt'].isoformat() if isinstance(transaction.get('createdAt'), datetime) else str(transaction.get('createdAt', '')),
-                'updatedAt': transaction.get('updatedAt', '').isoformat() if isinstance(transaction.get('updatedAt'), datetime) else str(transaction.get('updatedAt', ''))
-            }
-            formatted_transactions.append(formatted_transaction)
-            
-        return jsonify({'transactions': formatted_transactions})
+        fields = TRANSACTION_FIELDS.select(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        return jsonify({'transactions': load_transactions(session['user_id'], fields)})
     except Exception as e:
         print(f"Error fetching transactions: {str(e)}")
         return jsonify({'error': 'Failed to fetch transactions'}), 500
@@ -1523,22 +1969,34 @@ def get_transactions():
 def initiate_deposit():
     try:
         data = request.get_json()
-        amount = float(data.get('amount', 0))
+        amount = money.to_decimal(data.get('amount', 0))
         
         if not amount or amount <= 0:
             return jsonify({'error': 'Invalid amount'}), 400
         
+        user = find_by_id(db.users, ObjectId(session['user_id']), {'username': 1, 'phone': 1})
+        if not user:
+            return jsonify({'error': 'User not found'}), 404
+
         current_time = datetime.utcnow()
         transaction = {
             'user_id': ObjectId(session['user_id']),
             'type': 'deposit',
-            'amount': amount,
+            'amount': money.to_bson(amount),
             'status': 'pending',
             'createdAt': current_time,
-            'updatedAt': current_time
+            'updatedAt': current_time,
+            **user_snapshots.snapshot(user)
         }
         
         result = db.transactions.insert_one(transaction)
+        bump_data_version(session['user_id'])
+        analytics.record_transaction(db, current_time, 'deposit', 'pending', amount)
+        events.publish(
+            'transaction.created',
+            {'id': result.inserted_id, 'type': 'deposit', 'amount': money.to_bson(amount), **user_snapshots.snapshot(user)},
+            {'pendingTransactions': 1}
+        )
         
         # Format response
         transaction_response = {
@@ -1561,33 +2019,59 @@ def initiate_deposit():
 def initiate_withdrawal():
     try:
         data = request.get_json()
-        amount = float(data.get('amount', 0))
+        amount = money.to_decimal(data.get('amount', 0))
         
         if not amount or amount <= 0:
             return jsonify({'error': 'Invalid amount'}), 400
             
-        # Get user data and calculate withdrawable amount
         user_id = session['user_id']
-        user = db.users.find_one({'_id': ObjectId(user_id)})
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
-            
-        withdrawable = calculate_withdrawable_amount(user_id)
-        if amount > withdrawable:
-            return jsonify({'error': 'Insufficient withdrawable amount'}), 400
-            
-        current_time = datetime.utcnow()
-        transaction = {
-            'user_id': ObjectId(user_id),  # Use consistent field name
-            'type': 'withdrawal',
-            'amount': amount,
-            'status': 'pending',
-            'createdAt': current_time,
-            'updatedAt': current_time,
-            'withdrawalType': 'earnings'  # Indicate this is from earnings
-        }
-        
-        result = db.transactions.insert_one(transaction)
+
+        # Optimistic concurrency on users.withdrawalSeq: the pending withdrawal
+        # is inserted first and only kept if nobody else bumped the sequence
+        # since we read it, so two concurrent requests can't both spend the
+        # same withdrawable amount.
+        for _ in range(3):
+            user = db.users.find_one(
+                {'_id': ObjectId(user_id)},
+                {'signupBonus': 1, 'withdrawalSeq': 1, 'username': 1, 'phone': 1}
+            )
+            if not user:
+                return jsonify({'error': 'User not found'}), 404
+
+            withdrawable = calculate_withdrawable_amount(user_id, user=user)
+            if amount > withdrawable:
+                return jsonify({'error': 'Insufficient withdrawable amount'}), 400
+
+            current_time = datetime.utcnow()
+            transaction = {
+                'user_id': ObjectId(user_id),  # Use consistent field name
+                'type': 'withdrawal',
+                'amount': money.to_bson(amount),
+                'status': 'pending',
+                'createdAt': current_time,
+                'updatedAt': current_time,
+                'withdrawalType': 'earnings',  # Indicate this is from earnings
+                **user_snapshots.snapshot(user)
+            }
+            result = db.transactions.insert_one(transaction)
+
+            seq = user.get('withdrawalSeq')
+            claimed = db.users.update_one(
+                {'_id': ObjectId(user_id), 'withdrawalSeq': seq if seq is not None else {'$exists': False}},
+                {'$inc': {'withdrawalSeq': 1, 'dataVersion': 1}}
+            )
+            if claimed.modified_count:
+                break
+            db.transactions.delete_one({'_id': result.inserted_id})
+        else:
+            return jsonify({'error': 'Too many concurrent withdrawals, please retry'}), 409
+
+        analytics.record_transaction(db, current_time, 'withdrawal', 'pending', amount)
+        events.publish(
+            'transaction.created',
+            {'id': result.inserted_id, 'type': 'withdrawal', 'amount': money.to_bson(amount), **user_snapshots.snapshot(user)},
+            {'pendingTransactions': 1}
+        )
         
         # Format response
         transaction_response = {
@@ -1611,73 +2095,75 @@ def initiate_withdrawal():
 @app.route('/api/transactions/deposit/<transaction_id>/confirm', methods=['POST'])
 @login_required
 def confirm_deposit(transaction_id):
+    user_id = ObjectId(session['user_id'])
+
+    # Claim the deposit: only one confirm can move it out of pending
     transaction = db.transactions.find_one_and_update(
-        {'_id': ObjectId(transaction_id), 'user_id': session['user_id']},
+        {'_id': ObjectId(transaction_id), 'user_id': user_id, 'status': 'pending'},
         {'$set': {'status': 'completed'}},
         return_document=True
     )
     
     if not transaction:
+        if db.transactions.count_documents({'_id': ObjectId(transaction_id), 'user_id': user_id}, limit=1):
+            return jsonify({'error': 'Transaction has already been processed'}), 409
         return jsonify({'error': 'Transaction not found'}), 404
     
-    db.users.update_one(
-        {'_id': ObjectId(session['user_id'])},
-        {'$inc': {'balance': transaction['amount']}}
+    balance_result = db.users.update_one(
+        {'_id': user_id},
+        {'$inc': {'balance': money.to_bson(transaction['amount']), 'dataVersion': 1}}
     )
+    if balance_result.modified_count == 0:
+        db.transactions.update_one(
+            {'_id': transaction['_id'], 'status': 'completed'},
+            {'$set': {'status': 'pending'}}
+        )
+        return jsonify({'error': 'Failed to update user balance'}), 500
+    analytics.record_transaction(db, datetime.utcnow(), 'deposit', 'completed', transaction['amount'])
     
     transaction['_id'] = str(transaction['_id'])
+    transaction['user_id'] = str(transaction['user_id'])
     return jsonify({'transaction': transaction})
 
 # Investment routes
+def load_investments(user_id, fields=INVESTMENT_FIELDS.all):
+    """The user's investments as returned by GET /api/investments"""
+    # Get all investments for the user - try both field names
+    investments = list(db.investments.find({
+        '$or': [
+            {'userId': ObjectId(user_id)},
+            {'user_id': ObjectId(user_id)}
+        ]
+    }, INVESTMENT_FIELDS.projection(fields)))
+    print(f"Raw investments from DB: {investments}")
+    
+    # Format investments for response
+    formatted_investments = []
+    for inv in investments:
+        try:
+            formatted_inv = INVESTMENT_FIELDS.format(inv, fields)
+            formatted_investments.append(formatted_inv)
+            print(f"Formatted investment: {formatted_inv}")
+        except Exception as format_error:
+            print(f"Error formatting investment {inv.get('_id')}: {str(format_error)}")
+            print(f"Raw investment data: {inv}")
+            continue
+    
+    print(f"Successfully formatted {len(formatted_investments)} investments")
+    return formatted_investments
+
 @app.route('/api/investments', methods=['GET'])
 @login_required
+@conditional_get
 def get_investments():
+    try:
+        fields = INVESTMENT_FIELDS.select(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     try:
         user_id = session['user_id']
         print(f"Getting investments for user: {user_id}")
-        
-        # Get all investments for the user - try both field names
-        investments = list(db.investments.find({
-            '$or': [
-                {'userId': ObjectId(user_id)},
-                {'user_id': ObjectId(user_id)}
-            ]
-        }))
-        print(f"Raw investments from DB: {investments}")
-        
-        # Format investments for response
-        formatted_investments = []
-        for inv in investments:
-            try:
-                # Handle both field name formats
-                user_id_field = inv.get('userId', inv.get('user_id'))
-                forex_pair = inv.get('forexPair', inv.get('pair', ''))
-                entry_price = inv.get('entryPrice', inv.get('entry_price', 0))
-                current_price = inv.get('currentPrice', inv.get('current_price', entry_price))
-                daily_roi = inv.get('dailyROI', inv.get('daily_roi', 0))
-                created_at = inv.get('createdAt', inv.get('created_at', datetime.utcnow()))
-                
-                formatted_inv = {
-                    'id': str(inv['_id']),
-                    'userId': str(user_id_field) if user_id_field else str(user_id),
-                    'forexPair': forex_pair,
-                    'amount': float(inv.get('amount', 0)),
-                    'dailyROI': float(daily_roi),
-                    'entryPrice': float(entry_price),
-                    'currentPrice': float(current_price),
-                    'status': inv.get('status', 'active'),
-                    'profit': float(inv.get('profit', 0)),
-                    'createdAt': created_at.isoformat() if isinstance(created_at, datetime) else str(created_at)
-                }
-                formatted_investments.append(formatted_inv)
-                print(f"Formatted investment: {formatted_inv}")
-            except Exception as format_error:
-                print(f"Error formatting investment {inv.get('_id')}: {str(format_error)}")
-                print(f"Raw investment data: {inv}")
-                continue
-        
-        print(f"Successfully formatted {len(formatted_investments)} investments")
-        return jsonify({'investments': formatted_investments})
+        return jsonify({'investments': load_investments(user_id, fields)})
         
     except Exception as e:
         import traceback
@@ -1687,19 +2173,39 @@ def get_investments():
 
 @app.route('/api/investments/earnings', methods=['GET'])
 @login_required
+@conditional_get
 def get_investment_earnings():
     try:
-        # Get all investments for the user
-        investments = list(db.investments.find({'userId': session['user_id']}))
-        
-        # Calculate total earnings
-        total_earnings = sum(float(inv.get('profit', 0)) for inv in investments)
-        active_investments = sum(1 for inv in investments if inv.get('status', '').lower() == 'open')
+        user_id = ObjectId(session['user_id'])
+
+        # Range and granularity for the history chart (default: last 30 days by day)
+        granularity = request.args.get('granularity', 'day')
+        if granularity not in earnings_rollups.GRANULARITIES:
+            return jsonify({'error': f"granularity must be one of {', '.join(earnings_rollups.GRANULARITIES)}"}), 400
+        try:
+            today = datetime.utcnow()
+            end = datetime.fromisoformat(request.args['to']) if request.args.get('to') else today + timedelta(days=1)
+            start = datetime.fromisoformat(request.args['from']) if request.args.get('from') else end - timedelta(days=30)
+        except ValueError:
+            return jsonify({'error': 'from/to must be YYYY-MM-DD dates'}), 400
+        if start >= end or (end - start).days > 366 * 2:
+            return jsonify({'error': 'Invalid date range'}), 400
+
+        # Total earnings and active count, summed in the database
+        totals = next(db.investments.aggregate([
+            {'$match': {'userId': user_id}},
+            {'$group': {
+                '_id': None,
+                'profit': {'$sum': '$profit'},
+                'active': {'$sum': {'$cond': [{'$eq': [{'$toLower': {'$ifNull': ['$status', '']}}, 'active']}, 1, 0]}}
+            }}
+        ]), {'profit': 0, 'active': 0})
         
         earnings_data = {
-            'total_earnings': total_earnings,
-            'active_investments': active_investments,
-            'earnings_history': []  # You can implement historical earnings if needed
+            'total_earnings': money.to_decimal(totals['profit']),
+            'active_investments': totals['active'],
+            'granularity': granularity,
+            'earnings_history': earnings_rollups.get_history(db, user_id, start, end, granularity)
         }
         
         return jsonify(earnings_data)
@@ -1719,109 +2225,89 @@ def create_investment():
         if not all(key in data for key in ['pair', 'amount', 'dailyROI']):
             return jsonify({'error': 'Missing required fields'}), 400
 
-        # Get user data to check balance
-        user = db.users.find_one({'_id': ObjectId(user_id)})
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
-
-        amount = float(data['amount'])
+        amount = money.to_decimal(data['amount'])
         if amount <= 0:
             return jsonify({'error': 'Invalid amount'}), 400
 
-        if amount > user.get('balance', 0):
-            return jsonify({'error': 'Insufficient balance'}), 400
-
         forex_pair = data['pair']
-
-        # Define maximum amounts per forex pair
-        MAX_AMOUNTS = {
-            'EUR/AUD': 50000,
-            'USD/CAD': 50000,
-            'NZD/USD': 200000,
-            'EUR/USD': 20000,
-            'GBP/USD': 20000,
-            'USD/JPY': 20000,
-            'USD/CHF': 20000,
-            'AUD/USD': 20000,
-            'EUR/GBP': 20000,
-        }
+        config = config_store.get(db)
 
         # Validate maximum amount for the forex pair
-        max_amount = MAX_AMOUNTS.get(forex_pair)
+        max_amount = config.max_amounts.get(forex_pair)
         if max_amount is None:
             return jsonify({'error': 'Invalid forex pair'}), 400
         
         if amount > max_amount:
             return jsonify({'error': f'Maximum investment amount for {forex_pair} is {max_amount:,} KES'}), 400
 
-        # Check number of existing investments for this pair
-        existing_investments = db.investments.count_documents({
-            'userId': ObjectId(user_id),
-            'forexPair': forex_pair,
-            'status': 'active'
-        })
-
-        if existing_investments >= 2:
-            return jsonify({'error': f'Maximum of 2 active investments allowed per forex pair. You already have {existing_investments} active investments in {forex_pair}'}), 400
+        # Atomically debit the balance and take one of the pair's 2 slots
+        user, error = reserve_investment(ObjectId(user_id), forex_pair, amount)
+        if error:
+            return error
 
         # Create the investment
         current_time = datetime.utcnow()
         investment = {
             'userId': ObjectId(user_id),
             'forexPair': forex_pair,
-            'amount': amount,
+            'amount': money.to_bson(amount),
             'dailyROI': float(data['dailyROI']),
             'entryPrice': 1.0000,
             'currentPrice': 1.0000,
             'status': 'active',
-            'profit': 0,
-            'createdAt': current_time
+            'profit': money.to_bson(0),
+            'createdAt': current_time,
+            **user_snapshots.snapshot(user)
         }
 
         print(f"Inserting investment: {investment}")
-        result = db.investments.insert_one(investment)
+        try:
+            result = db.investments.insert_one(investment)
+        except Exception:
+            release_investment(ObjectId(user_id), forex_pair, refund=amount)
+            raise
         print(f"Investment created with ID: {result.inserted_id}")
-        
-        # Update user's balance
-        db.users.update_one(
-            {'_id': ObjectId(user_id)},
-            {'$inc': {'balance': -amount}}
-        )
 
-        # Calculate and credit referral rewards
-        if user.get('referredBy'):
-            referrer = db.users.find_one({'_id': user['referredBy']})
-            if referrer:
-                # One-time reward for the specific forex pair
-                one_time_reward = FOREX_REFERRAL_REWARDS.get(forex_pair, 0)
-                
-                # Check if referrer has already received a one-time reward for this referee
-                existing_one_time_reward = db.referral_history.find_one({
-                    'referrerId': referrer['_id'],
-                    'userId': ObjectId(user_id),
-                    'type': 'one_time_reward'
-                })
-                
-                if not existing_one_time_reward and one_time_reward > 0:
-                    # Credit one-time reward to direct referrer's referral earnings
-                    db.users.update_one(
-                        {'_id': referrer['_id']},
-                        {'$inc': {'referralEarnings': one_time_reward}}
-                    )
-                    
-                    # Record the reward in referral history
-                    db.referral_history.insert_one({
-                        'referrerId': referrer['_id'],
+        cashflow = {f'investments.{forex_pair}': (1, amount)}
+
+        # Credit the direct referrer's one-time reward for this referee (at most once)
+        one_time_reward = money.to_decimal(config.forex_rewards.get(forex_pair, 0))
+        if user.get('referredBy') and one_time_reward > 0:
+            try:
+                rewarded = db.referral_history.update_one(
+                    {
+                        'referrerId': user['referredBy'],
                         'userId': ObjectId(user_id),
-                        'type': 'one_time_reward',
-                        'forexPair': forex_pair,
-                        'amount': one_time_reward,
-                        'createdAt': current_time
-                    })
+                        'type': 'one_time_reward'
+                    },
+                    {
+                        '$setOnInsert': {
+                            'forexPair': forex_pair,
+                            'amount': money.to_bson(one_time_reward),
+                            'createdAt': current_time
+                        }
+                    },
+                    upsert=True
+                ).upserted_id is not None
+            except DuplicateKeyError:
+                # A concurrent investment by the same referee inserted it first
+                rewarded = False
+            if rewarded:
+                # Credit one-time reward to direct referrer's referral earnings
+                db.users.update_one(
+                    {'_id': user['referredBy']},
+                    {'$inc': {'referralEarnings': money.to_bson(one_time_reward), 'dataVersion': 1}}
+                )
+                earnings_rollups.add_earning(db, user['referredBy'], current_time, 'oneTimeRewards', one_time_reward)
+                cashflow['commissions.oneTime'] = (1, one_time_reward)
+
+        analytics.record(db, current_time, cashflow)
+        events.publish(
+            'investment.created',
+            {'id': result.inserted_id, 'forexPair': forex_pair, 'amount': investment['amount'], **user_snapshots.snapshot(user)},
+            {'totalInvestments': investment['amount']}
+        )
 
-        # Get updated user balance
-        updated_user = db.users.find_one({'_id': ObjectId(user_id)})
-        
         # Format the investment for response
         investment_response = {
             'id': str(result.inserted_id),
@@ -1834,7 +2320,7 @@ def create_investment():
             'status': investment['status'],
             'profit': investment['profit'],
             'createdAt': current_time.isoformat(),
-            'userBalance': updated_user.get('balance', 0)
+            'userBalance': user.get('balance', 0)
         }
 
         print(f"Returning investment response: {investment_response}")
@@ -1853,42 +2339,56 @@ def create_investment():
 @login_required
 def close_investment(investment_id):
     try:
-        # Find the investment
-        investment = db.investments.find_one({
-            '_id': ObjectId(investment_id),
-            'user_id': session['user_id'],
-            'status': 'open'
-        })
+        user_id = ObjectId(session['user_id'])
+
+        # Claim the investment: only one close can move it out of active
+        investment = db.investments.find_one_and_update(
+            {
+                '_id': ObjectId(investment_id),
+                'userId': user_id,
+                'status': 'active'
+            },
+            {'$set': {'status': 'closed'}}
+        )
         
         if not investment:
-            return jsonify({'error': 'Investment not found or already closed'}), 404
+            if db.investments.count_documents({'_id': ObjectId(investment_id), 'userId': user_id}, limit=1):
+                return jsonify({'error': 'Investment has already been closed'}), 409
+            return jsonify({'error': 'Investment not found'}), 404
         
         # Calculate final profit (in a real app, you'd get the current price from a forex API)
-        current_price = investment['currentPrice']
-        amount = investment['amount']
-        profit = float(investment.get('profit', 0))
+        amount = money.to_decimal(investment['amount'])
+        profit = money.to_decimal(investment.get('profit'))
         
-        # Update investment status
-        db.investments.update_one(
-            {'_id': ObjectId(investment_id)},
-            {
-                '$set': {
-                    'status': 'closed',
-                    'currentPrice': current_price,
-                    'profit': profit
-                }
-            }
-        )
-        
-        # Add profit to user balance
-        db.users.update_one(
-            {'_id': ObjectId(session['user_id'])},
-            {'$inc': {'balance': amount + profit}}
-        )
+        # Give back the pair slot and credit stake + profit in one update
+        if not release_investment(user_id, investment.get('forexPair'), refund=amount + profit):
+            # Users without a slot counter for the pair only get the credit
+            balance_result = db.users.update_one(
+                {'_id': user_id},
+                {'$inc': {'balance': money.to_bson(amount + profit), 'dataVersion': 1}}
+            )
+            if balance_result.modified_count == 0:
+                db.investments.update_one(
+                    {'_id': investment['_id'], 'status': 'closed'},
+                    {'$set': {'status': 'active'}}
+                )
+                return jsonify({'error': 'Failed to update user balance'}), 500
+
+        try:
+            events.publish(
+                'investment.closed',
+                {'id': investment['_id'], 'forexPair': investment.get('forexPair'), 'amount': investment['amount'],
+                 **user_snapshots.snapshot(investment)},
+                {'totalInvestments': money.to_bson(-amount)}
+            )
+        except Exception as e:
+            # The investment is closed and paid out; a missed event must not turn that into a 500
+            print(f"Failed to publish investment.closed for {investment_id}: {str(e)}")
         
         # Get updated investment
         updated_investment = db.investments.find_one({'_id': ObjectId(investment_id)})
         updated_investment['_id'] = str(updated_investment['_id'])
+        updated_investment['userId'] = str(updated_investment['userId'])
         updated_investment['createdAt'] = updated_investment['createdAt'].isoformat() if isinstance(updated_investment['createdAt'], datetime) else updated_investment['createdAt']
         
         return jsonify(updated_investment)
@@ -1896,89 +2396,155 @@ def close_investment(investment_id):
         print(f"Close investment error: {str(e)}")
         return jsonify({'error': 'Failed to close investment'}), 500
 
+def load_investment_history(user_id, fields=HISTORY_FIELDS.all):
+    """The user's investment history (newest first) as returned by GET /api/investments/history"""
+    history = history_store.get_user_history(db, ObjectId(user_id), HISTORY_FIELDS.stored(fields))
+    return [HISTORY_FIELDS.format(entry, fields) for entry in history]
+
 @app.route('/api/investments/history', methods=['GET'])
 @login_required
+@conditional_get
 def get_investment_history():
     try:
-        user_id = session['user_id']
-        
-        # Get investment history for the user
-        history = list(db.investment_history.find(
-            {'userId': ObjectId(user_id)},
-            {'_id': 0}  # Exclude MongoDB _id from results
-        ).sort('createdAt', -1))  # Sort by newest first
-        
-        # Format dates and numbers
-        formatted_history = []
-        for entry in history:
-            formatted_entry = {
-                'date': entry['date'],
-                'amount': float(entry.get('amount', 0)),
-                'type': entry.get('type', ''),
-                'balance': float(entry.get('balance', 0))
-            }
-            formatted_history.append(formatted_entry)
-            
-        return jsonify({'history': formatted_history})
+        fields = HISTORY_FIELDS.select(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        return jsonify({'history': load_investment_history(session['user_id'], fields)})
     except Exception as e:
         print(f"Error fetching investment history: {str(e)}")
         return jsonify({'error': 'Failed to fetch investment history'}), 500
 
 # Referral routes
+def load_referral_stats(user_id):
+    """Downline counts and referral earnings as returned by GET /api/referral/stats"""
+    # Get all users who were referred by the current user
+    level1_referrals = list(db.users.find({'referredBy': ObjectId(user_id)}))
+    level1_count = len(level1_referrals)
+    print(f"Found {level1_count} level 1 referrals")
+    
+    # Get level 2 referrals (users referred by your referrals)
+    level2_count = 0
+    level2_ids = []
+    for ref in level1_referrals:
+        level2_refs = list(db.users.find({'referredBy': ref['_id']}))
+        level2_count += len(level2_refs)
+        level2_ids.extend([ref['_id'] for ref in level2_refs])
+    print(f"Found {level2_count} level 2 referrals")
+    
+    # Get level 3 referrals
+    level3_count = 0
+    for ref_id in level2_ids:
+        level3_refs = list(db.users.find({'referredBy': ref_id}))
+        level3_count += len(level3_refs)
+    print(f"Found {level3_count} level 3 referrals")
+    
+    # Calculate earnings
+    earnings = calculate_referral_earnings(user_id)
+    print(f"Calculated earnings: {earnings}")
+    
+    stats = {
+        'counts': {
+            'level1': level1_count,
+            'level2': level2_count,
+            'level3': level3_count,
+            'total': level1_count + level2_count + level3_count
+        },
+        'earnings': earnings
+    }
+    
+    print(f"Final referral stats: {stats}")
+    return stats
+
 @app.route('/api/referral/stats', methods=['GET'])
 @login_required
+@conditional_get
 def get_referral_stats():
     try:
         user_id = session['user_id']
         print(f"Getting referral stats for user: {user_id}")
-        
-        # Get all users who were referred by the current user
-        level1_referrals = list(db.users.find({'referredBy': ObjectId(user_id)}))
-        level1_count = len(level1_referrals)
-        print(f"Found {level1_count} level 1 referrals")
-        
-        # Get level 2 referrals (users referred by your referrals)
-        level2_count = 0
-        level2_ids = []
-        for ref in level1_referrals:
-            level2_refs = list(db.users.find({'referredBy': ref['_id']}))
-            level2_count += len(level2_refs)
-            level2_ids.extend([ref['_id'] for ref in level2_refs])
-        print(f"Found {level2_count} level 2 referrals")
-        
-        # Get level 3 referrals
-        level3_count = 0
-        for ref_id in level2_ids:
-            level3_refs = list(db.users.find({'referredBy': ref_id}))
-            level3_count += len(level3_refs)
-        print(f"Found {level3_count} level 3 referrals")
-        
-        # Calculate earnings
-        earnings = calculate_referral_earnings(user_id)
-        print(f"Calculated earnings: {earnings}")
-        
-        stats = {
-            'counts': {
-                'level1': level1_count,
-                'level2': level2_count,
-                'level3': level3_count,
-                'total': level1_count + level2_count + level3_count
-            },
-            'earnings': earnings
-        }
-        
-        print(f"Final referral stats: {stats}")
-        return jsonify(stats)
+        return jsonify(load_referral_stats(user_id))
     except Exception as e:
         print(f"Get referral stats error: {str(e)}")
         return jsonify({'error': 'Failed to fetch referral stats'}), 500
 
+# Dashboard bootstrap: the reads the dashboard makes on load, in one request.
+# Sections are named after the keys of the endpoints they replace.
+BOOTSTRAP_SECTIONS = ('user', 'investments', 'transactions', 'history', 'referralStats')
+BOOTSTRAP_SECTION_TIMEOUT = float(os.getenv('BOOTSTRAP_SECTION_TIMEOUT', '5'))
+# Under gunicorn's gevent workers these threads are greenlets, so a section
+# waiting on MongoDB doesn't hold up the others or the worker
+bootstrap_pool = ThreadPoolExecutor(max_workers=int(os.getenv('BOOTSTRAP_POOL_SIZE', '32')),
+                                    thread_name_prefix='bootstrap')
+
+def _within_budget(loader, deadline):
+    """Run a section loader with every MongoDB operation in it limited to the time left.
+
+    pymongo.timeout() sends the remaining budget as maxTimeMS with each query
+    and fails any operation started after the deadline, so a section that
+    overruns stops on the server instead of running on after we gave up on it.
+    """
+    def run():
+        with pymongo.timeout(max(deadline - time.monotonic(), 0.001)):
+            return loader()
+    return run
+
+@app.route('/api/dashboard/bootstrap', methods=['GET'])
+@login_required
+@conditional_get
+def dashboard_bootstrap():
+    user_id = session['user_id']
+    requested = request.args.get('sections')
+    sections = [name.strip() for name in requested.split(',') if name.strip()] if requested else BOOTSTRAP_SECTIONS
+    unknown = set(sections) - set(BOOTSTRAP_SECTIONS)
+    if unknown:
+        return jsonify({'error': f"Unknown sections: {', '.join(sorted(unknown))}"}), 400
+
+    loaders = {
+        'user': partial(load_profile, user_id, g.get('data_version')),
+        'investments': partial(load_investments, user_id),
+        'transactions': partial(load_transactions, user_id),
+        'history': partial(load_investment_history, user_id),
+        'referralStats': partial(load_referral_stats, user_id)
+    }
+    # All sections start together; each gets BOOTSTRAP_SECTION_TIMEOUT from the start
+    deadline = time.monotonic() + BOOTSTRAP_SECTION_TIMEOUT
+    # Each section runs in a copy of this context, so request profiling and
+    # slow-query origins still see its queries
+    futures = {
+        name: bootstrap_pool.submit(contextvars.copy_context().run, _within_budget(loaders[name], deadline))
+        for name in sections
+    }
+    payload, errors = {}, {}
+    for name, future in futures.items():
+        try:
+            payload[name] = future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FuturesTimeout:
+            # Still in Python code; its next query fails on the expired budget
+            print(f"Dashboard bootstrap: {name} timed out for user {user_id}")
+            errors[name] = 'timeout'
+        except PyMongoError as e:
+            print(f"Dashboard bootstrap: {name} {'timed out' if e.timeout else 'failed'} for user {user_id}: {str(e)}")
+            errors[name] = 'timeout' if e.timeout else 'failed'
+        except Exception as e:
+            print(f"Dashboard bootstrap: {name} failed for user {user_id}: {str(e)}")
+            errors[name] = 'failed'
+
+    if 'user' in payload and payload['user'] is None:
+        return jsonify({'error': 'User not found'}), 401
+    if errors:
+        # The client refetches the missing sections with ?sections=; don't let
+        # it revalidate this partial payload as current
+        payload['errors'] = errors
+        g.skip_etag = True
+    return jsonify(payload)
+
 @app.route('/api/referral/history', methods=['GET'])
 @login_required
 def get_referral_history():
     try:
         user_id = session.get('user_id')
-        user = db.users.find_one({'_id': ObjectId(user_id)})
+        user = find_by_id(db.users, ObjectId(user_id))
         if not user:
             return jsonify({'error': 'User not found'}), 404
 
@@ -1989,7 +2555,7 @@ def get_referral_history():
         level1_refs = list(db.users.find({'referredBy': ObjectId(user_id)}))
         for ref in level1_refs:
             # Get one-time rewards for this referral
-            one_time_rewards = sum(reward.get('amount', 0) 
+            one_time_rewards = sum(money.to_decimal(reward.get('amount')) 
                 for reward in db.referral_history.find({
                     'referrerId': ObjectId(user_id),
                     'userId': ref['_id'],
@@ -1997,7 +2563,7 @@ def get_referral_history():
                 }))
             
             # Get daily commissions for this referral
-            daily_commissions = sum(reward.get('amount', 0)
+            daily_commissions = sum(money.to_decimal(reward.get('amount'))
                 for reward in db.referral_history.find({
                     'referrerId': ObjectId(user_id),
                     'referredId': ref['_id'],
@@ -2013,23 +2579,23 @@ def get_referral_history():
                 'referralCount': db.users.count_documents({'referredBy': ref['_id']}),
                 'level': 1,
                 'earnings': {
-                    'oneTimeRewards': float(one_time_rewards),
-                    'dailyCommissions': float(daily_commissions),
-                    'total': float(one_time_rewards + daily_commissions)
+                    'oneTimeRewards': money.to_number(one_time_rewards),
+                    'dailyCommissions': money.to_number(daily_commissions),
+                    'total': money.to_number(one_time_rewards + daily_commissions)
                 }
             })
             
             # Get level 2 referrals
             level2_refs = list(db.users.find({'referredBy': ref['_id']}))
             for l2_ref in level2_refs:
-                l2_one_time = sum(reward.get('amount', 0)
+                l2_one_time = sum(money.to_decimal(reward.get('amount'))
                     for reward in db.referral_history.find({
                         'referrerId': ObjectId(user_id),
                         'referredId': l2_ref['_id'],
                         'type': 'one_time_reward'
                     }))
                 
-                l2_daily = sum(reward.get('amount', 0)
+                l2_daily = sum(money.to_decimal(reward.get('amount'))
                     for reward in db.referral_history.find({
                         'referrerId': ObjectId(user_id),
                         'referredId': l2_ref['_id'],
@@ -2045,23 +2611,23 @@ def get_referral_history():
                     'referralCount': db.users.count_documents({'referredBy': l2_ref['_id']}),
                     'level': 2,
                     'earnings': {
-                        'oneTimeRewards': float(l2_one_time),
-                        'dailyCommissions': float(l2_daily),
-                        'total': float(l2_one_time + l2_daily)
+                        'oneTimeRewards': money.to_number(l2_one_time),
+                        'dailyCommissions': money.to_number(l2_daily),
+                        'total': money.to_number(l2_one_time + l2_daily)
                     }
                 })
                 
                 # Get level 3 referrals
                 level3_refs = list(db.users.find({'referredBy': l2_ref['_id']}))
                 for l3_ref in level3_refs:
-                    l3_one_time = sum(reward.get('amount', 0)
+                    l3_one_time = sum(money.to_decimal(reward.get('amount'))
                         for reward in db.referral_history.find({
                             'referrerId': ObjectId(user_id),
                             'referredId': l3_ref['_id'],
                             'type': 'one_time_reward'
                         }))
                     
-                    l3_daily = sum(reward.get('amount', 0)
+                    l3_daily = sum(money.to_decimal(reward.get('amount'))
                         for reward in db.referral_history.find({
                             'referrerId': ObjectId(user_id),
                             'referredId': l3_ref['_id'],
@@ -2077,9 +2643,9 @@ def get_referral_history():
                         'referralCount': db.users.count_documents({'referredBy': l3_ref['_id']}),
                         'level': 3,
                         'earnings': {
-                            'oneTimeRewards': float(l3_one_time),
-                            'dailyCommissions': float(l3_daily),
-                            'total': float(l3_one_time + l3_daily)
+                            'oneTimeRewards': money.to_number(l3_one_time),
+                            'dailyCommissions': money.to_number(l3_daily),
+                            'total': money.to_number(l3_one_time + l3_daily)
                         }
                     })
 
@@ -2101,7 +2667,7 @@ def change_password():
             return jsonify({'error': 'Current password and new password are required'}), 400
 
         # Get the current user
-        user = db.users.find_one({'_id': ObjectId(session['user_id'])})
+        user = find_by_id(db.users, ObjectId(session['user_id']))
         if not user:
             return jsonify({'error': 'User not found'}), 404
 
@@ -2141,10 +2707,28 @@ def change_password():
         return jsonify({'error': 'Failed to change password'}), 500
 
 @app.route('/health', methods=['GET'])
+@public_route
 def health_check():
+    # Liveness only: never touches MongoDB so a slow database can't get the
+    # process restarted.
     return jsonify({"status": "healthy"}), 200
 
+@app.route('/ready', methods=['GET'])
+@public_route
+def readiness_check():
+    # Readiness: the worker can reach MongoDB and has run its bootstrap
+    try:
+        mongo_connection.ping(timeout_ms=int(os.getenv('READINESS_TIMEOUT_MS', 1000)))
+        return jsonify({"status": "ready"}), 200
+    except Exception as e:
+        print(f"Readiness check failed: {str(e)}")
+        return jsonify({"status": "unavailable", "error": str(e)}), 503
+
+create_app()
+
 if __name__ == '__main__':
     from scheduler import start_scheduler
+    from worker import start_in_background
     scheduler = start_scheduler()
+    start_in_background()
     app.run(host='0.0.0.0', port=5000)
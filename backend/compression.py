@@ -0,0 +1,291 @@
+"""gzip/brotli response compression at the WSGI layer.
+
+The API is served straight from gunicorn on port 5000 (nginx only fronts
+the static frontend), so large JSON payloads such as the admin user list,
+referral history and transaction lists would otherwise leave uncompressed.
+
+- The encoding is negotiated from Accept-Encoding. Brotli is preferred when
+  the optional `brotli` package is installed, gzip otherwise.
+- Only compressible types (JSON, text, JavaScript) are compressed, and only
+  from COMPRESSION_MIN_BYTES up. text/event-stream is always left alone.
+- Responses that already carry a Content-Encoding, or that set
+  Cache-Control: no-transform, are also left alone.
+- Responses with a Content-Length are compressed in one go. Streamed
+  responses without one are compressed chunk by chunk, with a sync flush
+  after each chunk so the client sees data as it is produced.
+- A payload with an ETag, or with Cache-Control: immutable, is the same
+  bytes every time it is served. Its compressed form is kept in a small
+  per-process LRU, so re-serving it costs no compression CPU.
+
+Compression runs on the worker's event loop under gevent, so the levels
+default to cheap settings (gzip 6, brotli 4). See the trade-off with:
+
+    python compression.py --benchmark [--file payload.json]
+"""
+import argparse
+import gzip
+import itertools
+import json
+import os
+import time
+import zlib
+
+from werkzeug.wsgi import ClosingIterator
+
+from cache import LRUCache
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional, gzip only without it
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/', 'application/javascript')
+NEVER_COMPRESS = ('text/event-stream',)
+CACHE_MAX_ENTRY_BYTES = 1024 * 1024
+
+
+def _accepted(header):
+    """{encoding: q} from an Accept-Encoding header"""
+    accepted = {}
+    for part in header.split(','):
+        name, _, params = part.strip().partition(';')
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    return accepted
+
+
+def negotiate(header, brotli_available=None):
+    """'br', 'gzip' or None for an Accept-Encoding header"""
+    if not header:
+        return None
+    accepted = _accepted(header)
+    wildcard = accepted.get('*', 0)
+    available = ('br', 'gzip') if (brotli is not None if brotli_available is None else brotli_available) else ('gzip',)
+    best = max(available, key=lambda name: accepted.get(name, wildcard))
+    return best if accepted.get(best, wildcard) > 0 else None
+
+
+def compress(data, encoding, gzip_level=6, brotli_quality=4):
+    if encoding == 'br':
+        return brotli.compress(data, quality=brotli_quality)
+    return gzip.compress(data, compresslevel=gzip_level)
+
+
+class _StreamCompressor:
+    def __init__(self, encoding, gzip_level, brotli_quality):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._brotli = brotli.Compressor(quality=brotli_quality)
+        else:
+            self._zlib = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)  # 31: gzip container
+
+    def chunk(self, data):
+        if self.encoding == 'br':
+            return self._brotli.process(data) + self._brotli.flush()
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self._brotli.finish()
+        return self._zlib.flush()
+
+
+def _header(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+class CompressionMiddleware:
+    """Compress eligible responses for clients that accept gzip or brotli.
+
+    Relies on the wrapped app calling start_response before its body is
+    iterated, as Flask/Werkzeug do; an app that defers it to the first
+    chunk still works, that chunk is just read before the decision is made.
+    """
+
+    def __init__(self, wsgi_app, min_size=None, gzip_level=None, brotli_quality=None, cache_size=None):
+        self.wsgi_app = wsgi_app
+        self.min_size = min_size if min_size is not None else int(os.getenv('COMPRESSION_MIN_BYTES', '1024'))
+        self.gzip_level = gzip_level if gzip_level is not None else int(os.getenv('COMPRESSION_GZIP_LEVEL', '6'))
+        self.brotli_quality = (brotli_quality if brotli_quality is not None
+                               else int(os.getenv('COMPRESSION_BROTLI_QUALITY', '4')))
+        self.cache = LRUCache(cache_size if cache_size is not None else int(os.getenv('COMPRESSION_CACHE_SIZE', '256')))
+
+    def __call__(self, environ, start_response):
+        encoding = negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.wsgi_app(environ, start_response)
+
+        captured = {}
+        early = []
+
+        def capture(status, headers, exc_info=None):
+            captured.update(status=status, headers=headers, exc_info=exc_info)
+            return early.append
+
+        app_iter = self.wsgi_app(environ, capture)
+        chunks = iter(app_iter)
+        if 'status' not in captured:
+            early.extend(itertools.islice(chunks, 1))
+        body = itertools.chain(early, chunks)
+        status, headers = captured['status'], captured['headers']
+        close = getattr(app_iter, 'close', None)
+
+        if not self._eligible(status, headers):
+            start_response(status, headers, captured['exc_info'])
+            return ClosingIterator(body, close)
+
+        length = _header(headers, 'Content-Length')
+        if length is None:
+            start_response(status, self._compressed_headers(headers, encoding), captured['exc_info'])
+            return ClosingIterator(self._stream(body, encoding), close)
+        if int(length) < self.min_size:
+            start_response(status, headers, captured['exc_info'])
+            return ClosingIterator(body, close)
+
+        cache_key = self._cache_key(environ, headers, encoding)
+        compressed = self.cache.get(cache_key) if cache_key else None
+        if compressed is None:
+            try:
+                data = b''.join(body)
+            finally:
+                if close:
+                    close()
+            compressed = compress(data, encoding, self.gzip_level, self.brotli_quality)
+            if len(compressed) >= len(data):
+                # Already dense (or tiny); send it as it came
+                start_response(status, headers, captured['exc_info'])
+                return [data]
+            if cache_key and len(compressed) <= CACHE_MAX_ENTRY_BYTES:
+                self.cache.put(cache_key, compressed)
+        elif close:
+            close()
+
+        start_response(status, self._compressed_headers(headers, encoding, len(compressed)), captured['exc_info'])
+        return [compressed]
+
+    def _eligible(self, status, headers):
+        if status[:3] in ('204', '206', '304') or _header(headers, 'Content-Encoding'):
+            return False
+        if 'no-transform' in (_header(headers, 'Cache-Control') or ''):
+            return False
+        content_type = (_header(headers, 'Content-Type') or '').lower()
+        if content_type.startswith(NEVER_COMPRESS):
+            return False
+        return content_type.startswith(COMPRESSIBLE_TYPES)
+
+    def _cache_key(self, environ, headers, encoding):
+        etag = _header(headers, 'ETag')
+        if etag is None and 'immutable' not in (_header(headers, 'Cache-Control') or ''):
+            return None
+        return (environ.get('PATH_INFO', ''), environ.get('QUERY_STRING', ''), etag, encoding,
+                self.gzip_level if encoding == 'gzip' else self.brotli_quality)
+
+    def _compressed_headers(self, headers, encoding=None, length=None):
+        updated = []
+        vary = []
+        for key, value in headers:
+            lower = key.lower()
+            if lower == 'content-length':
+                continue
+            if lower == 'vary':
+                # Merge every Vary header (Flask-Session and CORS may each add one)
+                for name in value.split(','):
+                    name = name.strip()
+                    if name and name.lower() not in (v.lower() for v in vary):
+                        vary.append(name)
+                continue
+            if lower == 'etag' and not value.startswith('W/'):
+                # The compressed bytes differ from the identity representation
+                value = f'W/{value}'
+            updated.append((key, value))
+        if 'accept-encoding' not in (v.lower() for v in vary):
+            vary.append('Accept-Encoding')
+        updated.append(('Vary', ', '.join(vary)))
+        if encoding is not None:
+            updated.append(('Content-Encoding', encoding))
+        if length is not None:
+            updated.append(('Content-Length', str(length)))
+        return updated
+
+    def _stream(self, body, encoding):
+        compressor = _StreamCompressor(encoding, self.gzip_level, self.brotli_quality)
+        for data in body:
+            if data:
+                yield compressor.chunk(data)
+        yield compressor.finish()
+
+
+def _sample_payload(users):
+    """Shaped like GET /api/admin/users"""
+    return json.dumps({'users': [
+        {
+            '_id': f'65f0c0ffee{i:014x}',
+            'username': f'user{i}',
+            'phone': f'2547{i % 100000000:08d}',
+            'balance': round(1000 + i * 13.37 % 5000, 2),
+            'withdrawableAmount': round(i * 7.11 % 900, 2),
+            'referralCode': f'{i * 7919 % 2176782336:06X}'[:6],
+            'isActive': i % 7 != 0,
+            'isAdmin': False,
+            'createdAt': f'2025-{1 + i % 12:02d}-{1 + i % 28:02d}T10:{i % 60:02d}:00',
+            'referralCount': i % 11
+        }
+        for i in range(users)
+    ]}).encode('utf-8')
+
+
+def benchmark(data, rounds=5):
+    """Size and compression time per encoding/level, best of `rounds`"""
+    settings = [('gzip', level) for level in (1, 4, 6, 9)]
+    if brotli is not None:
+        settings += [('br', quality) for quality in (1, 4, 6, 11)]
+    results = []
+    for encoding, level in settings:
+        best = None
+        for _ in range(rounds):
+            started = time.perf_counter()
+            out = compress(data, encoding, gzip_level=level, brotli_quality=level)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        results.append({
+            'encoding': encoding,
+            'level': level,
+            'bytes': len(out),
+            'ratio': round(len(data) / len(out), 1),
+            'ms': round(best * 1000, 2),
+            'MBps': round(len(data) / best / 1e6, 1)
+        })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Response compression CPU vs bytes benchmark')
+    parser.add_argument('--benchmark', action='store_true', help='compress a payload at each level and report')
+    parser.add_argument('--file', help='payload to compress (default: a generated admin user list)')
+    parser.add_argument('--users', type=int, default=10000, help='users in the generated payload')
+    args = parser.parse_args()
+
+    if not args.benchmark:
+        parser.print_help()
+    else:
+        if args.file:
+            with open(args.file, 'rb') as f:
+                payload = f.read()
+        else:
+            payload = _sample_payload(args.users)
+        print(f"Payload: {len(payload)} bytes{'' if brotli else ' (brotli not installed, gzip only)'}")
+        for row in benchmark(payload):
+            print(f"{row['encoding']:>4} level {row['level']:>2}: {row['bytes']:>9} bytes "
+                  f"({row['ratio']}x) in {row['ms']} ms ({row['MBps']} MB/s)")
@@ -0,0 +1,163 @@
+"""Platform configuration: commission rates, forex rewards and per-pair limits.
+
+The configuration lives in `commission_rates`; every change inserts a new
+document with the next `version`, so the newest document is the live config
+and older ones are the change history:
+
+    {'version': 3, 'forex_rewards': {'EUR/USD': 100, ...},
+     'daily_commission': {'level1': 0.10, 'level2': 0.05, 'level3': 0.02},
+     'max_amounts': {'EUR/USD': 20000, ...},
+     'created_at': datetime, 'updated_at': datetime, 'updated_by': ObjectId}
+
+Each process keeps an immutable snapshot of it. Callers use get(db); after
+CONFIG_TTL_SECONDS the next call reads only the newest document's version
+(one indexed read) and reloads when it changed, so an update made through
+any worker is picked up everywhere within the TTL without a restart. The
+worker that made the update invalidates its own snapshot immediately.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+from types import MappingProxyType
+
+from pymongo import DESCENDING
+from pymongo.errors import DuplicateKeyError
+
+COLLECTION = 'commission_rates'
+TTL_SECONDS = float(os.getenv('CONFIG_TTL_SECONDS', '30'))
+
+DEFAULTS = {
+    'forex_rewards': {
+        'EUR/USD': 100,
+        'GBP/USD': 300,
+        'USD/JPY': 500,
+        'USD/CHF': 600,
+        'AUD/USD': 700,
+        'EUR/GBP': 1000,
+        'EUR/AUD': 1500,
+        'USD/CAD': 2500,
+        'NZD/USD': 5000
+    },
+    'daily_commission': {
+        'level1': 0.10,  # 10% ROI
+        'level2': 0.05,  # 5% ROI
+        'level3': 0.02   # 2% ROI
+    },
+    'max_amounts': {
+        'EUR/AUD': 50000,
+        'USD/CAD': 50000,
+        'NZD/USD': 200000,
+        'EUR/USD': 20000,
+        'GBP/USD': 20000,
+        'USD/JPY': 20000,
+        'USD/CHF': 20000,
+        'AUD/USD': 20000,
+        'EUR/GBP': 20000
+    }
+}
+SECTIONS = tuple(DEFAULTS)
+
+
+class ConfigConflict(Exception):
+    """Another update was saved since the version the caller started from"""
+
+
+class Snapshot:
+    """Read-only view of one config version"""
+
+    __slots__ = ('version', 'forex_rewards', 'daily_commission', 'max_amounts')
+
+    def __init__(self, document):
+        document = document or {}
+        object.__setattr__(self, 'version', document.get('version', 0))
+        for section in SECTIONS:
+            # Documents written before a section existed fall back to the defaults
+            values = document.get(section) or DEFAULTS[section]
+            object.__setattr__(self, section, MappingProxyType(dict(values)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('config snapshots are read-only')
+
+    def as_dict(self):
+        return {'version': self.version, **{section: dict(getattr(self, section)) for section in SECTIONS}}
+
+
+class ConfigStore:
+    def __init__(self, ttl=TTL_SECONDS):
+        self.ttl = ttl
+        self._snapshot = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _latest(db, projection=None):
+        # By version, not time: created_at comes from the saving worker's clock.
+        # Documents from before versioning sort last, newest of them first.
+        return db[COLLECTION].find_one({}, projection, sort=[('version', DESCENDING), ('created_at', DESCENDING)])
+
+    def get(self, db):
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - self._checked_at < self.ttl:
+            return snapshot
+
+        with self._lock:
+            if self._snapshot is not None and time.monotonic() - self._checked_at < self.ttl:
+                return self._snapshot
+            if self._snapshot is not None:
+                head = self._latest(db, {'version': 1})
+                if head is not None and head.get('version', 0) == self._snapshot.version:
+                    self._checked_at = time.monotonic()
+                    return self._snapshot
+            self._snapshot = Snapshot(self._latest(db))
+            self._checked_at = time.monotonic()
+            return self._snapshot
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+
+    def update(self, db, changes, expected_version=None, updated_by=None):
+        """Save a new version with `changes` merged over the current config.
+
+        Raises ConfigConflict if expected_version is given and is no longer
+        current, or if another worker saved the same version first.
+        """
+        current = Snapshot(self._latest(db))
+        if expected_version is not None and expected_version != current.version:
+            raise ConfigConflict(current.version)
+
+        document = current.as_dict()
+        for section, values in changes.items():
+            document[section].update(values)
+        now = datetime.utcnow()
+        document.update(version=current.version + 1, created_at=now, updated_at=now, updated_by=updated_by)
+
+        try:
+            db[COLLECTION].insert_one(document)
+        except DuplicateKeyError:
+            raise ConfigConflict(current.version + 1)
+        finally:
+            self.invalidate()
+        return Snapshot(document)
+
+
+store = ConfigStore()
+
+
+def get(db):
+    return store.get(db)
+
+
+def ensure_indexes(db):
+    db[COLLECTION].create_index([('created_at', DESCENDING)])
+    db[COLLECTION].create_index(
+        [('version', DESCENDING)], unique=True,
+        partialFilterExpression={'version': {'$exists': True}}
+    )
+
+
+def ensure_defaults(db):
+    if db[COLLECTION].count_documents({}) == 0:
+        now = datetime.utcnow()
+        db[COLLECTION].insert_one({'version': 1, **DEFAULTS, 'created_at': now, 'updated_at': now})
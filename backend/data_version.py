@@ -0,0 +1,195 @@
+"""Per-user data versions for conditional GETs.
+
+Every write that changes what a user sees (balance, transactions,
+investments, history, referral stats) bumps `users.dataVersion`. Read
+endpoints decorated with @conditional_get answer with a weak ETag derived
+from that counter and return 304 before running any of their own queries
+when the client already has the current version.
+
+Reading the version is one indexed _id lookup. With
+DATA_VERSION_CHANGE_STREAM=true (MongoDB replica set only) each worker also
+follows users.dataVersion through a change stream and answers most version
+lookups from memory; while the stream is down it falls back to the read.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from functools import wraps
+from bson.objectid import ObjectId
+from flask import g, request, session, make_response
+from pymongo.errors import PyMongoError
+
+from cache import LRUCache
+from database import db
+from identity_map import find_by_id
+
+logger = logging.getLogger(__name__)
+
+
+def _as_object_id(user_id):
+    return user_id if isinstance(user_id, ObjectId) else ObjectId(str(user_id))
+
+
+def bump_data_version(*user_ids):
+    """Increment dataVersion for the given users in a single round trip"""
+    ids = {_as_object_id(uid) for uid in user_ids if uid}
+    if not ids:
+        return
+    if len(ids) == 1:
+        db.users.update_one({'_id': ids.pop()}, {'$inc': {'dataVersion': 1}})
+    else:
+        db.users.update_many({'_id': {'$in': list(ids)}}, {'$inc': {'dataVersion': 1}})
+
+
+def bump_referral_chain(user_id, levels=3):
+    """Bump a user's upline (their referral stats include this user)"""
+    upline = []
+    current = find_by_id(db.users, _as_object_id(user_id), {'referredBy': 1})
+    while current and current.get('referredBy') and len(upline) < levels:
+        upline.append(current['referredBy'])
+        current = find_by_id(db.users, current['referredBy'], {'referredBy': 1})
+    bump_data_version(*upline)
+
+
+class VersionWatcher:
+    """Per-process map of user id -> dataVersion kept current by a change stream.
+
+    Entries are only trusted while the stream is open. A version read from
+    the database is only remembered if the read started after the current
+    stream was opened, so any later write is guaranteed to arrive as an
+    event; events and reads are merged by keeping the highest version.
+    """
+
+    PIPELINE = [
+        {'$match': {'operationType': {'$in': ['update', 'replace', 'delete']}}},
+        {'$project': {'operationType': 1, 'documentKey': 1, 'updateDescription.updatedFields.dataVersion': 1}}
+    ]
+
+    def __init__(self, max_entries=None):
+        self.versions = LRUCache(max_entries or int(os.getenv('DATA_VERSION_CACHE_SIZE', '50000')))
+        self.generation = 0
+        self.live = False
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def ensure_started(self):
+        # Threads don't survive gunicorn's fork, so each worker starts its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.live = False
+            self.versions.clear()
+            threading.Thread(target=self._run, name='data-version-watcher', daemon=True).start()
+
+    def _run(self):
+        delay = 1
+        while True:
+            try:
+                with db.users.watch(self.PIPELINE) as stream:
+                    with self._lock:
+                        self.generation += 1
+                        self.live = True
+                    logger.info("Following users.dataVersion via change stream")
+                    delay = 1
+                    for change in stream:
+                        self._apply(change)
+            except PyMongoError as e:
+                logger.warning("dataVersion change stream stopped: %s (retrying in %ss)", e, delay)
+            finally:
+                with self._lock:
+                    self.live = False
+                    self.versions.clear()
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    def _apply(self, change):
+        user_id = change['documentKey']['_id']
+        fields = change.get('updateDescription', {}).get('updatedFields', {})
+        if 'dataVersion' in fields:
+            self.remember(user_id, fields['dataVersion'], self.generation)
+        elif change['operationType'] != 'update':
+            self.versions.discard(user_id)
+
+    def lookup(self, user_id):
+        """(cached version or None, token to pass to remember())"""
+        if not self.live:
+            return None, None
+        return self.versions.get(user_id), self.generation
+
+    def remember(self, user_id, version, token):
+        with self._lock:
+            if not self.live or token != self.generation:
+                return
+            current = self.versions.get(user_id)
+            if current is None or version > current:
+                self.versions.put(user_id, version)
+
+
+_watcher = None
+
+
+def get_watcher():
+    """The process's VersionWatcher, or None unless DATA_VERSION_CHANGE_STREAM=true"""
+    global _watcher
+    if _watcher is None and os.getenv('DATA_VERSION_CHANGE_STREAM', 'false').lower() == 'true':
+        _watcher = VersionWatcher()
+    return _watcher
+
+
+def get_data_version(user_id):
+    user_id = _as_object_id(user_id)
+    token = None
+    watcher = get_watcher()
+    if watcher is not None:
+        watcher.ensure_started()
+        version, token = watcher.lookup(user_id)
+        if version is not None:
+            return version
+
+    user = db.users.find_one({'_id': user_id}, {'dataVersion': 1})
+    if not user:
+        return None
+    version = user.get('dataVersion', 0)
+    if token is not None:
+        watcher.remember(user_id, version, token)
+    return version
+
+
+def make_etag(user_id, version):
+    # Path and query string are part of the tag so two endpoints (or two
+    # ranges of the same endpoint) never validate each other's cache entry.
+    scope = hashlib.sha1(request.full_path.encode('utf-8')).hexdigest()[:12]
+    return f'W/"{user_id}-{version}-{scope}"'
+
+
+def conditional_get(f):
+    """Serve 304 Not Modified when the user's data version hasn't changed.
+
+    Must be applied below @login_required so a session user is present.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        user_id = session.get('user_id')
+        version = get_data_version(user_id) if user_id else None
+        if version is None:
+            return f(*args, **kwargs)
+        # Handlers can key their own caches on the version without re-reading it
+        g.data_version = version
+
+        etag = make_etag(user_id, version)
+        if etag in request.headers.get('If-None-Match', ''):
+            response = make_response('', 304)
+        else:
+            response = make_response(f(*args, **kwargs))
+            # Handlers set g.skip_etag for responses that mustn't be revalidated (partial payloads)
+            if response.status_code != 200 or g.get('skip_etag'):
+                return response
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    return decorated_function
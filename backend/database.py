@@ -0,0 +1,204 @@
+import os
+import threading
+import logging
+from pymongo import MongoClient
+
+logger = logging.getLogger('database')
+
+# Per-environment client defaults. Every value can be overridden with the
+# matching MONGO_* environment variable (see .env.example).
+MONGO_ENV_DEFAULTS = {
+    'production': {
+        'maxPoolSize': 50,
+        'minPoolSize': 5,
+        'maxIdleTimeMS': 300000,
+        'serverSelectionTimeoutMS': 5000,
+        'connectTimeoutMS': 5000,
+        'socketTimeoutMS': 30000,
+        'waitQueueTimeoutMS': 5000,
+        'compressors': 'zstd,snappy,zlib',
+    },
+    'development': {
+        'maxPoolSize': 10,
+        'minPoolSize': 0,
+        'maxIdleTimeMS': 60000,
+        'serverSelectionTimeoutMS': 3000,
+        'connectTimeoutMS': 3000,
+        'socketTimeoutMS': 30000,
+        'waitQueueTimeoutMS': 5000,
+        'compressors': '',
+    },
+}
+
+_ENV_OVERRIDES = {
+    'maxPoolSize': ('MONGO_MAX_POOL_SIZE', int),
+    'minPoolSize': ('MONGO_MIN_POOL_SIZE', int),
+    'maxIdleTimeMS': ('MONGO_MAX_IDLE_TIME_MS', int),
+    'serverSelectionTimeoutMS': ('MONGO_SERVER_SELECTION_TIMEOUT_MS', int),
+    'connectTimeoutMS': ('MONGO_CONNECT_TIMEOUT_MS', int),
+    'socketTimeoutMS': ('MONGO_SOCKET_TIMEOUT_MS', int),
+    'waitQueueTimeoutMS': ('MONGO_WAIT_QUEUE_TIMEOUT_MS', int),
+    'compressors': ('MONGO_COMPRESSORS', str),
+}
+
+
+def _available_compressors(requested):
+    """Drop compressors whose optional python packages are not installed"""
+    available = []
+    for name in [c.strip() for c in requested.split(',') if c.strip()]:
+        if name == 'zstd':
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                continue
+        elif name == 'snappy':
+            try:
+                import snappy  # noqa: F401
+            except ImportError:
+                continue
+        available.append(name)
+    return ','.join(available)
+
+
+def mongo_client_options(environment=None):
+    """Build MongoClient keyword arguments for the given environment"""
+    environment = environment or os.getenv('FLASK_ENV', 'development')
+    options = dict(MONGO_ENV_DEFAULTS.get(environment, MONGO_ENV_DEFAULTS['development']))
+
+    for option, (env_key, cast) in _ENV_OVERRIDES.items():
+        value = os.getenv(env_key)
+        if value not in (None, ''):
+            options[option] = cast(value)
+
+    compressors = _available_compressors(options.pop('compressors', ''))
+    if compressors:
+        options['compressors'] = compressors
+
+    # Never block at construction time; the first operation connects.
+    options['connect'] = False
+    options['appname'] = os.getenv('MONGO_APP_NAME', 'pos-backend')
+    return options
+
+
+class MongoConnection:
+    """Lazily created, fork-safe MongoClient holder.
+
+    The client is only built on first use and is rebuilt if the current pid
+    differs from the pid that created it, so a client created in a gunicorn
+    master (preload_app) is never shared across forked workers. Within a
+    worker the single client (and its pool) is shared by every thread or
+    greenlet.
+    """
+
+    def __init__(self, uri=None, db_name=None):
+        self._uri = uri
+        self._db_name = db_name
+        self._client = None
+        self._pid = None
+        self._lock = threading.RLock()
+        self._bootstrap_hooks = []
+        self._bootstrapped = False
+        self._bootstrapping = False
+        self._event_listeners = []
+
+    @property
+    def uri(self):
+        return self._uri or os.getenv('MONGODB_URI', 'mongodb://localhost:27017/pos')
+
+    @property
+    def db_name(self):
+        return self._db_name or os.getenv('MONGODB_DB_NAME', 'pos')
+
+    def on_first_connect(self, hook):
+        """Register a callable(db) to run once per process after the first connection"""
+        self._bootstrap_hooks.append(hook)
+        return hook
+
+    def add_event_listener(self, listener):
+        """Register a pymongo monitoring listener for clients created from now on"""
+        self._event_listeners.append(listener)
+        return listener
+
+    def get_client(self):
+        pid = os.getpid()
+        if self._client is None or self._pid != pid:
+            with self._lock:
+                if self._client is None or self._pid != pid:
+                    if self._client is not None:
+                        # Inherited from the parent process; drop it without
+                        # touching the parent's sockets.
+                        logger.info(f"Discarding MongoClient inherited from pid {self._pid}")
+                    options = mongo_client_options()
+                    if self._event_listeners:
+                        options['event_listeners'] = list(self._event_listeners)
+                    logger.info(f"Creating MongoClient in pid {pid} (maxPoolSize={options.get('maxPoolSize')}, "
+                                f"compressors={options.get('compressors', 'none')})")
+                    self._client = MongoClient(self.uri, **options)
+                    self._pid = pid
+                    self._bootstrapped = False
+        return self._client
+
+    def get_db(self):
+        client = self.get_client()
+        database = client[self.db_name]
+        if not self._bootstrapped:
+            self._run_bootstrap(database)
+        return database
+
+    def _run_bootstrap(self, database):
+        with self._lock:
+            if self._bootstrapped or self._bootstrapping:
+                return
+            self._bootstrapping = True
+            try:
+                for hook in self._bootstrap_hooks:
+                    hook(database)
+                self._bootstrapped = True
+            except Exception as e:
+                # Leave the flag unset so the next call retries
+                logger.error(f"MongoDB bootstrap failed: {str(e)}")
+            finally:
+                self._bootstrapping = False
+
+    def ping(self, timeout_ms=1000):
+        """Readiness check: round trip to the server with a short timeout"""
+        client = self.get_client()
+        client.admin.command('ping', maxTimeMS=timeout_ms)
+        self.get_db()
+        return True
+
+    def reset(self):
+        """Forget the current client (e.g. in a gunicorn post_fork hook)"""
+        with self._lock:
+            self._client = None
+            self._pid = None
+            self._bootstrapped = False
+
+    def close(self):
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+            self._pid = None
+            self._bootstrapped = False
+
+
+class _LazyProxy:
+    """Attribute proxy so module-level `mongo_client` / `db` stay usable as before"""
+
+    def __init__(self, resolve):
+        object.__setattr__(self, '_resolve', resolve)
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __getitem__(self, name):
+        return self._resolve()[name]
+
+    def __repr__(self):
+        return f"<lazy {self._resolve.__name__}>"
+
+
+connection = MongoConnection()
+mongo_client = _LazyProxy(connection.get_client)
+db = _LazyProxy(connection.get_db)
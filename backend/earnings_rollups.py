@@ -0,0 +1,123 @@
+"""Per-user daily earnings rollups.
+
+`user_daily_earnings` holds one document per user per UTC day:
+
+    {'userId': ObjectId, 'day': datetime(2025, 1, 2), 'roi': Decimal128('12.50'),
+     'level1': Decimal128('1.25'), 'level2': Decimal128('0.00'), 'level3': Decimal128('0.00'),
+     'oneTimeRewards': Decimal128('100.00'), 'total': Decimal128('113.75')}
+
+One-time referral rewards are added incrementally when they are credited.
+The nightly job calls rebuild_day() after ROI and commissions have run,
+which recomputes the whole day from the source collections, so re-running
+it is always safe. It bumps the dataVersion of every user it rewrote, so
+cached earnings responses (ETags) are not served stale after a rebuild.
+
+    python earnings_rollups.py --from 2025-01-01 [--to 2025-02-01]   # backfill
+"""
+import argparse
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, UpdateOne
+
+import history_store
+import money
+
+COLLECTION = 'user_daily_earnings'
+FIELDS = ('roi', 'level1', 'level2', 'level3', 'oneTimeRewards')
+GRANULARITIES = ('day', 'week', 'month')
+
+
+def ensure_indexes(db):
+    db[COLLECTION].create_index([('userId', ASCENDING), ('day', ASCENDING)], unique=True)
+
+
+def day_start(moment):
+    return datetime(moment.year, moment.month, moment.day)
+
+
+def add_earning(db, user_id, moment, field, amount):
+    """Increment one rollup field for the day containing `moment`"""
+    db[COLLECTION].update_one(
+        {'userId': user_id, 'day': day_start(moment)},
+        {'$inc': {field: money.to_bson(amount), 'total': money.to_bson(amount)}},
+        upsert=True
+    )
+
+
+def rebuild_day(db, day):
+    """Recompute every user's rollup for one day from the source ledgers"""
+    day = day_start(day)
+    next_day = day + timedelta(days=1)
+    totals = defaultdict(lambda: dict.fromkeys(FIELDS, money.ZERO))
+
+    for entry in history_store.get_entries_for_date(db, day.date().isoformat(), 'roi_earning'):
+        totals[entry['userId']]['roi'] += money.to_decimal(entry.get('amount'))
+
+    commissions = db.referral_history.aggregate([
+        {'$match': {'type': 'daily_commission', 'date': day}},
+        {'$group': {'_id': {'userId': '$referrerId', 'level': '$level'}, 'total': {'$sum': '$amount'}}}
+    ])
+    for row in commissions:
+        totals[row['_id']['userId']][f"level{row['_id']['level']}"] += money.to_decimal(row['total'])
+
+    rewards = db.referral_history.aggregate([
+        {'$match': {'type': 'one_time_reward', 'createdAt': {'$gte': day, '$lt': next_day}}},
+        {'$group': {'_id': '$referrerId', 'total': {'$sum': '$amount'}}}
+    ])
+    for row in rewards:
+        totals[row['_id']]['oneTimeRewards'] += money.to_decimal(row['total'])
+
+    operations = []
+    for user_id, values in totals.items():
+        values['total'] = sum(values[f] for f in FIELDS)
+        values = {field: money.to_bson(amount) for field, amount in values.items()}
+        operations.append(UpdateOne({'userId': user_id, 'day': day}, {'$set': values}, upsert=True))
+    if operations:
+        db[COLLECTION].bulk_write(operations, ordered=False)
+        db.users.update_many({'_id': {'$in': list(totals)}}, {'$inc': {'dataVersion': 1}})
+    return len(operations)
+
+
+def _period_start(day, granularity):
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def get_history(db, user_id, start, end, granularity='day'):
+    """Rollups for [start, end) grouped by day, ISO week (Monday) or month"""
+    periods = {}
+    cursor = db[COLLECTION].find(
+        {'userId': user_id, 'day': {'$gte': day_start(start), '$lt': day_start(end)}},
+        {'_id': 0, 'userId': 0}
+    ).sort('day', ASCENDING)
+    for doc in cursor:
+        period = _period_start(doc['day'], granularity)
+        bucket = periods.setdefault(period, dict.fromkeys(FIELDS + ('total',), money.ZERO))
+        for field in FIELDS + ('total',):
+            bucket[field] += money.to_decimal(doc.get(field))
+
+    return [
+        {'period': period.date().isoformat(), **{k: money.to_number(v) for k, v in values.items()}}
+        for period, values in periods.items()
+    ]
+
+
+if __name__ == '__main__':
+    from database import db
+
+    parser = argparse.ArgumentParser(description='Rebuild daily earnings rollups')
+    parser.add_argument('--from', dest='start', required=True, help='first day, YYYY-MM-DD')
+    parser.add_argument('--to', dest='end', help='day after the last one, YYYY-MM-DD (default: tomorrow)')
+    args = parser.parse_args()
+
+    ensure_indexes(db)
+    current = datetime.fromisoformat(args.start)
+    end = datetime.fromisoformat(args.end) if args.end else day_start(datetime.utcnow()) + timedelta(days=1)
+    while current < end:
+        count = rebuild_day(db, current)
+        print(f"{current.date()}: {count} users")
+        current += timedelta(days=1)
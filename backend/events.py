@@ -0,0 +1,214 @@
+"""Admin event feed: in-process pub/sub fed by a MongoDB capped collection.
+
+Write paths call publish(), which appends one document to the capped
+`admin_events` collection. Every worker that has at least one SSE client
+runs a single tailer thread following that collection with a tailable
+await cursor and hands each new event to its local subscribers, so an
+event published by any worker reaches every connected admin. Capped
+collections and tailable cursors work on a standalone mongod.
+
+Each subscriber gets a bounded queue; a client that stops reading is
+dropped instead of buffering without limit. Event ids are the log's
+ObjectIds, so a reconnecting EventSource sends Last-Event-ID and replay()
+fills the gap from the log. ObjectIds from different workers aren't
+strictly ordered within a second, so both the replay and the tailer read a
+few seconds back in insertion ($natural) order and skip ids already seen.
+
+    {'_id': ObjectId, 'type': 'transaction.created', 'createdAt': datetime,
+     'data': {...}, 'stats': {'pendingTransactions': 1}}
+
+`stats` holds deltas to the /api/admin/stats counters.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from pymongo import CursorType
+from pymongo.errors import PyMongoError
+
+from database import db
+import money
+
+logger = logging.getLogger(__name__)
+
+COLLECTION = 'admin_events'
+LOG_SIZE_BYTES = int(os.getenv('ADMIN_EVENTS_LOG_BYTES', str(16 * 1024 * 1024)))
+QUEUE_SIZE = 256
+HEARTBEAT_SECONDS = 15
+OVERLAP = timedelta(seconds=5)
+
+
+def ensure_collection(db):
+    if COLLECTION not in db.list_collection_names():
+        try:
+            db.create_collection(COLLECTION, capped=True, size=LOG_SIZE_BYTES)
+            # A tailable cursor on an empty capped collection dies at once
+            publish('log.created')
+        except PyMongoError as e:
+            # Another worker created it first
+            logger.info("admin_events not created here: %s", e)
+
+
+def _json_default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if money.is_money(value):
+        return money.to_number(value)
+    raise TypeError(f'Object of type {type(value)} is not JSON serializable')
+
+
+def format_sse(event):
+    payload = {'type': event['type'], 'data': event.get('data', {}), 'stats': event.get('stats', {}),
+               'createdAt': event.get('createdAt')}
+    return f"id: {event['_id']}\nevent: {event['type']}\ndata: {json.dumps(payload, default=_json_default)}\n\n"
+
+
+def publish(event_type, data=None, stats=None):
+    """Append an event to the log; failures never break the write path"""
+    try:
+        db[COLLECTION].insert_one({
+            'type': event_type,
+            'createdAt': datetime.utcnow(),
+            'data': data or {},
+            'stats': stats or {}
+        })
+    except PyMongoError as e:
+        logger.warning("Failed to publish %s event: %s", event_type, e)
+
+
+class EventHub:
+    """Local subscribers of one worker plus the tailer feeding them"""
+
+    def __init__(self, max_subscribers=None):
+        self.max_subscribers = max_subscribers or int(os.getenv('SSE_MAX_CLIENTS', '500'))
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def subscribe(self):
+        """A new bounded queue, or None if this worker is at its client limit"""
+        self._ensure_tailer()
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            subscriber = queue.Queue(maxsize=QUEUE_SIZE)
+            self._subscribers.add(subscriber)
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def _dispatch(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # Slow client: close it, the browser reconnects and replays
+                self.unsubscribe(subscriber)
+                while not subscriber.empty():
+                    subscriber.get_nowait()
+                subscriber.put_nowait(None)
+
+    def _ensure_tailer(self):
+        # Threads don't survive gunicorn's fork; start one per worker on demand
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._subscribers = set()
+            threading.Thread(target=self._tail, name='admin-events-tailer', daemon=True).start()
+
+    def _tail(self):
+        ensure_collection(db)
+        recent = deque(maxlen=QUEUE_SIZE * 4)
+        last = db[COLLECTION].find_one(sort=[('$natural', -1)])
+        since = last['_id'].generation_time.replace(tzinfo=None) if last else datetime.utcnow()
+        # Everything already logged is history, not news for this worker
+        window = {'_id': {'$gte': ObjectId.from_datetime(since - OVERLAP)}}
+        recent.extend(event['_id'] for event in db[COLLECTION].find(window, {'_id': 1}))
+        delay = 1
+        while True:
+            try:
+                cursor = db[COLLECTION].find(
+                    {'_id': {'$gte': ObjectId.from_datetime(since - OVERLAP)}},
+                    cursor_type=CursorType.TAILABLE_AWAIT,
+                    max_await_time_ms=HEARTBEAT_SECONDS * 1000
+                )
+                delay = 1
+                while cursor.alive:
+                    for event in cursor:
+                        if event['_id'] in recent:
+                            continue
+                        recent.append(event['_id'])
+                        since = max(since, event['createdAt'])
+                        self._dispatch(event)
+            except PyMongoError as e:
+                logger.warning("admin_events tailer stopped: %s (retrying in %ss)", e, delay)
+                delay = min(delay * 2, 30)
+            time.sleep(delay)
+
+
+hub = EventHub()
+
+
+def replay(since_id, limit=QUEUE_SIZE):
+    """Events logged after since_id that are still in the log, oldest first"""
+    try:
+        since_id = ObjectId(since_id)
+    except Exception:
+        return []
+    window = ObjectId.from_datetime(since_id.generation_time - OVERLAP)
+    cursor = db[COLLECTION].find({'_id': {'$gte': window}}).sort('$natural', 1)
+    events, found = [], False
+    for event in cursor:
+        if found:
+            events.append(event)
+        elif event['_id'] == since_id:
+            found = True
+            events = []
+        else:
+            # Until since_id turns up we don't know what the client saw;
+            # keep only what is newer than its id
+            if event['_id'] > since_id:
+                events.append(event)
+    return events[-limit:]
+
+
+def stream(subscriber, last_event_id=None):
+    """SSE body for one client: replay, then live events with heartbeats"""
+    try:
+        yield "retry: 3000\n\n"
+        seen = set()
+        if last_event_id:
+            for event in replay(last_event_id):
+                seen.add(event['_id'])
+                yield format_sse(event)
+        while True:
+            try:
+                event = subscriber.get(timeout=HEARTBEAT_SECONDS)
+            except queue.Empty:
+                yield ": ping\n\n"
+                continue
+            if event is None:
+                return
+            if event['_id'] in seen:
+                continue
+            yield format_sse(event)
+    finally:
+        hub.unsubscribe(subscriber)
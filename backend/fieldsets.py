@@ -0,0 +1,46 @@
+"""Sparse fieldsets: `?fields=amount,status` on read endpoints.
+
+An endpoint declares a Fieldset listing the response fields a client may
+ask for, the stored fields each one is built from and how to format it.
+select() checks the `fields=` value against that whitelist, projection()
+turns the selection into a MongoDB projection and format() builds only the
+selected response fields, so both the transfer from the database and the
+serialization shrink with what the client asked for. Without `fields=` an
+endpoint returns its full shape, as before.
+"""
+
+
+class Fieldset:
+    def __init__(self, fields):
+        """fields: {response field: (stored fields it reads, formatter(doc))}, in response order"""
+        self.fields = fields
+        self.all = tuple(fields)
+
+    def select(self, value):
+        """Response fields named in a `fields=` value, all of them if it's empty.
+        Raises ValueError for names outside the whitelist."""
+        if not value:
+            return self.all
+        selected = tuple(dict.fromkeys(name.strip() for name in value.split(',') if name.strip()))
+        unknown = [name for name in selected if name not in self.fields]
+        if unknown or not selected:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)} (allowed: {', '.join(self.all)})")
+        return selected
+
+    def stored(self, selected, always=()):
+        """Stored fields needed to build the selected response fields"""
+        needed = set(always)
+        for name in selected:
+            needed.update(self.fields[name][0])
+        return needed
+
+    def projection(self, selected, always=()):
+        """find() projection for the selection; `always` adds fields the caller needs itself"""
+        needed = self.stored(selected, always)
+        projection = {field: 1 for field in needed}
+        if '_id' not in needed:
+            projection['_id'] = 0
+        return projection
+
+    def format(self, doc, selected):
+        return {name: self.fields[name][1](doc) for name in selected}
@@ -1,4 +1,54 @@
-bind = "0.0.0.0:5000"
-workers = 4
-worker_class = "gevent"
-timeout = 120
+import multiprocessing
+import os
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+
+# Patch the stdlib before anything else is imported. With preload_app the
+# application (pymongo, ssl, threading, ...) is imported in the master, so
+# patching has to happen here rather than in the gevent worker's init, or the
+# workers end up with unpatched sockets and locks.
+if worker_class == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+cpu_count = multiprocessing.cpu_count()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# Two workers per core (+1), capped at GUNICORN_MAX_WORKERS (default 8): each
+# gevent worker multiplexes many connections, so more processes mostly add
+# memory and MongoDB pools. WEB_CONCURRENCY (set by Render/Heroku) wins if present.
+workers = int(os.getenv('WEB_CONCURRENCY', min(cpu_count * 2 + 1, int(os.getenv('GUNICORN_MAX_WORKERS', 8)))))
+
+# Concurrent greenlets per worker. Keep this in line with MONGO_MAX_POOL_SIZE:
+# greenlets beyond the pool size queue for a connection (waitQueueTimeoutMS).
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+backlog = int(os.getenv('GUNICORN_BACKLOG', 2048))
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+
+# Recycle workers periodically to bound memory growth
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+
+# Load the app once in the master so workers share its memory copy-on-write.
+# This is safe because nothing in app import touches MongoDB (see database.py).
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-') or None
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+
+
+def post_fork(server, worker):
+    # Make sure no MongoClient created in the master survives into a worker
+    from database import connection
+    connection.reset()
+    server.log.info(f"Worker {worker.pid} ready ({worker_class}, {worker_connections} connections)")
+
+
+def worker_exit(server, worker):
+    from database import connection
+    connection.close()
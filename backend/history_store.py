@@ -0,0 +1,105 @@
+"""Bucketed storage for investment history.
+
+Instead of one `investment_history` document per investment per day, each
+investment gets one document per calendar month in
+`investment_history_buckets`, holding parallel arrays:
+
+    {
+        'investmentId': ObjectId, 'userId': ObjectId, 'month': '2025-01',
+        'count': 21,
+        'dates': ['2025-01-02', ...], 'types': ['roi_earning', ...],
+        'amounts': [...], 'balances': [...], 'createdAt': [...]
+    }
+
+Buckets filled by migrate_investment_history.py also carry the
+`migrationBatches` that went into them. The functions here are the only
+place that knows about that layout; callers keep working with flat history
+entries.
+"""
+from pymongo import ASCENDING, DESCENDING
+
+import money
+
+BUCKETS = 'investment_history_buckets'
+LEGACY = 'investment_history'
+MIGRATION_ID = 'investment_history_buckets'
+
+# Cached per process once the migration marker is seen
+_legacy_migrated = False
+
+
+def ensure_indexes(db):
+    db[BUCKETS].create_index([('investmentId', ASCENDING), ('month', ASCENDING)], unique=True)
+    db[BUCKETS].create_index([('userId', ASCENDING), ('month', DESCENDING)])
+    db[BUCKETS].create_index([('month', ASCENDING), ('dates', ASCENDING)])
+
+
+def record_entry(db, investment_id, user_id, entry_type, amount, date, created_at, balance):
+    """Append one history entry to its investment's monthly bucket (one upsert)"""
+    db[BUCKETS].update_one(
+        {'investmentId': investment_id, 'month': date[:7]},
+        {
+            '$setOnInsert': {'userId': user_id},
+            '$push': {
+                'dates': date,
+                'types': entry_type,
+                'amounts': money.to_bson(amount),
+                'balances': money.to_bson(balance),
+                'createdAt': created_at
+            },
+            '$inc': {'count': 1}
+        },
+        upsert=True
+    )
+
+
+# Entry key -> bucket array it is unpacked from
+ARRAYS = {'date': 'dates', 'type': 'types', 'amount': 'amounts', 'balance': 'balances', 'createdAt': 'createdAt'}
+
+
+def _unpack(bucket, fields=None):
+    """Flat entries from a bucket; with fields, only those entry keys (their arrays are all it needs)"""
+    keys = [key for key in ARRAYS if fields is None or key in fields]
+    common = {key: bucket[key] for key in ('investmentId', 'userId')
+              if key in bucket and (fields is None or key in fields)}
+    for values in zip(*(bucket[ARRAYS[key]] for key in keys)):
+        yield {**common, **dict(zip(keys, values))}
+
+
+def _legacy_pending(db):
+    """True until migrate_investment_history.py has moved the legacy rows"""
+    global _legacy_migrated
+    if not _legacy_migrated:
+        _legacy_migrated = db.schema_migrations.find_one({'_id': MIGRATION_ID, 'completed': True}) is not None
+    return not _legacy_migrated
+
+
+def get_user_history(db, user_id, fields=None):
+    """All history entries for a user, newest first; with fields, entries only carry those
+    keys (plus createdAt, for the ordering) and only the matching arrays are read"""
+    bucket_projection = {'_id': 0, 'migrationBatches': 0}
+    legacy_projection = {'_id': 0}
+    if fields is not None:
+        bucket_projection = {'_id': 0}
+        fields = set(fields) | {'createdAt'}
+        bucket_projection.update({ARRAYS[key]: 1 for key in fields if key in ARRAYS})
+        bucket_projection.update({key: 1 for key in ('investmentId', 'userId') if key in fields})
+        legacy_projection.update({key: 1 for key in fields})
+
+    entries = []
+    for bucket in db[BUCKETS].find({'userId': user_id}, bucket_projection):
+        entries.extend(_unpack(bucket, fields))
+    if _legacy_pending(db):
+        entries.extend(db[LEGACY].find({'userId': user_id, 'migrated': {'$ne': True}}, legacy_projection))
+    entries.sort(key=lambda e: e['createdAt'], reverse=True)
+    return entries
+
+
+def get_entries_for_date(db, date, entry_type):
+    """All entries of one type recorded on a given ISO date, across users"""
+    entries = []
+    for bucket in db[BUCKETS].find({'month': date[:7], 'dates': date}, {'_id': 0, 'migrationBatches': 0}):
+        entries.extend(e for e in _unpack(bucket) if e['date'] == date and e['type'] == entry_type)
+    if _legacy_pending(db):
+        entries.extend(db[LEGACY].find({'type': entry_type, 'date': date, 'migrated': {'$ne': True}}))
+    return entries
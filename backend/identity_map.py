@@ -0,0 +1,106 @@
+"""Request-scoped identity map for documents looked up by _id.
+
+find_by_id() remembers every document it loads on flask.g for the rest of
+the request, so the admin check, the handler and the helpers it calls share
+one read of the same user. A cached full document also answers later
+projected lookups; a cached projection only answers lookups for a subset of
+its fields.
+
+Entries are dropped as soon as the request writes to the collection: the
+command listener registered on the MongoClient sees every insert, update,
+delete and findAndModify the current thread sends. Outside a request (the
+scheduler, CLI scripts) find_by_id is a plain find_one.
+"""
+import copy
+
+from flask import g, has_app_context
+from pymongo import monitoring
+
+WRITE_COMMANDS = frozenset(('insert', 'update', 'delete', 'findAndModify'))
+_MISSING = object()
+
+
+def _entries():
+    if not has_app_context():
+        return None
+    entries = g.get('_identity_map')
+    if entries is None:
+        entries = g._identity_map = {}
+    return entries
+
+
+def _fields(projection):
+    """Fields covered by an inclusion projection, None for the whole document,
+    or _MISSING for projections the map doesn't handle (exclusions, dotted
+    paths, operators)"""
+    if projection is None:
+        return None
+    if isinstance(projection, dict):
+        keys = [key for key, include in projection.items() if key != '_id']
+        if projection.get('_id', 1) == 0 or not all(projection[key] == 1 for key in keys):
+            return _MISSING
+    else:
+        keys = [key for key in projection if key != '_id']
+    if any('.' in key or key.startswith('$') for key in keys):
+        return _MISSING
+    return frozenset(keys) | {'_id'}
+
+
+def _project(document, fields):
+    if fields is None:
+        return copy.deepcopy(document)
+    return {key: copy.deepcopy(document[key]) for key in fields if key in document}
+
+
+def find_by_id(collection, _id, projection=None):
+    """collection.find_one({'_id': _id}, projection), at most once per request"""
+    entries = _entries()
+    fields = _fields(projection)
+    if entries is None or fields is _MISSING:
+        return collection.find_one({'_id': _id}, projection)
+
+    key = (collection.full_name, _id)
+    cached = entries.get(key)
+    if cached is not None:
+        cached_fields, document = cached
+        if document is None:
+            return None
+        if cached_fields is None or (fields is not None and fields <= cached_fields):
+            return _project(document, fields)
+
+    document = collection.find_one({'_id': _id}, projection)
+    if document is None:
+        entries[key] = (None, None)
+        return None
+    if fields is not None and cached is not None and cached[1] is not None:
+        # Widen the cached projection instead of replacing it
+        entries[key] = (cached[0] | fields, {**cached[1], **document})
+    else:
+        entries[key] = (fields, document)
+    return copy.deepcopy(document)
+
+
+def invalidate(full_name=None):
+    """Forget cached documents of one collection ('db.collection'), or all of them"""
+    entries = _entries()
+    if not entries:
+        return
+    if full_name is None:
+        entries.clear()
+        return
+    for key in [key for key in entries if key[0] == full_name]:
+        del entries[key]
+
+
+class WriteListener(monitoring.CommandListener):
+    """Drops identity map entries for collections the current request writes to"""
+
+    def started(self, event):
+        if event.command_name in WRITE_COMMANDS:
+            invalidate(f"{event.database_name}.{event.command[event.command_name]}")
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
@@ -0,0 +1,262 @@
+"""Durable background jobs stored in MongoDB.
+
+enqueue() inserts a job document; worker processes (python worker.py) claim
+jobs one at a time with find_one_and_update, so two consumers never get the
+same job. A claimed job is leased for VISIBILITY_TIMEOUT; while its handler
+runs, the consumer keeps extending the lease. If the worker dies the lease
+runs out and the job becomes claimable again, counting as a failed attempt.
+
+    {'type': 'user.delete', 'payload': {...}, 'priority': 0,
+     'status': 'queued' | 'running' | 'done' | 'failed',
+     'attempts': 1, 'maxAttempts': 5, 'runAt': datetime,
+     'lockedBy': 'host:pid:2', 'lockedUntil': datetime, 'lastError': str,
+     'dedupeKey': str, 'active': True, 'createdAt', 'startedAt', 'finishedAt'}
+
+Higher priority runs first, then the earliest runAt. Failed attempts are
+retried after an exponential backoff until maxAttempts is used up. Handlers
+should be idempotent; work that must never run twice belongs in a job with
+max_attempts=1, which is marked failed instead of being re-run.
+
+Handlers register with @jobs.handler('type') and receive (db, payload, job).
+"""
+import logging
+import os
+import random
+import socket
+import threading
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import slow_queries
+
+logger = logging.getLogger(__name__)
+
+COLLECTION = 'jobs'
+VISIBILITY_TIMEOUT = timedelta(seconds=int(os.getenv('JOB_VISIBILITY_TIMEOUT', '300')))
+BACKOFF_BASE_SECONDS = 10
+BACKOFF_MAX_SECONDS = 3600
+RETENTION = timedelta(days=7)
+
+HANDLERS = {}
+
+
+def handler(job_type):
+    """Register the function that runs jobs of job_type"""
+    def register(func):
+        HANDLERS[job_type] = func
+        return func
+    return register
+
+
+def ensure_indexes(db):
+    db[COLLECTION].create_index([('status', ASCENDING), ('priority', DESCENDING), ('runAt', ASCENDING)])
+    db[COLLECTION].create_index([('status', ASCENDING), ('lockedUntil', ASCENDING)])
+    # One unfinished job per dedupe key
+    db[COLLECTION].create_index(
+        [('dedupeKey', ASCENDING)], unique=True,
+        partialFilterExpression={'active': True, 'dedupeKey': {'$exists': True}}
+    )
+    # Finished jobs are kept for a week for the admin view
+    db[COLLECTION].create_index(
+        [('finishedAt', ASCENDING)], expireAfterSeconds=int(RETENTION.total_seconds()),
+        partialFilterExpression={'status': 'done'}
+    )
+
+
+def enqueue(db, job_type, payload=None, priority=0, run_at=None, max_attempts=5, dedupe_key=None):
+    """Queue a job; with dedupe_key, returns the unfinished job already queued for it"""
+    now = datetime.utcnow()
+    job = {
+        'type': job_type,
+        'payload': payload or {},
+        'priority': priority,
+        'status': 'queued',
+        'active': True,
+        'attempts': 0,
+        'maxAttempts': max_attempts,
+        'runAt': run_at or now,
+        'createdAt': now
+    }
+    if dedupe_key:
+        job['dedupeKey'] = dedupe_key
+    try:
+        job['_id'] = db[COLLECTION].insert_one(job).inserted_id
+    except DuplicateKeyError:
+        return db[COLLECTION].find_one({'dedupeKey': dedupe_key, 'active': True})
+    return job
+
+
+def _backoff(attempts):
+    delay = min(BACKOFF_BASE_SECONDS * 2 ** (attempts - 1), BACKOFF_MAX_SECONDS)
+    return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+def reap(db):
+    """Take jobs back from consumers that stopped renewing their lease"""
+    now = datetime.utcnow()
+    expired = {'status': 'running', 'lockedUntil': {'$lt': now}}
+    failed = db[COLLECTION].update_many(
+        {**expired, '$expr': {'$gte': ['$attempts', '$maxAttempts']}},
+        {'$set': {'status': 'failed', 'lastError': 'lease expired', 'finishedAt': now},
+         '$unset': {'active': '', 'lockedBy': '', 'lockedUntil': ''}}
+    ).modified_count
+    requeued = db[COLLECTION].update_many(
+        expired,
+        {'$set': {'status': 'queued', 'runAt': now, 'lastError': 'lease expired'},
+         '$unset': {'lockedBy': '', 'lockedUntil': ''}}
+    ).modified_count
+    if failed or requeued:
+        logger.warning(f"Expired leases: {requeued} jobs requeued, {failed} out of attempts")
+    return requeued + failed
+
+
+def claim(db, worker_id, types=None):
+    """Lease the most urgent due job to worker_id, or None"""
+    now = datetime.utcnow()
+    query = {'status': 'queued', 'runAt': {'$lte': now}}
+    if types:
+        query['type'] = {'$in': list(types)}
+    return db[COLLECTION].find_one_and_update(
+        query,
+        {
+            '$set': {'status': 'running', 'lockedBy': worker_id, 'lockedUntil': now + VISIBILITY_TIMEOUT},
+            '$min': {'startedAt': now},
+            '$inc': {'attempts': 1}
+        },
+        sort=[('priority', DESCENDING), ('runAt', ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def extend(db, job):
+    """Renew the lease; False if the job was taken away from this consumer"""
+    result = db[COLLECTION].update_one(
+        {'_id': job['_id'], 'status': 'running', 'lockedBy': job['lockedBy']},
+        {'$set': {'lockedUntil': datetime.utcnow() + VISIBILITY_TIMEOUT}}
+    )
+    return result.matched_count == 1
+
+
+def _finish(db, job, status, error=None, result=None):
+    update = {'$set': {'status': status, 'finishedAt': datetime.utcnow()},
+              '$unset': {'active': '', 'lockedBy': '', 'lockedUntil': ''}}
+    if error is not None:
+        update['$set']['lastError'] = error
+    if result is not None:
+        update['$set']['result'] = result
+    query = {'_id': job['_id']}
+    if job.get('lockedBy'):
+        query['lockedBy'] = job['lockedBy']
+    db[COLLECTION].update_one(query, update)
+
+
+def complete(db, job, result=None):
+    _finish(db, job, 'done', result=result)
+
+
+def fail(db, job, error):
+    """Schedule a retry with backoff, or mark the job failed once attempts run out"""
+    if job['attempts'] >= job['maxAttempts']:
+        logger.error(f"Job {job['_id']} ({job['type']}) failed for good: {error}")
+        _finish(db, job, 'failed', error=error)
+        return
+    retry_at = datetime.utcnow() + _backoff(job['attempts'])
+    logger.warning(f"Job {job['_id']} ({job['type']}) attempt {job['attempts']} failed, retrying at {retry_at}: {error}")
+    db[COLLECTION].update_one(
+        {'_id': job['_id'], 'lockedBy': job['lockedBy']},
+        {'$set': {'status': 'queued', 'runAt': retry_at, 'lastError': error},
+         '$unset': {'lockedBy': '', 'lockedUntil': ''}}
+    )
+
+
+def retry(db, job_id):
+    """Put a failed job back in the queue with a fresh set of attempts"""
+    return db[COLLECTION].find_one_and_update(
+        {'_id': ObjectId(job_id), 'status': 'failed'},
+        {'$set': {'status': 'queued', 'active': True, 'attempts': 0, 'runAt': datetime.utcnow()},
+         '$unset': {'finishedAt': ''}},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def execute(db, job):
+    """Run one claimed job, renewing its lease until the handler returns"""
+    func = HANDLERS.get(job['type'])
+    if func is None:
+        fail(db, job, f"no handler for {job['type']}")
+        return False
+
+    done = threading.Event()
+
+    def keep_leased():
+        while not done.wait(VISIBILITY_TIMEOUT.total_seconds() / 3):
+            if not extend(db, job):
+                logger.warning(f"Job {job['_id']} lease lost while running")
+                return
+
+    renewer = threading.Thread(target=keep_leased, name=f"lease-{job['_id']}", daemon=True)
+    renewer.start()
+    try:
+        with slow_queries.origin(f"job:{job['type']}"):
+            result = func(db, job.get('payload', {}), job)
+    except Exception as e:
+        fail(db, job, f"{type(e).__name__}: {e}")
+        return False
+    finally:
+        done.set()
+        renewer.join()
+    complete(db, job, result)
+    return True
+
+
+def worker_id(slot):
+    return f"{socket.gethostname()}:{os.getpid()}:{slot}"
+
+
+def serialize(job):
+    return {
+        'id': str(job['_id']),
+        'type': job['type'],
+        'status': job['status'],
+        'priority': job.get('priority', 0),
+        'attempts': job.get('attempts', 0),
+        'maxAttempts': job.get('maxAttempts'),
+        'payload': {key: str(value) if isinstance(value, ObjectId) else value
+                    for key, value in job.get('payload', {}).items()},
+        'lockedBy': job.get('lockedBy'),
+        'lastError': job.get('lastError'),
+        'runAt': job.get('runAt'),
+        'createdAt': job.get('createdAt'),
+        'startedAt': job.get('startedAt'),
+        'finishedAt': job.get('finishedAt')
+    }
+
+
+def get_job(db, job_id):
+    job = db[COLLECTION].find_one({'_id': ObjectId(job_id)})
+    return serialize(job) if job else None
+
+
+def stats(db, recent=20):
+    """Queue depth per type and status, the oldest due job's wait and recent failures"""
+    now = datetime.utcnow()
+    counts = {}
+    for row in db[COLLECTION].aggregate([
+        {'$group': {'_id': {'type': '$type', 'status': '$status'}, 'count': {'$sum': 1}}}
+    ]):
+        counts.setdefault(row['_id']['type'], {})[row['_id']['status']] = row['count']
+
+    oldest = db[COLLECTION].find_one(
+        {'status': 'queued', 'runAt': {'$lte': now}}, {'runAt': 1}, sort=[('runAt', ASCENDING)]
+    )
+    running = db[COLLECTION].find({'status': 'running'}).sort('startedAt', ASCENDING).limit(recent)
+    failed = db[COLLECTION].find({'status': 'failed'}).sort('finishedAt', DESCENDING).limit(recent)
+    return {
+        'counts': counts,
+        'oldestQueuedSeconds': round((now - oldest['runAt']).total_seconds(), 1) if oldest else 0,
+        'running': [serialize(job) for job in running],
+        'recentFailures': [serialize(job) for job in failed]
+    }
@@ -0,0 +1,105 @@
+from flask.sessions import SessionInterface
+
+
+def public_route(f):
+    """Mark a view as public: no session is loaded or saved for it.
+
+    Apply below @app.route so the registered view carries the flag.
+    """
+    f.public_route = True
+    return f
+
+
+def build_cors_headers(allowed_origins, methods, headers, max_age):
+    """Precompute the CORS response headers for every allowed origin"""
+    shared = [
+        ('Access-Control-Allow-Headers', ', '.join(headers)),
+        ('Access-Control-Allow-Methods', ', '.join(methods)),
+        ('Access-Control-Allow-Credentials', 'true'),
+        ('Access-Control-Max-Age', str(max_age)),
+        ('Vary', 'Origin'),
+    ]
+    return {
+        origin: [('Access-Control-Allow-Origin', origin)] + shared
+        for origin in allowed_origins if origin
+    }
+
+
+class PreflightMiddleware:
+    """Answer CORS preflights for /api/* before Flask sees them.
+
+    Preflights never reach the session backend, the URL map or any
+    after_request handler; the response headers are built once per origin.
+    Preflights from unknown origins get an empty 200 without CORS headers,
+    which the browser treats as a refusal (same as before).
+    """
+
+    def __init__(self, wsgi_app, cors_headers, prefix='/api/'):
+        self.wsgi_app = wsgi_app
+        self.prefix = prefix
+        self._responses = {
+            origin: headers + [('Content-Length', '0')]
+            for origin, headers in cors_headers.items()
+        }
+        self._refused = [('Content-Length', '0'), ('Vary', 'Origin')]
+
+    def __call__(self, environ, start_response):
+        if (environ.get('REQUEST_METHOD') == 'OPTIONS'
+                and environ.get('PATH_INFO', '').startswith(self.prefix)
+                and 'HTTP_ACCESS_CONTROL_REQUEST_METHOD' in environ):
+            headers = self._responses.get(environ.get('HTTP_ORIGIN'), self._refused)
+            start_response('200 OK', list(headers))
+            return [b'']
+        return self.wsgi_app(environ, start_response)
+
+
+class PublicRouteSessionInterface(SessionInterface):
+    """Wrap the configured session interface and skip it for public routes.
+
+    OPTIONS requests and views marked with @public_route get Flask's null
+    session, so nothing is read from or written to the session store.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+        self._public_paths = None
+        self._has_dynamic_public_rules = False
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def _load_public_rules(self, app):
+        paths = set()
+        for rule in app.url_map.iter_rules():
+            view = app.view_functions.get(rule.endpoint)
+            if not getattr(view, 'public_route', False):
+                continue
+            if rule.arguments:
+                self._has_dynamic_public_rules = True
+            else:
+                paths.add(rule.rule)
+        self._public_paths = frozenset(paths)
+
+    def _is_public(self, app, request):
+        if request.method == 'OPTIONS':
+            return True
+        if self._public_paths is None:
+            self._load_public_rules(app)
+        if request.path in self._public_paths:
+            return True
+        if self._has_dynamic_public_rules:
+            try:
+                endpoint, _ = app.url_map.bind_to_environ(request.environ).match()
+            except Exception:
+                return False
+            return getattr(app.view_functions.get(endpoint), 'public_route', False)
+        return False
+
+    def open_session(self, app, request):
+        if self._is_public(app, request):
+            return self.make_null_session(app)
+        return self.inner.open_session(app, request)
+
+    def save_session(self, app, session, response):
+        # Flask never calls this for the null session
+        return self.inner.save_session(app, session, response)
@@ -0,0 +1,164 @@
+"""Move investment_history rows into monthly per-investment buckets.
+
+    python migrate_investment_history.py            # migrate, with before/after report
+    python migrate_investment_history.py --measure  # report only
+
+Rows are processed in _id order in batches. A batch is first tagged with a
+`migrationBatch` id, then becomes one bulk_write of $push upserts into
+investment_history_buckets, then its rows are flagged `migrated: true`.
+Each bucket records the batch ids it has taken in `migrationBatches` and
+the $push only matches buckets without the current id, so a run that
+crashed between the push and the flag re-pushes nothing when it resumes
+that batch. Legacy rows are kept (read adapters ignore migrated rows)
+until you drop the collection yourself.
+"""
+import argparse
+import time
+from collections import defaultdict
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from database import db
+import history_store
+
+BATCH_SIZE = 5000
+
+
+def collection_report(name):
+    stats = db.command('collStats', name)
+    return {
+        'count': stats.get('count', 0),
+        'size': stats.get('size', 0),
+        'storageSize': stats.get('storageSize', 0),
+        'totalIndexSize': stats.get('totalIndexSize', 0)
+    }
+
+
+def time_user_reads(user_ids, reader):
+    timings = []
+    for user_id in user_ids:
+        start = time.perf_counter()
+        reader(user_id)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    if not timings:
+        return {}
+    return {
+        'p50_ms': round(timings[len(timings) // 2], 2),
+        'p95_ms': round(timings[int(len(timings) * 0.95)], 2),
+        'max_ms': round(timings[-1], 2)
+    }
+
+
+def sample_users(limit=50):
+    # The users with the most rows are the ones the change matters for
+    pipeline = [
+        {'$group': {'_id': '$userId', 'rows': {'$sum': 1}}},
+        {'$sort': {'rows': -1}},
+        {'$limit': limit}
+    ]
+    return [doc['_id'] for doc in db[history_store.LEGACY].aggregate(pipeline, allowDiskUse=True)]
+
+
+def legacy_read(user_id):
+    return list(db[history_store.LEGACY].find({'userId': user_id}, {'_id': 0}).sort('createdAt', -1))
+
+
+def bucket_read(user_id):
+    return history_store.get_user_history(db, user_id)
+
+
+def report(label, user_ids):
+    print(f"\n=== {label} ===")
+    for name in (history_store.LEGACY, history_store.BUCKETS):
+        if name in db.list_collection_names():
+            print(f"{name}: {collection_report(name)}")
+    print(f"legacy read latency ({len(user_ids)} users): {time_user_reads(user_ids, legacy_read)}")
+    if history_store.BUCKETS in db.list_collection_names():
+        print(f"bucket read latency ({len(user_ids)} users): {time_user_reads(user_ids, bucket_read)}")
+
+
+def next_batch(legacy):
+    """(batch id, rows) for the next batch: a tagged batch left unfinished by a crash first"""
+    unfinished = legacy.find_one({'migrated': {'$ne': True}, 'migrationBatch': {'$exists': True}},
+                                 {'migrationBatch': 1})
+    if unfinished:
+        batch_id = unfinished['migrationBatch']
+    else:
+        ids = [row['_id'] for row in legacy.find(
+            {'migrated': {'$ne': True}}, {'_id': 1}).sort('_id', 1).limit(BATCH_SIZE)]
+        if not ids:
+            return None, []
+        batch_id = ObjectId()
+        legacy.update_many({'_id': {'$in': ids}}, {'$set': {'migrationBatch': batch_id}})
+    return batch_id, list(legacy.find({'migrationBatch': batch_id, 'migrated': {'$ne': True}}))
+
+
+def push_batch(batch_id, rows):
+    """One $push upsert per bucket, skipped for buckets that already took this batch"""
+    # Group the batch by bucket, keeping chronological order inside each
+    buckets = defaultdict(list)
+    for row in sorted(rows, key=lambda r: r['createdAt']):
+        buckets[(row['investmentId'], row['date'][:7])].append(row)
+
+    operations = []
+    for (investment_id, month), entries in buckets.items():
+        operations.append(UpdateOne(
+            {'investmentId': investment_id, 'month': month, 'migrationBatches': {'$ne': batch_id}},
+            {
+                '$setOnInsert': {'userId': entries[0]['userId']},
+                '$push': {
+                    'dates': {'$each': [e['date'] for e in entries]},
+                    'types': {'$each': [e.get('type', '') for e in entries]},
+                    'amounts': {'$each': [e.get('amount', 0) for e in entries]},
+                    'balances': {'$each': [e.get('balance', 0) for e in entries]},
+                    'createdAt': {'$each': [e['createdAt'] for e in entries]},
+                    'migrationBatches': batch_id
+                },
+                '$inc': {'count': len(entries)}
+            },
+            upsert=True
+        ))
+    try:
+        db[history_store.BUCKETS].bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # A bucket that already took this batch doesn't match the filter, so the
+        # upsert collides with it on the unique (investmentId, month) index
+        if any(error['code'] != 11000 for error in e.details['writeErrors']):
+            raise
+    return len(operations)
+
+
+def migrate():
+    history_store.ensure_indexes(db)
+    legacy = db[history_store.LEGACY]
+
+    while True:
+        batch_id, rows = next_batch(legacy)
+        if not rows:
+            break
+        operations = push_batch(batch_id, rows)
+        legacy.update_many({'_id': {'$in': [r['_id'] for r in rows]}}, {'$set': {'migrated': True}})
+        print(f"Migrated batch {batch_id}: {len(rows)} rows into {operations} bucket updates")
+
+    migrated = legacy.count_documents({'migrated': True})
+    db.schema_migrations.update_one(
+        {'_id': history_store.MIGRATION_ID},
+        {'$set': {'completed': True, 'rows': migrated}},
+        upsert=True
+    )
+    print(f"Migration complete: {migrated} rows")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--measure', action='store_true', help='only print storage and latency figures')
+    args = parser.parse_args()
+
+    users = sample_users()
+    report('Before' if not args.measure else 'Current', users)
+    if not args.measure:
+        migrate()
+        report('After', users)
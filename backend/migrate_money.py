@@ -0,0 +1,94 @@
+"""Convert stored amounts from floats/ints to Decimal128 with two decimal places.
+
+    python migrate_money.py            # convert, collection by collection
+    python migrate_money.py --measure  # only count documents still holding floats/ints
+
+Documents are converted in _id batches with one pipeline update per batch
+($round of $toDecimal, so 0.1 stored as a double becomes 0.10). The filter
+only matches documents that still hold a float or int, so a re-run picks up
+where it stopped and the app can keep writing meanwhile: money.to_decimal()
+reads both representations, and $inc/$sum mix them correctly.
+
+cashflow_buckets counters are not converted in place; rebuild them with
+`python analytics.py --rebuild --from ...` if exact historical totals matter.
+"""
+import argparse
+
+import earnings_rollups
+import history_store
+
+BATCH_SIZE = 1000
+MIGRATION_ID = 'money_decimal128'
+NUMERIC_TYPES = ['double', 'int', 'long']
+
+# collection -> scalar money fields, array money fields
+FIELDS = {
+    'users': (('balance', 'signupBonus', 'referralEarnings'), ()),
+    'transactions': (('amount',), ()),
+    'investments': (('amount', 'profit'), ()),
+    'referral_history': (('amount', 'baseAmount'), ()),
+    history_store.LEGACY: (('amount', 'balance'), ()),
+    history_store.BUCKETS: ((), ('amounts', 'balances')),
+    earnings_rollups.COLLECTION: (earnings_rollups.FIELDS + ('total',), ()),
+}
+
+
+def _convert(value):
+    return {'$cond': [
+        {'$in': [{'$type': value}, NUMERIC_TYPES]},
+        {'$round': [{'$toDecimal': value}, 2]},
+        value
+    ]}
+
+
+def _pending_query(scalars, arrays):
+    # $type on an array field matches when any element has that type
+    return {'$or': [{field: {'$type': NUMERIC_TYPES}} for field in scalars + arrays]}
+
+
+def _pipeline(scalars, arrays):
+    converted = {field: _convert(f'${field}') for field in scalars}
+    converted.update({
+        field: {'$map': {'input': f'${field}', 'in': _convert('$$this')}}
+        for field in arrays
+    })
+    return [{'$set': converted}]
+
+
+def pending(db):
+    return {name: db[name].count_documents(_pending_query(*fields)) for name, fields in FIELDS.items()}
+
+
+def migrate(db):
+    totals = {}
+    for name, (scalars, arrays) in FIELDS.items():
+        query = _pending_query(scalars, arrays)
+        pipeline = _pipeline(scalars, arrays)
+        converted = 0
+        while True:
+            ids = [doc['_id'] for doc in db[name].find(query, {'_id': 1}).limit(BATCH_SIZE)]
+            if not ids:
+                break
+            converted += db[name].update_many({'_id': {'$in': ids}}, pipeline).modified_count
+            print(f"{name}: {converted} documents converted")
+        totals[name] = converted
+
+    db.schema_migrations.update_one(
+        {'_id': MIGRATION_ID},
+        {'$set': {'completed': True, 'documents': totals}},
+        upsert=True
+    )
+    return totals
+
+
+if __name__ == '__main__':
+    from database import db
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--measure', action='store_true', help='only count unconverted documents')
+    args = parser.parse_args()
+
+    print(f"Unconverted documents: {pending(db)}")
+    if not args.measure:
+        print(f"Converted: {migrate(db)}")
+        print(f"Unconverted documents: {pending(db)}")
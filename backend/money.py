@@ -0,0 +1,67 @@
+"""Money amounts: Decimal128 with two decimal places in MongoDB, Decimal in Python.
+
+Every stored amount (balances, transaction and investment amounts, profits,
+commissions, history entries, rollups, analytics counters) is written with
+to_bson(), so $sum and $inc in the database are exact and no rounding drift
+builds up across daily rows. Python code reads amounts with to_decimal(),
+which also accepts the floats and ints written before migrate_money.py ran,
+and does arithmetic on Decimal. JSON responses keep plain numbers:
+to_number() is only used at that boundary.
+"""
+from decimal import ROUND_HALF_EVEN, Decimal, InvalidOperation
+
+from bson.decimal128 import Decimal128
+
+CENT = Decimal('0.01')
+ZERO = Decimal('0.00')
+
+
+def to_decimal(value):
+    """Any stored or submitted amount as a Decimal rounded to cents"""
+    if value is None:
+        return ZERO
+    if isinstance(value, Decimal128):
+        value = value.to_decimal()
+    elif isinstance(value, float):
+        # repr gives the shortest decimal that round-trips, e.g. 0.1 -> '0.1'
+        value = Decimal(repr(value))
+    elif not isinstance(value, Decimal):
+        try:
+            value = Decimal(str(value))
+        except InvalidOperation:
+            raise ValueError(f'Not an amount: {value!r}')
+    if not value.is_finite():
+        raise ValueError(f'Not an amount: {value!r}')
+    return value.quantize(CENT, rounding=ROUND_HALF_EVEN)
+
+
+def to_bson(value):
+    return Decimal128(to_decimal(value))
+
+
+def to_number(value):
+    """For JSON responses and float-only maths (projections)"""
+    return float(to_decimal(value))
+
+
+def to_decimal_rate(rate):
+    """A rate or percentage without rounding it to cents"""
+    if isinstance(rate, Decimal128):
+        return rate.to_decimal()
+    if isinstance(rate, float):
+        return Decimal(repr(rate))
+    return Decimal(str(rate))
+
+
+def percent(amount, rate):
+    """amount * rate / 100, rounded to cents (rate may be a float percentage)"""
+    return to_decimal(to_decimal(amount) * to_decimal_rate(rate) / 100)
+
+
+def share(amount, fraction):
+    """amount * fraction, rounded to cents (fraction like 0.05 for 5%)"""
+    return to_decimal(to_decimal(amount) * to_decimal_rate(fraction))
+
+
+def is_money(value):
+    return isinstance(value, (Decimal128, Decimal))
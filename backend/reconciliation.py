@@ -0,0 +1,289 @@
+"""Audit denormalized money figures against the ledgers they are derived from.
+
+    users.referralEarnings  == sum of referral_history.amount with referrerId = user
+    users.balance           == approved/completed deposits - every investment's
+                               stake + amount and profit of closed investments
+    investments.profit      == sum of the investment's roi_earning history entries
+
+Users are split into _id ranges with $bucketAuto and each range is audited
+in a worker process: a handful of set-based aggregations over the range
+(one per source collection, not one per user), compared in Decimal to the
+cent. Differences go to `reconciliation_discrepancies`, tagged with the run
+id; run totals go to `reconciliation_runs`:
+
+    {'runId': ObjectId, 'kind': 'referralEarnings', 'userId': ObjectId,
+     'investmentId': ObjectId (profit only), 'stored': Decimal128,
+     'expected': Decimal128, 'difference': Decimal128, 'repaired': bool}
+
+With repair, a figure is only overwritten if a second read finds both the
+stored value and the recomputed one unchanged, and the write is guarded on
+the stored value, so a commission or approval landing mid-audit is never
+clobbered. Balance repairs have to be asked for explicitly.
+
+    python reconciliation.py [--workers 8] [--partitions 64] [--repair referralEarnings,profit]
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, UpdateOne
+
+import history_store
+import jobs
+import money
+
+logger = logging.getLogger(__name__)
+
+RUNS = 'reconciliation_runs'
+DISCREPANCIES = 'reconciliation_discrepancies'
+KINDS = ('referralEarnings', 'balance', 'profit')
+DEFAULT_PARTITIONS = 64
+
+
+def ensure_indexes(db):
+    db[DISCREPANCIES].create_index([('runId', ASCENDING), ('kind', ASCENDING)])
+    db.referral_history.create_index([('referrerId', ASCENDING)])
+    db.investments.create_index([('userId', ASCENDING)])
+    db.transactions.create_index([('userId', ASCENDING)])
+
+
+def partitions(db, count):
+    """[(min _id, max _id)] covering every user, roughly equal in size"""
+    return [
+        (bucket['_id']['min'], bucket['_id']['max'])
+        for bucket in db.users.aggregate([
+            {'$project': {'_id': 1}},
+            {'$bucketAuto': {'groupBy': '$_id', 'buckets': count}}
+        ], allowDiskUse=True)
+    ]
+
+
+def _sums(cursor):
+    return {row['_id']: money.to_decimal(row['total']) for row in cursor}
+
+
+def _expected_referral_earnings(db, in_range):
+    return _sums(db.referral_history.aggregate([
+        {'$match': {'referrerId': in_range}},
+        {'$group': {'_id': '$referrerId', 'total': {'$sum': '$amount'}}}
+    ]))
+
+
+def _expected_balances(db, in_range):
+    expected = _sums(db.transactions.aggregate([
+        {'$match': {
+            'type': 'deposit',
+            'status': {'$in': ['approved', 'completed']},
+            '$or': [{'user_id': in_range}, {'userId': in_range}]
+        }},
+        {'$group': {'_id': {'$ifNull': ['$user_id', '$userId']}, 'total': {'$sum': '$amount'}}}
+    ]))
+    for row in db.investments.aggregate([
+        {'$match': {'userId': in_range}},
+        {'$group': {
+            '_id': '$userId',
+            'staked': {'$sum': '$amount'},
+            'returned': {'$sum': {'$cond': [
+                {'$eq': ['$status', 'closed']},
+                {'$add': [{'$ifNull': ['$amount', 0]}, {'$ifNull': ['$profit', 0]}]},
+                0
+            ]}}
+        }}
+    ]):
+        expected[row['_id']] = (expected.get(row['_id'], money.ZERO)
+                                - money.to_decimal(row['staked']) + money.to_decimal(row['returned']))
+    return expected
+
+
+def _expected_profits(db, in_range):
+    # amounts[i] of every bucket slot whose types[i] is roi_earning
+    expected = _sums(db[history_store.BUCKETS].aggregate([
+        {'$match': {'userId': in_range, 'types': 'roi_earning'}},
+        {'$project': {'investmentId': 1, 'types': 1, 'amounts': 1}},
+        {'$unwind': {'path': '$types', 'includeArrayIndex': 'slot'}},
+        {'$match': {'types': 'roi_earning'}},
+        {'$group': {'_id': '$investmentId', 'total': {'$sum': {'$arrayElemAt': ['$amounts', '$slot']}}}}
+    ]))
+    if history_store._legacy_pending(db):
+        for investment_id, total in _sums(db[history_store.LEGACY].aggregate([
+            {'$match': {'userId': in_range, 'type': 'roi_earning', 'migrated': {'$ne': True}}},
+            {'$group': {'_id': '$investmentId', 'total': {'$sum': '$amount'}}}
+        ])).items():
+            expected[investment_id] = expected.get(investment_id, money.ZERO) + total
+    return expected
+
+
+def _compare(db, in_range, kinds):
+    """{(kind, owner id): (userId, stored, expected)} for every figure that is off"""
+    found = {}
+    if 'referralEarnings' in kinds or 'balance' in kinds:
+        users = list(db.users.find({'_id': in_range}, {'referralEarnings': 1, 'balance': 1}))
+        if 'referralEarnings' in kinds:
+            expected = _expected_referral_earnings(db, in_range)
+            for user in users:
+                stored = money.to_decimal(user.get('referralEarnings'))
+                if stored != expected.get(user['_id'], money.ZERO):
+                    found[('referralEarnings', user['_id'])] = (
+                        user['_id'], user.get('referralEarnings'), expected.get(user['_id'], money.ZERO))
+        if 'balance' in kinds:
+            expected = _expected_balances(db, in_range)
+            for user in users:
+                stored = money.to_decimal(user.get('balance'))
+                if stored != expected.get(user['_id'], money.ZERO):
+                    found[('balance', user['_id'])] = (
+                        user['_id'], user.get('balance'), expected.get(user['_id'], money.ZERO))
+    if 'profit' in kinds:
+        expected = _expected_profits(db, in_range)
+        for investment in db.investments.find({'userId': in_range}, {'userId': 1, 'profit': 1}):
+            stored = money.to_decimal(investment.get('profit'))
+            if stored != expected.get(investment['_id'], money.ZERO):
+                found[('profit', investment['_id'])] = (
+                    investment['userId'], investment.get('profit'), expected.get(investment['_id'], money.ZERO))
+    return found
+
+
+def _repair(db, confirmed):
+    """Guarded overwrite of figures that were off on both reads"""
+    users, investments = [], []
+    for (kind, owner_id), (_, stored, expected) in confirmed.items():
+        if kind == 'profit':
+            investments.append(UpdateOne({'_id': owner_id, 'profit': stored},
+                                         {'$set': {'profit': money.to_bson(expected)}}))
+        else:
+            users.append(UpdateOne({'_id': owner_id, kind: stored},
+                                   {'$set': {kind: money.to_bson(expected)}, '$inc': {'dataVersion': 1}}))
+    repaired = 0
+    if users:
+        repaired += db.users.bulk_write(users, ordered=False).modified_count
+    if investments:
+        repaired += db.investments.bulk_write(investments, ordered=False).modified_count
+    return repaired
+
+
+def audit_partition(run_id, low, high, last, kinds, repair):
+    """Audit users with low <= _id < high (<= high for the last range); runs in a worker process"""
+    from database import db
+
+    in_range = {'$gte': low, '$lte' if last else '$lt': high}
+    found = _compare(db, in_range, kinds)
+
+    confirmed = {}
+    if repair and found:
+        again = _compare(db, in_range, kinds)
+        confirmed = {key: value for key, value in found.items()
+                     if key[0] in repair and again.get(key) == value}
+    repaired = _repair(db, confirmed) if confirmed else 0
+
+    now = datetime.utcnow()
+    if found:
+        db[DISCREPANCIES].insert_many([
+            {
+                'runId': run_id,
+                'kind': kind,
+                'userId': user_id,
+                **({'investmentId': owner_id} if kind == 'profit' else {}),
+                'stored': money.to_bson(stored),
+                'expected': money.to_bson(expected),
+                'difference': money.to_bson(money.to_decimal(stored) - expected),
+                'repaired': (kind, owner_id) in confirmed,
+                'createdAt': now
+            }
+            for (kind, owner_id), (user_id, stored, expected) in found.items()
+        ])
+    counts = {kind: 0 for kind in kinds}
+    for kind, _ in found:
+        counts[kind] += 1
+    return {'users': db.users.count_documents({'_id': in_range}), 'discrepancies': counts, 'repaired': repaired}
+
+
+def run(db, kinds=KINDS, repair=(), workers=None, partition_count=DEFAULT_PARTITIONS, run_id=None):
+    """Audit every user across a process pool; returns the run summary"""
+    ensure_indexes(db)
+    run_id = run_id or ObjectId()
+    workers = workers or int(os.getenv('RECONCILIATION_WORKERS', str(os.cpu_count() or 2)))
+    ranges = partitions(db, partition_count)
+    # A retried job reuses its run id; start its report over
+    db[DISCREPANCIES].delete_many({'runId': run_id})
+    db[RUNS].update_one({'_id': run_id}, {'$set': {
+        'status': 'running', 'kinds': list(kinds), 'repair': list(repair),
+        'partitions': len(ranges), 'startedAt': datetime.utcnow()
+    }}, upsert=True)
+
+    summary = {'users': 0, 'discrepancies': {kind: 0 for kind in kinds}, 'repaired': 0}
+    # spawn, not fork: the caller may be a threaded job worker
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [
+            pool.submit(audit_partition, run_id, low, high, i == len(ranges) - 1, tuple(kinds), tuple(repair))
+            for i, (low, high) in enumerate(ranges)
+        ]
+        for done, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            summary['users'] += result['users']
+            summary['repaired'] += result['repaired']
+            for kind, count in result['discrepancies'].items():
+                summary['discrepancies'][kind] += count
+            db[RUNS].update_one({'_id': run_id}, {'$set': {'partitionsDone': done, **summary}})
+
+    db[RUNS].update_one({'_id': run_id}, {'$set': {'status': 'completed', 'finishedAt': datetime.utcnow()}})
+    logger.info(f"Reconciliation {run_id}: {summary}")
+    return {'runId': run_id, **summary}
+
+
+@jobs.handler('reconciliation')
+def run_job(db, payload, job):
+    result = run(db, kinds=payload.get('kinds', KINDS), repair=payload.get('repair', ()),
+                 run_id=ObjectId(payload['runId']) if payload.get('runId') else None)
+    return {'runId': result['runId'], 'users': result['users'], 'repaired': result['repaired']}
+
+
+def get_report(db, run_id, kind=None, limit=100):
+    summary = db[RUNS].find_one({'_id': ObjectId(run_id)})
+    if not summary:
+        return None
+    query = {'runId': summary['_id']}
+    if kind:
+        query['kind'] = kind
+    rows = db[DISCREPANCIES].find(query, {'_id': 0, 'runId': 0}).limit(limit)
+    return {
+        'runId': str(summary['_id']),
+        'status': summary.get('status'),
+        'kinds': summary.get('kinds'),
+        'repair': summary.get('repair'),
+        'partitions': summary.get('partitions'),
+        'partitionsDone': summary.get('partitionsDone', 0),
+        'users': summary.get('users', 0),
+        'discrepancies': summary.get('discrepancies', {}),
+        'repaired': summary.get('repaired', 0),
+        'startedAt': summary.get('startedAt'),
+        'finishedAt': summary.get('finishedAt'),
+        'rows': [
+            {**row, 'userId': str(row['userId']),
+             **({'investmentId': str(row['investmentId'])} if 'investmentId' in row else {})}
+            for row in rows
+        ]
+    }
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+    from database import db
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Audit stored balances against the ledgers')
+    parser.add_argument('--workers', type=int, help='processes (default: RECONCILIATION_WORKERS or CPU count)')
+    parser.add_argument('--partitions', type=int, default=DEFAULT_PARTITIONS, help='user _id ranges')
+    parser.add_argument('--kinds', default=','.join(KINDS), help='figures to check')
+    parser.add_argument('--repair', default='', help='figures to repair, e.g. referralEarnings,profit')
+    args = parser.parse_args()
+
+    kinds = tuple(k for k in args.kinds.split(',') if k)
+    repair = tuple(k for k in args.repair.split(',') if k)
+    unknown = set(kinds + repair) - set(KINDS)
+    if unknown:
+        parser.error(f"unknown figures: {', '.join(sorted(unknown))}")
+    print(run(db, kinds=kinds, repair=repair, workers=args.workers, partition_count=args.partitions))
@@ -0,0 +1,105 @@
+"""Referral codes, kept unique by a unique index on users.referralCode.
+
+insert_user() picks a random code and inserts the user in the same write;
+if the index rejects the code it draws another and retries. With 36^6
+possible codes a retry is rare, so registration costs one insert and no
+lookups for the code, and concurrent signups can never share one.
+
+The index can only be built once existing duplicates are gone:
+
+    python referral_codes.py    # re-code duplicate/missing codes, then build the index
+"""
+import logging
+import random
+import string
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+logger = logging.getLogger(__name__)
+
+ALPHABET = string.ascii_uppercase + string.digits
+LENGTH = 6
+MAX_ATTEMPTS = 8
+INDEX_NAME = 'referralCode_unique'
+
+
+class AllocationError(RuntimeError):
+    pass
+
+
+def generate():
+    return ''.join(random.choices(ALPHABET, k=LENGTH))
+
+
+def _is_code_conflict(error):
+    return 'referralCode' in (error.details or {}).get('keyPattern', {}) or 'referralCode' in str(error)
+
+
+def ensure_indexes(db):
+    try:
+        db.users.create_index(
+            [('referralCode', ASCENDING)], unique=True, name=INDEX_NAME,
+            partialFilterExpression={'referralCode': {'$type': 'string'}}
+        )
+    except OperationFailure as e:
+        # Existing duplicates; registration still works, but without the guarantee
+        logger.error(f"users.referralCode unique index not built ({e}); run python referral_codes.py")
+
+
+def insert_user(db, user):
+    """Insert a new user with a fresh referral code; returns the code"""
+    for _ in range(MAX_ATTEMPTS):
+        user['referralCode'] = generate()
+        try:
+            db.users.insert_one(user)
+            return user['referralCode']
+        except DuplicateKeyError as e:
+            if not _is_code_conflict(e):
+                raise
+            logger.info(f"Referral code {user['referralCode']} taken, drawing another")
+    raise AllocationError(f'No free referral code after {MAX_ATTEMPTS} attempts')
+
+
+def reassign(db, user_id):
+    """Give an existing user a fresh code (same retry loop as insert_user)"""
+    for _ in range(MAX_ATTEMPTS):
+        code = generate()
+        try:
+            db.users.update_one({'_id': user_id}, {'$set': {'referralCode': code}, '$inc': {'dataVersion': 1}})
+            return code
+        except DuplicateKeyError as e:
+            if not _is_code_conflict(e):
+                raise
+    raise AllocationError(f'No free referral code after {MAX_ATTEMPTS} attempts')
+
+
+def fix_duplicates(db):
+    """Keep each code on its oldest user, re-code the others and users without one.
+    Downline links use referredBy (an _id), so changing a code doesn't move anyone."""
+    changed = 0
+    duplicates = db.users.aggregate([
+        {'$match': {'referralCode': {'$type': 'string'}}},
+        {'$sort': {'createdAt': 1, '_id': 1}},
+        {'$group': {'_id': '$referralCode', 'users': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}}
+    ], allowDiskUse=True)
+    for group in duplicates:
+        for user_id in group['users'][1:]:
+            code = reassign(db, user_id)
+            logger.info(f"User {user_id}: duplicate code {group['_id']} -> {code}")
+            changed += 1
+    for user in db.users.find({'referralCode': {'$not': {'$type': 'string'}}}, {'_id': 1}):
+        reassign(db, user['_id'])
+        changed += 1
+    return changed
+
+
+if __name__ == '__main__':
+    from database import db
+
+    logging.basicConfig(level=logging.INFO)
+    print(f"Re-coded {fix_duplicates(db)} users")
+    ensure_indexes(db)
+    print("users.referralCode unique index in place" if INDEX_NAME in db.users.index_information()
+          else "Index still missing, see the log above")
@@ -0,0 +1,215 @@
+"""On-demand profiling of a single request.
+
+An admin sends `X-Profile: 1` (or adds `?_profile=1`) and that request
+alone runs under cProfile. The report is stored in `request_profiles`
+(kept for PROFILE_RETENTION_DAYS) and holds:
+
+- the top functions by cumulative and own time, from pstats;
+- MongoDB round trips: count and time per command and collection, seen
+  by a command listener;
+- time spent serializing the JSON response;
+- wall time.
+
+The response then carries `X-Profile-Report: /api/admin/profiles/<id>` and
+a `Server-Timing` header (total, mongo, serialize) that browser devtools
+show next to the request.
+
+For every other request the cost is one header/argument check in
+before_request. The listener and the JSON provider only read a context
+variable that is unset outside profiled requests.
+
+Only one request per worker process is profiled at a time. cProfile hooks
+the interpreter, not the request: two overlapping profiles would each
+record the other's calls, and from Python 3.12 the second one can't even
+be enabled. A profiling request that arrives while another is running on
+the same worker gets 409 and should simply be retried.
+
+Under gevent, cProfile also sees every greenlet that runs on the worker's
+thread while the request is waiting on I/O, so on a busy worker the
+function table can include other (unprofiled) requests. The Mongo and
+serialization figures are tied to the profiled request only.
+"""
+import contextvars
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, monitoring
+
+COLLECTION = 'request_profiles'
+HEADER = 'X-Profile'
+QUERY_FLAG = '_profile'
+TOP_FUNCTIONS = int(os.getenv('PROFILE_TOP_FUNCTIONS', '30'))
+RETENTION = timedelta(days=int(os.getenv('PROFILE_RETENTION_DAYS', '7')))
+
+_active = contextvars.ContextVar('request_profile', default=None)
+# Held from start() to stop() of the one profile this process may run
+_busy = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    """Another request in this process is being profiled"""
+
+
+def requested(request):
+    return request.headers.get(HEADER) == '1' or request.args.get(QUERY_FLAG) == '1'
+
+
+@contextmanager
+def timing(section):
+    """Add the block's duration to the current profile's `section` total, if profiling"""
+    profile = _active.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.sections[section] = profile.sections.get(section, 0) + time.perf_counter() - started
+
+
+class RequestProfile:
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.profiler = cProfile.Profile()
+        self.sections = {}
+        self.mongo = {}
+        self._in_flight = {}
+        self._token = None
+        self._started = None
+        self.wall = None
+
+    def start(self):
+        """Raises ProfilerBusy if another profile is running in this process"""
+        if not _busy.acquire(blocking=False):
+            raise ProfilerBusy()
+        try:
+            self.profiler.enable()
+        except BaseException:
+            _busy.release()
+            raise
+        self._token = _active.set(self)
+        self._started = time.perf_counter()
+
+    def stop(self):
+        if self._token is None:
+            return
+        try:
+            self.profiler.disable()
+            self.wall = time.perf_counter() - self._started
+            _active.reset(self._token)
+            self._token = None
+        finally:
+            _busy.release()
+
+    def _functions(self, sort):
+        out = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=out)
+        stats.sort_stats(sort)
+        rows = []
+        for func in stats.fcn_list[:TOP_FUNCTIONS]:
+            _, calls, own, cumulative, _ = stats.stats[func]
+            filename, line, name = func
+            rows.append({
+                # Parent directory included: flask/app.py and our app.py both show up
+                'function': f"{'/'.join(filename.replace(os.sep, '/').split('/')[-2:])}:{line}({name})" if line else name,
+                'calls': calls,
+                'ownMs': round(own * 1000, 2),
+                'cumulativeMs': round(cumulative * 1000, 2)
+            })
+        return rows
+
+    def mongo_ms(self):
+        return sum(entry['ms'] for entry in self.mongo.values())
+
+    def report(self, status):
+        mongo = sorted(
+            ({'command': command, 'collection': collection, **entry}
+             for (command, collection), entry in self.mongo.items()),
+            key=lambda entry: entry['ms'], reverse=True
+        )
+        for entry in mongo:
+            entry['ms'] = round(entry['ms'], 2)
+        return {
+            'method': self.method,
+            'path': self.path,
+            'status': status,
+            'wallMs': round(self.wall * 1000, 2),
+            'serializationMs': round(self.sections.get('serialization', 0) * 1000, 2),
+            'mongo': {
+                'roundTrips': sum(entry['count'] for entry in mongo),
+                'ms': round(self.mongo_ms(), 2),
+                'commands': mongo
+            },
+            'byCumulative': self._functions('cumulative'),
+            'byOwnTime': self._functions('tottime'),
+        }
+
+    def server_timing(self):
+        return (f"total;dur={self.wall * 1000:.1f}, mongo;dur={self.mongo_ms():.1f}, "
+                f"serialize;dur={self.sections.get('serialization', 0) * 1000:.1f}")
+
+
+class MongoRoundTrips(monitoring.CommandListener):
+    """Counts the commands each profiled request sends; a no-op for the rest"""
+
+    def started(self, event):
+        profile = _active.get()
+        if profile is not None:
+            collection = event.command.get(event.command_name)
+            profile._in_flight[(event.request_id, event.connection_id)] = (
+                event.command_name, collection if isinstance(collection, str) else None)
+
+    def _finished(self, event):
+        profile = _active.get()
+        if profile is None:
+            return
+        key = profile._in_flight.pop((event.request_id, event.connection_id), None)
+        if key is None:
+            return
+        entry = profile.mongo.setdefault(key, {'count': 0, 'ms': 0.0})
+        entry['count'] += 1
+        entry['ms'] += event.duration_micros / 1000
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+
+def ensure_indexes(db):
+    db[COLLECTION].create_index([('createdAt', ASCENDING)], expireAfterSeconds=int(RETENTION.total_seconds()))
+
+
+def save(db, profile, status, user_id):
+    report = profile.report(status)
+    report.update({'_id': ObjectId(), 'userId': user_id, 'createdAt': datetime.utcnow()})
+    db[COLLECTION].insert_one(report)
+    return report['_id']
+
+
+def get_report(db, profile_id):
+    report = db[COLLECTION].find_one({'_id': ObjectId(profile_id)})
+    if report:
+        report['_id'] = str(report['_id'])
+        report['userId'] = str(report['userId'])
+    return report
+
+
+def recent(db, limit=50):
+    return [
+        {**row, '_id': str(row['_id'])}
+        for row in db[COLLECTION].find(
+            {}, {'method': 1, 'path': 1, 'status': 1, 'wallMs': 1, 'mongo.roundTrips': 1, 'mongo.ms': 1,
+                 'serializationMs': 1, 'createdAt': 1}
+        ).sort('createdAt', DESCENDING).limit(limit)
+    ]
@@ -1,6 +1,9 @@
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.triggers.cron import CronTrigger
-from app import calculate_daily_referral_commissions, calculate_daily_roi_earnings
+from app import calculate_daily_referral_commissions, calculate_daily_roi_earnings, db
+import earnings_rollups
+import slow_queries
 import logging
 from datetime import datetime
 import pytz
@@ -15,7 +18,8 @@ def log_job_execution(job_name):
         def wrapper(*args, **kwargs):
             logger.info(f"\n=== Starting {job_name} at {datetime.utcnow()} ===")
             try:
-                result = func(*args, **kwargs)
+                with slow_queries.origin(f"scheduler:{job_name}"):
+                    result = func(*args, **kwargs)
                 logger.info(f"=== Completed {job_name} successfully at {datetime.utcnow()} ===\n")
                 return result
             except Exception as e:
@@ -44,12 +48,24 @@ def run_daily_roi():
 @log_job_execution("Daily Commission Calculation")
 def run_daily_commission():
     calculate_daily_referral_commissions()
+    run_daily_rollup()
 
-def start_scheduler():
-    """Initialize and start the APScheduler for daily tasks"""
+@log_job_execution("Daily Earnings Rollup")
+def run_daily_rollup():
+    """Rebuild today's per-user earnings rollups once ROI and commissions are in"""
+    users = earnings_rollups.rebuild_day(db, datetime.utcnow())
+    logger.info(f"Rolled up earnings for {users} users")
+
+def start_scheduler(blocking=False):
+    """Initialize and start the APScheduler for daily tasks
+
+    blocking=True is used by the dedicated scheduler process (python scheduler.py),
+    where start() only returns on shutdown.
+    """
     try:
         # Use EAT timezone for development testing
-        scheduler = BackgroundScheduler(timezone=pytz.timezone('Africa/Nairobi'))
+        scheduler_class = BlockingScheduler if blocking else BackgroundScheduler
+        scheduler = scheduler_class(timezone=pytz.timezone('Africa/Nairobi'))
         logger.info(f"Scheduler timezone set to: {scheduler.timezone}")
         
         # Get current time in EAT
@@ -73,6 +89,10 @@ def start_scheduler():
         
         # Start the scheduler if not already running
         if scheduler.state == 0:
+            if blocking:
+                logger.info(f"Scheduler process starting at {eat_time}")
+                scheduler.start()
+                return scheduler
             scheduler.start()
             logger.info(f"Scheduler started successfully at {eat_time}")
             logger.info("\nNext scheduled run times (EAT):")
@@ -86,3 +106,7 @@ def start_scheduler():
     except Exception as e:
         logger.error(f"Error starting scheduler: {str(e)}")
         raise
+
+if __name__ == '__main__':
+    # Dedicated scheduler process: the web workers never run the jobs
+    start_scheduler(blocking=True)
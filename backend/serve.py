@@ -0,0 +1,121 @@
+"""Production entrypoint.
+
+Runs gunicorn (gevent workers, see gunicorn_config.py), a single dedicated
+scheduler process and a job queue worker (worker.py) side by side,
+restarting the scheduler or worker if it dies. Set RUN_SCHEDULER=false or
+RUN_WORKER=false when they run as their own services (e.g. separate
+docker-compose containers running `python scheduler.py` / `python worker.py`).
+
+    python serve.py
+"""
+import os
+import signal
+import subprocess
+import sys
+import time
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('serve')
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+WEB_COMMAND = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(BASE_DIR, 'gunicorn_config.py'), 'app:app']
+SCHEDULER_COMMAND = [sys.executable, os.path.join(BASE_DIR, 'scheduler.py')]
+WORKER_COMMAND = [sys.executable, os.path.join(BASE_DIR, 'worker.py')]
+
+# Restart backoff for supervised processes: doubles up to the cap, resets
+# once the process has stayed up for STABLE_SECONDS.
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+STABLE_SECONDS = 300
+
+
+def _start(command, name):
+    process = subprocess.Popen(command, cwd=BASE_DIR)
+    logger.info(f"Started {name} (pid {process.pid})")
+    return process
+
+
+class Supervised:
+    """A helper process that is restarted with backoff whenever it exits"""
+
+    def __init__(self, name, command):
+        self.name = name
+        self.command = command
+        self.process = _start(command, name)
+        self.started_at = time.monotonic()
+        self.backoff = MIN_BACKOFF
+        self.restart_at = None
+
+    def check(self):
+        if self.process is not None and self.process.poll() is not None:
+            uptime = time.monotonic() - self.started_at
+            if uptime >= STABLE_SECONDS:
+                self.backoff = MIN_BACKOFF
+            logger.error(f"{self.name} exited with status {self.process.returncode} after {uptime:.0f}s, "
+                         f"restarting in {self.backoff}s")
+            self.restart_at = time.monotonic() + self.backoff
+            self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+            self.process = None
+
+        if self.process is None and self.restart_at is not None and time.monotonic() >= self.restart_at:
+            self.process = _start(self.command, self.name)
+            self.started_at = time.monotonic()
+            self.restart_at = None
+
+    def signal(self, signum):
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signum)
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                logger.error(f"{self.name} did not exit within 30s of SIGTERM, killing it")
+                self.process.kill()
+                self.process.wait()
+
+
+def main():
+    stopping = False
+
+    web = _start(WEB_COMMAND, 'gunicorn')
+    helpers = []
+    if os.getenv('RUN_SCHEDULER', 'true').lower() == 'true':
+        helpers.append(Supervised('scheduler', SCHEDULER_COMMAND))
+    if os.getenv('RUN_WORKER', 'true').lower() == 'true':
+        helpers.append(Supervised('job worker', WORKER_COMMAND))
+
+    def shutdown(signum, frame):
+        nonlocal stopping
+        stopping = True
+        logger.info(f"Received signal {signum}, shutting down")
+        if web.poll() is None:
+            web.send_signal(signal.SIGTERM)
+        for helper in helpers:
+            helper.signal(signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    while True:
+        web_status = web.poll()
+        if web_status is not None:
+            if not stopping:
+                logger.error(f"gunicorn exited with status {web_status}")
+            for helper in helpers:
+                helper.stop()
+            return web_status
+
+        if not stopping:
+            for helper in helpers:
+                helper.check()
+
+        time.sleep(1)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
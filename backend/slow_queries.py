@@ -0,0 +1,326 @@
+"""Slow-query log built on pymongo command monitoring.
+
+SlowQueryListener times every command the process sends. One that takes
+longer than SLOW_QUERY_MS is handed to a background thread, so the request
+never waits on the logging. That thread normalizes the command to its
+shape: keys and operators are kept and every literal becomes '?', so
+`{'referredBy': ObjectId(...)}` from every user lands in one group. It
+fetches an explain plan (queryPlanner only, nothing is executed) the first
+time a shape is seen in SLOW_QUERY_EXPLAIN_EVERY seconds, and appends a
+document to the capped `slow_queries` collection:
+
+    {'shapeId': 'sha1', 'command': 'find', 'collection': 'users',
+     'shape': {'filter': {'referredBy': '?'}}, 'durationMs': 412.5,
+     'origin': 'GET /api/referral/stats', 'failed': False,
+     'planSummary': 'COLLSCAN', 'plan': {winning plan, literals normalized} or None,
+     'createdAt': datetime}
+
+`origin` is the Flask route, or whatever label the running job set with
+`with slow_queries.origin('job:user.delete')`. worst_shapes() ranks the
+shapes by total time for GET /api/admin/slow-queries.
+
+getMore is not timed: tailable and change-stream cursors wait in it by design.
+"""
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from pymongo import DESCENDING, monitoring
+from pymongo.errors import PyMongoError
+
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+COLLECTION = 'slow_queries'
+LOG_SIZE_BYTES = int(os.getenv('SLOW_QUERIES_LOG_BYTES', str(32 * 1024 * 1024)))
+THRESHOLD_MS = float(os.getenv('SLOW_QUERY_MS', '100'))
+EXPLAIN = os.getenv('SLOW_QUERY_EXPLAIN', 'true').lower() == 'true'
+EXPLAIN_EVERY = timedelta(seconds=int(os.getenv('SLOW_QUERY_EXPLAIN_EVERY', '600')))
+QUEUE_SIZE = 1000
+
+IGNORED_COMMANDS = frozenset((
+    'hello', 'ismaster', 'isMaster', 'ping', 'buildInfo', 'saslStart', 'saslContinue',
+    'endSessions', 'killCursors', 'getMore', 'explain'
+))
+EXPLAINABLE = frozenset(('find', 'aggregate', 'count', 'distinct', 'findAndModify', 'update', 'delete'))
+# Driver bookkeeping that isn't part of what the query asks for
+DROPPED_KEYS = frozenset((
+    'lsid', 'txnNumber', 'autocommit', 'startTransaction', 'writeConcern', 'readConcern',
+    'documents', 'ordered', 'bypassDocumentValidation', 'comment', 'maxTimeMS', 'batchSize', 'cursor'
+))
+
+_origin = contextvars.ContextVar('slow_query_origin', default=None)
+
+
+@contextmanager
+def origin(label):
+    """Attribute queries sent inside the block to `label` (jobs, scheduled tasks)"""
+    token = _origin.set(label)
+    try:
+        yield
+    finally:
+        _origin.reset(token)
+
+
+def _current_origin():
+    label = _origin.get()
+    if label:
+        return label
+    try:
+        from flask import has_request_context, request
+        if has_request_context():
+            rule = request.url_rule.rule if request.url_rule else request.path
+            return f"{request.method} {rule}"
+    except ImportError:
+        pass
+    return threading.current_thread().name
+
+
+def normalize(value):
+    """Keys and operators of a command with every literal replaced by '?'"""
+    if isinstance(value, dict):
+        return {key: normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if not any(isinstance(item, (dict, list, tuple)) for item in value):
+            return '?'
+        # Pipelines keep their order; repeated shapes (bulk updates) collapse to one
+        shapes = []
+        for item in value:
+            shape = normalize(item)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    if isinstance(value, str) and value.startswith('$'):
+        # Field paths and variables ('$amount', '$$this') are structure, not data
+        return value
+    return '?'
+
+
+def command_shape(command_name, command):
+    return {
+        key: normalize(value) for key, value in command.items()
+        if key != command_name and not key.startswith('$') and key not in DROPPED_KEYS
+    }
+
+
+def shape_id(command_name, collection, shape):
+    text = json.dumps([command_name, collection, shape], separators=(',', ':'), default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _explain_target(command_name, command):
+    target = {key: value for key, value in command.items() if not key.startswith('$') and key not in DROPPED_KEYS}
+    if command_name == 'aggregate':
+        target['cursor'] = {}
+    return target
+
+
+def winning_plan(explain):
+    """The winning plan from an explain result, with filters and index bounds normalized"""
+    planner = explain.get('queryPlanner')
+    if planner is None:
+        # Aggregations that aren't pushed down entirely explain per stage
+        for stage in explain.get('stages', []):
+            if '$cursor' in stage:
+                planner = stage['$cursor'].get('queryPlanner')
+                break
+    if not planner:
+        return None
+    plan = planner.get('winningPlan', {})
+    # The slot-based engine nests it one level down
+    return _scrub(plan.get('queryPlan', plan))
+
+
+def _scrub(plan):
+    if isinstance(plan, dict):
+        return {key: normalize(value) if key in ('filter', 'indexBounds', 'parsedQuery') else _scrub(value)
+                for key, value in plan.items()}
+    if isinstance(plan, list):
+        return [_scrub(item) for item in plan]
+    return plan
+
+
+def plan_summary(plan):
+    """'FETCH <- IXSCAN {"referredBy": 1}', 'COLLSCAN', ... for a winning plan"""
+    stages = []
+    node = plan
+    while node:
+        stage = node.get('stage', '?')
+        if stage == 'IXSCAN':
+            stage = f"IXSCAN {json.dumps(node.get('keyPattern', {}))}"
+        stages.append(stage)
+        node = node.get('inputStage')
+    return ' <- '.join(stages) or None
+
+
+def ensure_collection(db):
+    if COLLECTION not in db.list_collection_names():
+        try:
+            db.create_collection(COLLECTION, capped=True, size=LOG_SIZE_BYTES)
+        except PyMongoError as e:
+            # Another worker created it first
+            logger.info("slow_queries not created here: %s", e)
+
+
+class _Recorder:
+    """Per-process background thread that explains and stores slow commands"""
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.explained = LRUCache(1000)
+        self.dropped = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, item):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # Threads don't survive a fork; each worker starts its own
+                    self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+                    self._pid = os.getpid()
+                    threading.Thread(target=self._run, name='slow-query-recorder', daemon=True).start()
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        from database import connection
+        while True:
+            item = self.queue.get()
+            try:
+                self._record(connection.get_client()[item['database']], item)
+            except Exception as e:
+                logger.warning("Could not record slow query: %s", e)
+
+    def _record(self, db, item):
+        command_name, command = item['command_name'], item['command']
+        collection = command.get(command_name)
+        collection = collection if isinstance(collection, str) else None
+        shape = command_shape(command_name, command)
+        key = shape_id(command_name, collection, shape)
+
+        plan = summary = None
+        last_explained = self.explained.get(key)
+        if (EXPLAIN and command_name in EXPLAINABLE
+                and (last_explained is None or item['at'] - last_explained > EXPLAIN_EVERY)):
+            try:
+                plan = winning_plan(db.command({
+                    'explain': _explain_target(command_name, command), 'verbosity': 'queryPlanner'
+                }))
+                summary = plan_summary(plan) if plan else None
+                self.explained.put(key, item['at'])
+            except PyMongoError as e:
+                logger.info("explain failed for %s on %s: %s", command_name, collection, e)
+
+        db[COLLECTION].insert_one({
+            'shapeId': key,
+            'command': command_name,
+            'collection': collection,
+            'shape': shape,
+            'durationMs': item['durationMs'],
+            'origin': item['origin'],
+            'failed': item['failed'],
+            'planSummary': summary,
+            'plan': plan,
+            'createdAt': item['at']
+        })
+
+
+_recorder = _Recorder()
+
+
+class SlowQueryListener(monitoring.CommandListener):
+    """Times commands and queues the slow ones for the recorder"""
+
+    def __init__(self, threshold_ms=None):
+        self.threshold_ms = THRESHOLD_MS if threshold_ms is None else threshold_ms
+        self._commands = {}
+
+    def _key(self, event):
+        return event.request_id, event.connection_id
+
+    def started(self, event):
+        if event.command_name in IGNORED_COMMANDS or event.command.get(event.command_name) == COLLECTION:
+            return
+        self._commands[self._key(event)] = event.command
+
+    def _finished(self, event, failed):
+        command = self._commands.pop(self._key(event), None)
+        if command is None or event.duration_micros < self.threshold_ms * 1000:
+            return
+        # Same thread as the caller, so the request/job context is still current
+        _recorder.submit({
+            'database': event.database_name,
+            'command_name': event.command_name,
+            'command': command,
+            'durationMs': round(event.duration_micros / 1000, 1),
+            'origin': _current_origin(),
+            'failed': failed,
+            'at': datetime.utcnow()
+        })
+
+    def succeeded(self, event):
+        self._finished(event, False)
+
+    def failed(self, event):
+        self._finished(event, True)
+
+
+def worst_shapes(db, hours=24, limit=20):
+    """Query shapes ranked by total time spent in them over the last `hours`"""
+    since = datetime.utcnow() - timedelta(hours=hours)
+    shapes = list(db[COLLECTION].aggregate([
+        {'$match': {'createdAt': {'$gte': since}}},
+        {'$group': {
+            '_id': '$shapeId',
+            'command': {'$first': '$command'},
+            'collection': {'$first': '$collection'},
+            'shape': {'$first': '$shape'},
+            'count': {'$sum': 1},
+            'totalMs': {'$sum': '$durationMs'},
+            'maxMs': {'$max': '$durationMs'},
+            'failures': {'$sum': {'$cond': ['$failed', 1, 0]}},
+            'origins': {'$addToSet': '$origin'},
+            'lastSeen': {'$max': '$createdAt'}
+        }},
+        {'$sort': {'totalMs': -1}},
+        {'$limit': limit}
+    ]))
+    for shape in shapes:
+        shape['shapeId'] = shape.pop('_id')
+        shape['avgMs'] = round(shape['totalMs'] / shape['count'], 1)
+        shape['origins'] = sorted(shape['origins'])[:10]
+        latest = db[COLLECTION].find_one(
+            {'shapeId': shape['shapeId'], 'planSummary': {'$ne': None}},
+            {'planSummary': 1, 'plan': 1, '_id': 0},
+            sort=[('createdAt', DESCENDING)]
+        )
+        shape['planSummary'] = latest.get('planSummary') if latest else None
+        shape['winningPlan'] = latest.get('plan') if latest else None
+    return shapes
+
+
+if __name__ == '__main__':
+    import argparse
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    from database import db
+
+    parser = argparse.ArgumentParser(description='Print the slowest query shapes')
+    parser.add_argument('--hours', type=int, default=24)
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+    for row in worst_shapes(db, args.hours, args.limit):
+        print(f"{row['totalMs']:>10.1f} ms total  {row['count']:>6}x  max {row['maxMs']:>8.1f} ms  "
+              f"{row['command']} {row['collection']} {json.dumps(row['shape'], default=str)}  "
+              f"[{row['planSummary'] or 'no plan'}]  from {', '.join(row['origins'])}")
@@ -0,0 +1,91 @@
+"""Integration tests against a real MongoDB.
+
+They need a disposable server: app.py addresses `mongo_client.pos`
+directly, so the tests run in the `pos` database and drop it before and
+after the run.
+
+    TEST_MONGODB_URI=mongodb://localhost:27017 python -m pytest backend/tests -s
+
+Without TEST_MONGODB_URI every test here is skipped. `-s` shows the
+figures the measurement tests print.
+"""
+import os
+import sys
+import threading
+
+import pytest
+from pymongo import monitoring
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+TEST_URI = os.getenv('TEST_MONGODB_URI')
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Counts the commands sent to the server, by command name"""
+
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.counts = {}
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def started(self, event):
+        with self._lock:
+            self.counts[event.command_name] = self.counts.get(event.command_name, 0) + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+commands = CommandCounter()
+
+
+@pytest.fixture(scope='session')
+def appmod():
+    if not TEST_URI:
+        pytest.skip('TEST_MONGODB_URI is not set')
+    os.environ['MONGODB_URI'] = TEST_URI
+    os.environ['MONGODB_DB_NAME'] = 'pos'
+
+    import database
+    # Before the first client is created, so it sees every command
+    database.connection.add_event_listener(commands)
+    import app
+    app.mongo_client.drop_database('pos')
+    yield app
+    app.mongo_client.drop_database('pos')
+
+
+@pytest.fixture
+def db(appmod):
+    """The `pos` database, emptied before each test"""
+    database = appmod.mongo_client.pos
+    for name in database.list_collection_names():
+        if not name.startswith('system.'):
+            database[name].delete_many({})
+    appmod.history_store._legacy_migrated = False
+    commands.reset()
+    return database
+
+
+@pytest.fixture
+def call(appmod):
+    """call(endpoint, user_id, json=None, **view_args) -> (status, body), as `user_id`"""
+    from flask import session
+
+    def call(endpoint, user_id, json=None, **view_args):
+        with appmod.app.test_request_context(method='POST', json=json):
+            session['user_id'] = str(user_id)
+            response = appmod.app.make_response(appmod.app.view_functions[endpoint](**view_args))
+            return response.status_code, response.get_json()
+    return call
@@ -0,0 +1,73 @@
+"""Batch approvals (user-039): fixed round trips per batch and throughput figures."""
+import time
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+import admin_batch
+import money
+
+from conftest import commands
+
+
+def _pending_queue(db, users, per_user):
+    """Half deposits, half earnings withdrawals covered by the signup bonus"""
+    now = datetime.utcnow()
+    user_ids = db.users.insert_many([
+        {'username': f'user-{ObjectId()}', 'balance': money.to_bson(0),
+         'signupBonus': money.to_bson(100 * per_user), 'createdAt': now}
+        for _ in range(users)
+    ]).inserted_ids
+    transactions = []
+    for user_id in user_ids:
+        for i in range(per_user):
+            kind = 'deposit' if i % 2 == 0 else 'withdrawal'
+            transactions.append({
+                'user_id': user_id, 'type': kind, 'amount': money.to_bson(100), 'status': 'pending',
+                'createdAt': now, 'updatedAt': now,
+                **({'withdrawalType': 'earnings'} if kind == 'withdrawal' else {})
+            })
+    return [str(tid) for tid in db.transactions.insert_many(transactions).inserted_ids]
+
+
+def _commands_without_get_more():
+    # getMore depends on how many rows a cursor returns, not on the number of queries
+    return commands.total() - commands.counts.get('getMore', 0)
+
+
+def test_batch_round_trips_do_not_grow_with_batch_size(db):
+    small = _pending_queue(db, users=10, per_user=10)
+    large = _pending_queue(db, users=100, per_user=10)
+
+    commands.reset()
+    results = admin_batch.approve_transactions(db, small)
+    small_commands = _commands_without_get_more()
+    assert all(r['ok'] for r in results)
+
+    commands.reset()
+    results = admin_batch.approve_transactions(db, large)
+    large_commands = _commands_without_get_more()
+    assert all(r['ok'] for r in results)
+
+    assert large_commands == small_commands
+
+
+def test_batch_approval_throughput(db, call):
+    """Approvals per second, batched vs one route call each; run with -s to see them"""
+    admin = db.users.insert_one({'username': 'admin', 'isAdmin': True}).inserted_id
+    singles = _pending_queue(db, users=20, per_user=10)
+    batch = _pending_queue(db, users=100, per_user=10)
+
+    started = time.perf_counter()
+    for transaction_id in singles:
+        assert call('approve_transaction', admin, transaction_id=transaction_id)[0] == 200
+    single_rate = len(singles) / (time.perf_counter() - started)
+
+    started = time.perf_counter()
+    status, body = call('batch_transactions', admin, json={'action': 'approve', 'ids': batch})
+    batch_rate = len(batch) / (time.perf_counter() - started)
+
+    print(f"\nsingle approvals: {single_rate:,.0f}/s, batch of {len(batch)}: {batch_rate:,.0f}/s")
+    assert status == 200 and body['succeeded'] == len(batch)
+    assert money.to_decimal(db.users.find_one({'signupBonus': {'$exists': True}})['balance']) == money.to_decimal(500)
+    assert batch_rate > 5 * single_rate
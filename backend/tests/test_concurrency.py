@@ -0,0 +1,173 @@
+"""Concurrent approvals, withdrawals and investments against one user.
+
+The balance, withdrawalSeq and activePairs updates are guarded single
+document writes (user-034); these tests hammer them from many threads at
+once and check that nothing is double counted or overspent.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+import money
+
+THREADS = 16
+PAIR = 'EUR/USD'
+
+
+def _user(db, **fields):
+    user_id = db.users.insert_one({
+        'username': f'user-{ObjectId()}',
+        'phone': '254700000000',
+        'balance': money.to_bson(0),
+        'createdAt': datetime.utcnow(),
+        **fields
+    }).inserted_id
+    return user_id
+
+
+def _pending(db, user_id, kind, amount, count):
+    now = datetime.utcnow()
+    extra = {'withdrawalType': 'earnings'} if kind == 'withdrawal' else {}
+    return db.transactions.insert_many([
+        {'user_id': user_id, 'type': kind, 'amount': money.to_bson(amount), 'status': 'pending',
+         'createdAt': now, 'updatedAt': now, **extra}
+        for _ in range(count)
+    ]).inserted_ids
+
+
+def _run_all(calls):
+    with ThreadPoolExecutor(THREADS) as pool:
+        return list(pool.map(lambda job: job(), calls))
+
+
+def _statuses(results):
+    return sorted(status for status, _ in results)
+
+
+def test_concurrent_deposit_approvals_credit_each_deposit_once(db, call):
+    admin = _user(db, isAdmin=True)
+    user = _user(db)
+    deposits = _pending(db, user, 'deposit', 100, 40)
+
+    # Every deposit approved twice, all at once
+    results = _run_all([
+        (lambda tid=tid: call('approve_transaction', admin, transaction_id=str(tid)))
+        for tid in deposits for _ in range(2)
+    ])
+
+    assert _statuses(results) == [200] * 40 + [409] * 40
+    stored = db.users.find_one({'_id': user})
+    assert money.to_decimal(stored['balance']) == money.to_decimal(4000)
+    assert db.transactions.count_documents({'user_id': user, 'status': 'approved'}) == 40
+
+
+def test_concurrent_withdrawals_never_exceed_withdrawable(db, call):
+    user = _user(db, signupBonus=money.to_bson(1000))
+
+    results = _run_all([
+        (lambda: call('initiate_withdrawal', user, json={'amount': 100}))
+        for _ in range(30)
+    ])
+
+    accepted = [body for status, body in results if status == 200]
+    assert 0 < len(accepted) <= 10
+    assert all(status in (200, 400, 409) for status, _ in results)
+
+    withdrawals = list(db.transactions.find({'user_id': user, 'type': 'withdrawal'}))
+    assert len(withdrawals) == len(accepted)
+    assert sum(money.to_decimal(w['amount']) for w in withdrawals) <= money.to_decimal(1000)
+    # One sequence bump per withdrawal that was kept, none for the ones backed out
+    assert db.users.find_one({'_id': user})['withdrawalSeq'] == len(withdrawals)
+
+
+def test_concurrent_investments_respect_balance_and_pair_limit(db, call):
+    user = _user(db, balance=money.to_bson(1000))
+
+    results = _run_all([
+        (lambda: call('create_investment', user, json={'pair': PAIR, 'amount': 100, 'dailyROI': 1.5}))
+        for _ in range(20)
+    ])
+
+    placed = sum(1 for status, _ in results if status == 200)
+    assert placed == 2
+    stored = db.users.find_one({'_id': user})
+    assert stored['activePairs'][PAIR] == 2
+    assert db.investments.count_documents({'userId': user, 'forexPair': PAIR, 'status': 'active'}) == 2
+    assert money.to_decimal(stored['balance']) == money.to_decimal(800)
+
+
+def test_mixed_load_keeps_balance_sequence_and_slots_consistent(db, call):
+    admin = _user(db, isAdmin=True)
+    user = _user(db, balance=money.to_bson(500), signupBonus=money.to_bson(1000))
+    deposits = _pending(db, user, 'deposit', 50, 20)
+
+    jobs = []
+    jobs += [(lambda tid=tid: ('approve', call('approve_transaction', admin, transaction_id=str(tid))))
+             for tid in deposits for _ in range(2)]
+    jobs += [(lambda: ('withdraw', call('initiate_withdrawal', user, json={'amount': 150})))
+             for _ in range(15)]
+    jobs += [(lambda pair=pair: ('invest', call('create_investment', user,
+                                                json={'pair': pair, 'amount': 200, 'dailyROI': 1.5})))
+             for pair in (PAIR, 'GBP/USD') for _ in range(5)]
+    results = _run_all(jobs)
+
+    approved = sum(1 for kind, (status, _) in results if kind == 'approve' and status == 200)
+    assert approved == 20
+
+    stored = db.users.find_one({'_id': user})
+    active = list(db.investments.find({'userId': user, 'status': 'active'}))
+    staked = sum(money.to_decimal(inv['amount']) for inv in active)
+    assert money.to_decimal(stored['balance']) == money.to_decimal(500 + 20 * 50) - staked
+    assert money.to_decimal(stored['balance']) >= 0
+    for pair in (PAIR, 'GBP/USD'):
+        count = sum(1 for inv in active if inv['forexPair'] == pair)
+        assert count <= 2
+        assert stored.get('activePairs', {}).get(pair, 0) == count
+
+    withdrawals = list(db.transactions.find({'user_id': user, 'type': 'withdrawal'}))
+    assert stored.get('withdrawalSeq', 0) == len(withdrawals)
+    assert sum(money.to_decimal(w['amount']) for w in withdrawals) <= money.to_decimal(1000)
+
+    # Approving the withdrawals twice each, concurrently, leaves the balance alone
+    balance = stored['balance']
+    results = _run_all([
+        (lambda tid=w['_id']: call('approve_transaction', admin, transaction_id=str(tid)))
+        for w in withdrawals for _ in range(2)
+    ])
+    assert _statuses(results) == [200] * len(withdrawals) + [409] * len(withdrawals)
+    assert db.users.find_one({'_id': user})['balance'] == balance
+
+
+def test_concurrent_closes_release_each_investment_once(db, call):
+    user = _user(db, balance=money.to_bson(400))
+    for _ in range(2):
+        assert call('create_investment', user, json={'pair': PAIR, 'amount': 200, 'dailyROI': 1.5})[0] == 200
+    investments = [inv['_id'] for inv in db.investments.find({'userId': user})]
+
+    results = _run_all([
+        (lambda iid=iid: call('close_investment', user, investment_id=str(iid)))
+        for iid in investments for _ in range(3)
+    ])
+
+    assert _statuses(results) == [200] * 2 + [409] * 4
+    stored = db.users.find_one({'_id': user})
+    assert stored['activePairs'][PAIR] == 0
+    assert money.to_decimal(stored['balance']) == money.to_decimal(400)
+
+
+def test_concurrent_investments_credit_the_one_time_reward_once(db, call, appmod):
+    appmod.init_referral_history_indexes(db)
+    referrer = _user(db, referralEarnings=money.to_bson(0))
+    referee = _user(db, balance=money.to_bson(10000), referredBy=referrer)
+
+    results = _run_all([
+        (lambda pair=pair: call('create_investment', referee, json={'pair': pair, 'amount': 100, 'dailyROI': 1.5}))
+        for pair in ('EUR/USD', 'GBP/USD', 'USD/JPY', 'USD/CHF') for _ in range(2)
+    ])
+
+    assert all(status == 200 for status, _ in results)
+    rewards = list(db.referral_history.find({'referrerId': referrer, 'type': 'one_time_reward'}))
+    assert len(rewards) == 1
+    stored = db.users.find_one({'_id': referrer})
+    assert money.to_decimal(stored['referralEarnings']) == money.to_decimal(rewards[0]['amount'])
@@ -0,0 +1,88 @@
+"""investment_history -> monthly buckets (user-030): migration and storage/latency figures."""
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+
+import history_store
+import migrate_investment_history as migration
+import money
+
+from conftest import commands
+
+
+def _legacy_rows(db, users, investments_per_user, days):
+    start = datetime(2025, 1, 1)
+    user_ids = [ObjectId() for _ in range(users)]
+    rows = []
+    for user_id in user_ids:
+        for _ in range(investments_per_user):
+            investment_id = ObjectId()
+            for day in range(days):
+                created_at = start + timedelta(days=day, hours=1)
+                rows.append({
+                    'investmentId': investment_id,
+                    'userId': user_id,
+                    'type': 'roi_earning',
+                    'amount': money.to_bson('12.50'),
+                    'date': created_at.date().isoformat(),
+                    'createdAt': created_at,
+                    'balance': money.to_bson(1000 + day * 12.5)
+                })
+    db[history_store.LEGACY].insert_many(rows)
+    return user_ids, len(rows)
+
+
+def _entries(history):
+    # Investments of one user share createdAt per day, so compare as sets of rows
+    return sorted((e['investmentId'], e['date'], e['type'], money.to_decimal(e['amount']), e['createdAt'])
+                  for e in history)
+
+
+def test_resumed_migration_does_not_duplicate_entries(db, monkeypatch):
+    user_ids, total = _legacy_rows(db, users=2, investments_per_user=2, days=70)
+    before = {user_id: _entries(migration.legacy_read(user_id)) for user_id in user_ids}
+    monkeypatch.setattr(migration, 'BATCH_SIZE', 50)
+    history_store.ensure_indexes(db)
+
+    # Crash after the $push, before the rows are flagged migrated
+    batch_id, rows = migration.next_batch(db[history_store.LEGACY])
+    migration.push_batch(batch_id, rows)
+    migration.migrate()
+
+    buckets = list(db[history_store.BUCKETS].find())
+    assert sum(bucket['count'] for bucket in buckets) == total
+    assert all(bucket['count'] == len(bucket['dates']) == len(set(bucket['createdAt'])) for bucket in buckets)
+    assert db[history_store.LEGACY].count_documents({'migrated': {'$ne': True}}) == 0
+    for user_id in user_ids:
+        assert _entries(history_store.get_user_history(db, user_id)) == before[user_id]
+
+    # Running it again finds nothing left to do
+    migration.migrate()
+    assert sum(bucket['count'] for bucket in db[history_store.BUCKETS].find()) == total
+
+
+def test_bucket_storage_and_read_latency(db):
+    """Prints collStats and read latency for both layouts; run with -s to see them"""
+    user_ids, total = _legacy_rows(db, users=20, investments_per_user=3, days=180)
+    db[history_store.LEGACY].create_index('userId')
+    legacy = migration.collection_report(history_store.LEGACY)
+    legacy_latency = migration.time_user_reads(user_ids, migration.legacy_read)
+    commands.reset()
+    migration.legacy_read(user_ids[0])
+    legacy_round_trips = commands.total()
+
+    migration.migrate()
+    buckets = migration.collection_report(history_store.BUCKETS)
+    bucket_latency = migration.time_user_reads(user_ids, migration.bucket_read)
+    commands.reset()
+    migration.bucket_read(user_ids[0])
+    bucket_round_trips = commands.total()
+
+    print(f"\n{total} history rows, {len(user_ids)} users")
+    print(f"legacy:  {legacy}, read {legacy_latency}, {legacy_round_trips} commands per user")
+    print(f"buckets: {buckets}, read {bucket_latency}, {bucket_round_trips} commands per user")
+
+    # One document per investment per month instead of per day
+    assert buckets['count'] == len(user_ids) * 3 * 6
+    assert buckets['size'] < legacy['size']
+    assert bucket_round_trips <= legacy_round_trips
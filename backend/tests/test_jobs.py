@@ -0,0 +1,129 @@
+"""Job queue (user-042): claiming, ordering, leases, retries and dedupe."""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import jobs
+
+THREADS = 16
+
+
+def _queue(db, count, **kwargs):
+    jobs.ensure_indexes(db)
+    return [jobs.enqueue(db, 'test.job', {'n': n}, **kwargs)['_id'] for n in range(count)]
+
+
+def _expire_lease(db, job_id):
+    db[jobs.COLLECTION].update_one({'_id': job_id}, {'$set': {'lockedUntil': datetime.utcnow() - timedelta(seconds=1)}})
+
+
+def test_concurrent_consumers_never_claim_the_same_job(db):
+    queued = _queue(db, 50)
+
+    def drain(slot):
+        claimed = []
+        while (job := jobs.claim(db, jobs.worker_id(slot))) is not None:
+            claimed.append(job['_id'])
+        return claimed
+
+    with ThreadPoolExecutor(THREADS) as pool:
+        claimed = [job_id for batch in pool.map(drain, range(THREADS)) for job_id in batch]
+
+    assert sorted(claimed) == sorted(queued)
+    assert db[jobs.COLLECTION].count_documents({'status': 'running', 'attempts': 1}) == 50
+
+
+def test_claim_takes_higher_priority_then_earliest_run_at(db):
+    jobs.ensure_indexes(db)
+    now = datetime.utcnow()
+    late = jobs.enqueue(db, 'test.job', run_at=now - timedelta(minutes=1))
+    early = jobs.enqueue(db, 'test.job', run_at=now - timedelta(minutes=5))
+    urgent = jobs.enqueue(db, 'test.job', priority=10, run_at=now - timedelta(seconds=1))
+    jobs.enqueue(db, 'test.job', priority=100, run_at=now + timedelta(hours=1))
+    jobs.enqueue(db, 'other.job', priority=50)
+
+    order = [jobs.claim(db, 'w', types=['test.job'])['_id'] for _ in range(3)]
+
+    assert order == [urgent['_id'], early['_id'], late['_id']]
+    # The future job is not due yet
+    assert jobs.claim(db, 'w', types=['test.job']) is None
+
+
+def test_expired_lease_is_requeued_or_failed_once_attempts_run_out(db):
+    retried, last = _queue(db, 1)[0], _queue(db, 1, max_attempts=1)[0]
+    for _ in range(2):
+        jobs.claim(db, 'crashed')
+    _expire_lease(db, retried)
+    _expire_lease(db, last)
+
+    assert jobs.reap(db) == 2
+
+    requeued = db[jobs.COLLECTION].find_one({'_id': retried})
+    assert requeued['status'] == 'queued' and requeued['lastError'] == 'lease expired'
+    assert 'lockedBy' not in requeued and requeued['active']
+    failed = db[jobs.COLLECTION].find_one({'_id': last})
+    assert failed['status'] == 'failed' and 'active' not in failed
+
+    # A live lease is left alone, and the requeued job can be claimed again
+    assert jobs.claim(db, 'w')['_id'] == retried
+    assert jobs.reap(db) == 0
+
+
+def test_lost_lease_cannot_be_extended_or_finished_by_the_old_consumer(db):
+    job_id = _queue(db, 1)[0]
+    stale = jobs.claim(db, 'crashed')
+    _expire_lease(db, job_id)
+    jobs.reap(db)
+    current = jobs.claim(db, 'w')
+
+    assert not jobs.extend(db, stale)
+    jobs.complete(db, stale)
+    assert db[jobs.COLLECTION].find_one({'_id': job_id})['status'] == 'running'
+    assert jobs.extend(db, current)
+
+
+def test_failed_attempts_back_off_until_max_attempts_then_retry_resets(db, monkeypatch):
+    calls = []
+
+    def flaky(db, payload, job):
+        calls.append(job['attempts'])
+        raise RuntimeError('boom')
+
+    monkeypatch.setitem(jobs.HANDLERS, 'test.job', flaky)
+    job_id = _queue(db, 1, max_attempts=3)[0]
+
+    for attempt in range(1, 4):
+        job = jobs.claim(db, 'w')
+        assert job['attempts'] == attempt
+        assert not jobs.execute(db, job)
+        stored = db[jobs.COLLECTION].find_one({'_id': job_id})
+        assert stored['lastError'] == 'RuntimeError: boom'
+        if attempt < 3:
+            assert stored['status'] == 'queued' and stored['runAt'] > datetime.utcnow()
+            # Not due until the backoff has passed
+            assert jobs.claim(db, 'w') is None
+            db[jobs.COLLECTION].update_one({'_id': job_id}, {'$set': {'runAt': datetime.utcnow()}})
+
+    assert calls == [1, 2, 3]
+    assert db[jobs.COLLECTION].find_one({'_id': job_id})['status'] == 'failed'
+
+    monkeypatch.setitem(jobs.HANDLERS, 'test.job', lambda db, payload, job: {'ok': True})
+    assert jobs.retry(db, job_id)['attempts'] == 0
+    assert jobs.execute(db, jobs.claim(db, 'w'))
+    stored = db[jobs.COLLECTION].find_one({'_id': job_id})
+    assert stored['status'] == 'done' and stored['result'] == {'ok': True}
+
+
+def test_dedupe_key_allows_one_unfinished_job(db):
+    jobs.ensure_indexes(db)
+
+    with ThreadPoolExecutor(THREADS) as pool:
+        queued = list(pool.map(lambda _: jobs.enqueue(db, 'test.job', dedupe_key='user:1'), range(THREADS)))
+
+    assert len({job['_id'] for job in queued}) == 1
+    assert db[jobs.COLLECTION].count_documents({'dedupeKey': 'user:1'}) == 1
+
+    # Once the job is finished the key is free again
+    jobs.complete(db, jobs.claim(db, 'w'))
+    again = jobs.enqueue(db, 'test.job', dedupe_key='user:1')
+    assert again['_id'] != queued[0]['_id']
+    assert db[jobs.COLLECTION].count_documents({'dedupeKey': 'user:1', 'active': True}) == 1
@@ -0,0 +1,226 @@
+"""Background cascade deletion of a user and everything that hangs off them.
+
+request_deletion() marks the user as being deleted and records a progress
+document in `user_deletions`; schedule() queues a `user.delete` job and the
+admin request returns straight away. A job worker then runs the cascade in
+bounded batches, updating the progress document after every batch, so a
+retried job resumes where the last attempt stopped and
+GET /api/admin/deletions/<id> shows how far it got:
+
+    {'userId': ObjectId, 'status': 'pending' | 'running' | 'completed' | 'failed',
+     'referrals': 'tombstone' | 'reparent', 'step': 'investments',
+     'counts': {'transactions': 120, 'investments': 4, ...},
+     'createdAt', 'startedAt', 'heartbeatAt', 'finishedAt', 'error'}
+
+Referral links: downline users either lose their referrer (tombstone, the
+default: referredBy is cleared and the old id kept in formerReferredBy) or
+move up to the deleted user's own referrer (reparent). Commissions already
+paid to the upline because of this user stay in referral_history, flagged
+userDeleted, since they are part of the upline's withdrawable balance.
+The user document itself is archived to `deleted_users` before removal.
+"""
+import logging
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, ReturnDocument
+
+import history_store
+import earnings_rollups
+import events
+import jobs
+
+logger = logging.getLogger(__name__)
+
+COLLECTION = 'user_deletions'
+ARCHIVE = 'deleted_users'
+BATCH_SIZE = 1000
+REFERRAL_MODES = ('tombstone', 'reparent')
+STALE_AFTER = timedelta(minutes=5)
+
+
+def _owned_transactions(user_id):
+    # Legacy transactions may only carry userId; both fields are indexed
+    return {'$or': [{'user_id': user_id}, {'userId': user_id}]}
+
+
+# (progress key, collection, filter) in the order they are removed
+def _cascade(user_id):
+    return [
+        ('transactions', 'transactions', _owned_transactions(user_id)),
+        ('investments', 'investments', {'userId': user_id}),
+        ('investmentHistory', history_store.BUCKETS, {'userId': user_id}),
+        ('legacyInvestmentHistory', history_store.LEGACY, {'userId': user_id}),
+        ('referralEarnings', 'referral_history', {'referrerId': user_id}),
+        ('dailyEarnings', earnings_rollups.COLLECTION, {'userId': user_id}),
+        ('passwordResets', 'password_resets', {'userId': user_id}),
+    ]
+
+
+def ensure_indexes(db):
+    # At most one unfinished deletion per user
+    db[COLLECTION].create_index(
+        [('userId', ASCENDING)], unique=True,
+        partialFilterExpression={'active': True}
+    )
+    db.users.create_index([('referredBy', ASCENDING)])
+    # Both $or branches of the referral_history flagging in _unlink_referrals
+    db.referral_history.create_index([('userId', ASCENDING)])
+    db.referral_history.create_index([('referredId', ASCENDING)])
+
+
+def request_deletion(db, user_id, requested_by=None, referrals='tombstone'):
+    """Record a deletion and disable the account; returns the progress document"""
+    if referrals not in REFERRAL_MODES:
+        raise ValueError(f"referrals must be one of {', '.join(REFERRAL_MODES)}")
+
+    existing = db[COLLECTION].find_one({'userId': user_id, 'active': True})
+    if existing:
+        return existing
+
+    now = datetime.utcnow()
+    deletion = {
+        'userId': user_id,
+        'requestedBy': requested_by,
+        'referrals': referrals,
+        'status': 'pending',
+        'active': True,
+        'step': None,
+        'counts': {},
+        'createdAt': now
+    }
+    deletion['_id'] = db[COLLECTION].insert_one(deletion).inserted_id
+    db.users.update_one(
+        {'_id': user_id},
+        {'$set': {'isActive': False, 'deletionId': deletion['_id']}, '$inc': {'dataVersion': 1}}
+    )
+    return deletion
+
+
+def schedule(db, deletion):
+    """Queue the cascade; a deletion has at most one unfinished job"""
+    return jobs.enqueue(db, 'user.delete', {'deletionId': deletion['_id']},
+                        dedupe_key=f"user.delete:{deletion['_id']}")
+
+
+def claim(db, deletion_id):
+    """Take an unfinished deletion, unless another worker is still heartbeating on it"""
+    now = datetime.utcnow()
+    return db[COLLECTION].find_one_and_update(
+        {'_id': deletion_id, 'active': True, '$or': [
+            {'status': {'$in': ['pending', 'failed']}},
+            {'status': 'running', 'heartbeatAt': {'$lt': now - STALE_AFTER}}
+        ]},
+        {'$set': {'status': 'running', 'heartbeatAt': now}, '$min': {'startedAt': now}, '$unset': {'error': ''}},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def _progress(db, deletion, step, key=None, count=0):
+    update = {'$set': {'step': step, 'heartbeatAt': datetime.utcnow()}}
+    if key:
+        update['$inc'] = {f'counts.{key}': count}
+    db[COLLECTION].update_one({'_id': deletion['_id']}, update)
+
+
+def _delete_in_batches(db, deletion, key, collection, query):
+    while True:
+        ids = [doc['_id'] for doc in db[collection].find(query, {'_id': 1}).limit(BATCH_SIZE)]
+        if not ids:
+            return
+        deleted = db[collection].delete_many({'_id': {'$in': ids}}).deleted_count
+        _progress(db, deletion, key, key, deleted)
+
+
+def _unlink_referrals(db, deletion, user):
+    user_id = user['_id']
+    if deletion['referrals'] == 'reparent' and user.get('referredBy'):
+        update = {'$set': {'referredBy': user['referredBy'], 'formerReferredBy': user_id}}
+    else:
+        update = {'$set': {'referredBy': None, 'formerReferredBy': user_id}}
+    update['$inc'] = {'dataVersion': 1}
+
+    while True:
+        ids = [doc['_id'] for doc in db.users.find({'referredBy': user_id}, {'_id': 1}).limit(BATCH_SIZE)]
+        if not ids:
+            break
+        moved = db.users.update_many({'_id': {'$in': ids}, 'referredBy': user_id}, update).modified_count
+        _progress(db, deletion, 'referrals', 'referrals', moved)
+
+    # Upline commissions earned from this user stay, but are marked
+    # (one-time rewards name the referee userId, daily commissions referredId)
+    db.referral_history.update_many(
+        {'$or': [{'userId': user_id}, {'referredId': user_id}]},
+        {'$set': {'userDeleted': True}}
+    )
+    if deletion['referrals'] == 'reparent' and user.get('referredBy'):
+        db.users.update_one({'_id': user['referredBy']}, {'$inc': {'dataVersion': 1}})
+
+
+def run(db, deletion):
+    """Carry a claimed deletion through to the end (safe to re-run); False if it failed"""
+    user_id = deletion['userId']
+    try:
+        user = db.users.find_one({'_id': user_id})
+        if user:
+            _progress(db, deletion, 'referrals')
+            _unlink_referrals(db, deletion, user)
+
+        for key, collection, query in _cascade(user_id):
+            _progress(db, deletion, key)
+            _delete_in_batches(db, deletion, key, collection, query)
+
+        if user:
+            _progress(db, deletion, 'user')
+            user.pop('password', None)
+            db[ARCHIVE].replace_one({'_id': user_id}, {**user, 'deletedAt': datetime.utcnow(),
+                                                       'deletionId': deletion['_id']}, upsert=True)
+            db.users.delete_one({'_id': user_id})
+            events.publish('user.deleted', {'id': user_id, 'username': user.get('username')}, {'totalUsers': -1})
+
+        db[COLLECTION].update_one(
+            {'_id': deletion['_id']},
+            {'$set': {'status': 'completed', 'step': None, 'finishedAt': datetime.utcnow()}, '$unset': {'active': ''}}
+        )
+        logger.info(f"Deleted user {user_id} (deletion {deletion['_id']})")
+        return True
+    except Exception as e:
+        logger.error(f"Deletion {deletion['_id']} of user {user_id} failed: {str(e)}")
+        db[COLLECTION].update_one(
+            {'_id': deletion['_id']},
+            {'$set': {'status': 'failed', 'error': str(e), 'finishedAt': datetime.utcnow()}}
+        )
+        return False
+
+
+@jobs.handler('user.delete')
+def run_job(db, payload, job):
+    deletion_id = payload['deletionId']
+    deletion = claim(db, deletion_id)
+    if deletion is None:
+        current = db[COLLECTION].find_one({'_id': deletion_id}, {'status': 1})
+        if current and current['status'] != 'completed':
+            # A crashed attempt's heartbeat hasn't gone stale yet; retry later
+            raise RuntimeError(f"deletion {deletion_id} is still {current['status']}")
+        return {'status': current['status'] if current else 'missing'}
+    if not run(db, deletion):
+        raise RuntimeError(f"deletion {deletion_id} failed, see its progress document")
+    return {'status': 'completed'}
+
+
+def get_progress(db, deletion_id):
+    deletion = db[COLLECTION].find_one({'_id': ObjectId(deletion_id)})
+    if not deletion:
+        return None
+    return {
+        'id': str(deletion['_id']),
+        'userId': str(deletion['userId']),
+        'status': deletion['status'],
+        'step': deletion.get('step'),
+        'referrals': deletion.get('referrals'),
+        'counts': deletion.get('counts', {}),
+        'error': deletion.get('error'),
+        'createdAt': deletion.get('createdAt'),
+        'startedAt': deletion.get('startedAt'),
+        'finishedAt': deletion.get('finishedAt')
+    }
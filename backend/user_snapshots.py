@@ -0,0 +1,102 @@
+"""Username/phone snapshots on transactions and investments.
+
+Admin lists show who a transaction belongs to. Instead of a $lookup into
+`users` per row, the owner's display fields are copied onto transactions
+and investments when they are written, and re-copied by fan_out() when the
+user changes them. Rows written before this existed are filled by the
+backfill below; until it has run, fill_missing() looks the stragglers up
+with one query per page.
+
+Transactions were written with either `user_id` or `userId`; `user_id` is
+the canonical field and the backfill copies legacy `userId` values into it.
+
+    python user_snapshots.py            # backfill missing snapshots
+    python user_snapshots.py --force    # rewrite every snapshot
+"""
+import argparse
+
+from pymongo import ASCENDING, DESCENDING, UpdateMany
+
+FIELDS = ('username', 'phone')
+BATCH_SIZE = 1000
+
+
+def snapshot(user):
+    return {field: user.get(field) for field in FIELDS}
+
+
+# Owner filter per collection. Legacy transactions may only have `userId`;
+# investments only ever carry `userId`. Every branch is indexed (ensure_indexes).
+OWNER_FILTERS = {
+    'transactions': lambda user_id: {'$or': [{'user_id': user_id}, {'userId': user_id}]},
+    'investments': lambda user_id: {'userId': user_id},
+}
+
+
+def fan_out(db, user_id, values):
+    """Copy changed display fields onto all of a user's transactions and investments"""
+    values = {field: values[field] for field in FIELDS if field in values}
+    if not values:
+        return
+    for name, owned_by in OWNER_FILTERS.items():
+        db[name].update_many(owned_by(user_id), {'$set': values})
+
+
+def fill_missing(db, rows, user_key='userId'):
+    """Fill username/phone on rows (dicts with a user id under user_key) that lack them"""
+    missing = {row[user_key] for row in rows if row.get('username') is None and row.get(user_key)}
+    if not missing:
+        return rows
+    users = {u['_id']: u for u in db.users.find({'_id': {'$in': list(missing)}}, {'username': 1, 'phone': 1})}
+    for row in rows:
+        user = users.get(row.get(user_key))
+        if row.get('username') is None and user:
+            row.update(snapshot(user))
+    return rows
+
+
+def ensure_indexes(db):
+    db.transactions.create_index([('status', ASCENDING), ('createdAt', DESCENDING)])
+    db.transactions.create_index([('type', ASCENDING), ('createdAt', DESCENDING)])
+    db.transactions.create_index([('createdAt', DESCENDING)])
+    db.transactions.create_index([('user_id', ASCENDING)])
+    db.transactions.create_index([('userId', ASCENDING)])
+    db.investments.create_index([('userId', ASCENDING)])
+
+
+def backfill(db, force=False):
+    # Canonical owner field first, so the snapshot updates can use it
+    normalized = db.transactions.update_many(
+        {'user_id': {'$exists': False}, 'userId': {'$exists': True}},
+        [{'$set': {'user_id': '$userId'}}]
+    ).modified_count
+    print(f"Copied userId -> user_id on {normalized} transactions")
+
+    stale = {} if force else {'username': {'$exists': False}}
+    updated = 0
+    last_id = None
+    while True:
+        query = {'_id': {'$gt': last_id}} if last_id else {}
+        users = list(db.users.find(query, {'username': 1, 'phone': 1}).sort('_id', ASCENDING).limit(BATCH_SIZE))
+        if not users:
+            break
+        last_id = users[-1]['_id']
+        for name, owned_by in OWNER_FILTERS.items():
+            operations = [
+                UpdateMany({**owned_by(user['_id']), **stale}, {'$set': snapshot(user)})
+                for user in users
+            ]
+            updated += db[name].bulk_write(operations, ordered=False).modified_count
+        print(f"Backfilled through user {last_id} ({updated} rows updated so far)")
+    return updated
+
+
+if __name__ == '__main__':
+    from database import db
+
+    parser = argparse.ArgumentParser(description='Backfill username/phone onto transactions and investments')
+    parser.add_argument('--force', action='store_true', help='rewrite snapshots that already exist')
+    args = parser.parse_args()
+
+    ensure_indexes(db)
+    print(f"Done: {backfill(db, force=args.force)} rows updated")
@@ -0,0 +1,107 @@
+"""Job queue worker process (see jobs.py).
+
+Runs N consumer threads that claim and execute queued jobs, plus a reaper
+that hands jobs of crashed workers back to the queue. On SIGTERM/SIGINT the
+consumers finish the job they are running and exit.
+
+    python worker.py                      # JOB_WORKER_CONCURRENCY consumers (default 4)
+    python worker.py -c 8 --types user.delete
+"""
+import argparse
+import logging
+import os
+import signal
+import threading
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import jobs  # noqa: E402
+import slow_queries  # noqa: E402
+from database import connection, db  # noqa: E402
+
+# Modules that register job handlers
+import reconciliation  # noqa: F401,E402
+import user_deletion  # noqa: F401,E402
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('job_worker')
+
+IDLE_MIN_SECONDS = 0.5
+IDLE_MAX_SECONDS = 5
+REAP_SECONDS = 30
+
+
+def consume(slot, stopping, types=None):
+    worker_id = jobs.worker_id(slot)
+    idle = IDLE_MIN_SECONDS
+    while not stopping.is_set():
+        try:
+            job = jobs.claim(db, worker_id, types)
+        except Exception as e:
+            logger.error(f"{worker_id}: claim failed: {str(e)}")
+            job = None
+        if job is None:
+            # Back off while the queue is empty
+            stopping.wait(idle)
+            idle = min(idle * 2, IDLE_MAX_SECONDS)
+            continue
+        idle = IDLE_MIN_SECONDS
+        logger.info(f"{worker_id}: running job {job['_id']} ({job['type']}, attempt {job['attempts']})")
+        jobs.execute(db, job)
+
+
+def reap_expired(stopping):
+    while not stopping.wait(REAP_SECONDS):
+        try:
+            jobs.reap(db)
+        except Exception as e:
+            logger.error(f"Reaper failed: {str(e)}")
+
+
+def start_in_background(concurrency=1):
+    """Consumers as daemon threads of the current process, for `python app.py`"""
+    stopping = threading.Event()
+    threading.Thread(target=reap_expired, args=(stopping,), name='job-reaper', daemon=True).start()
+    for slot in range(concurrency):
+        threading.Thread(target=consume, args=(slot, stopping), name=f'job-consumer-{slot}', daemon=True).start()
+    return stopping
+
+
+def main(concurrency, types=None):
+    # Before the first query creates the client (app.py registers its own)
+    connection.add_event_listener(slow_queries.SlowQueryListener())
+    jobs.ensure_indexes(db)
+    stopping = threading.Event()
+
+    def shutdown(signum, frame):
+        logger.info(f"Received signal {signum}, finishing running jobs")
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    threading.Thread(target=reap_expired, args=(stopping,), name='job-reaper', daemon=True).start()
+    consumers = [
+        threading.Thread(target=consume, args=(slot, stopping, types), name=f'job-consumer-{slot}')
+        for slot in range(concurrency)
+    ]
+    for consumer in consumers:
+        consumer.start()
+    logger.info(f"Job worker started with {concurrency} consumers for {', '.join(types) if types else 'all job types'}")
+
+    # Joining with a timeout keeps the main thread able to take signals
+    while any(consumer.is_alive() for consumer in consumers):
+        for consumer in consumers:
+            consumer.join(timeout=1)
+    logger.info("Job worker stopped")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run background job consumers')
+    parser.add_argument('-c', '--concurrency', type=int, default=int(os.getenv('JOB_WORKER_CONCURRENCY', '4')),
+                        help='number of concurrent consumers')
+    parser.add_argument('--types', help='comma-separated job types to take (default: all)')
+    args = parser.parse_args()
+    main(args.concurrency, args.types.split(',') if args.types else None)
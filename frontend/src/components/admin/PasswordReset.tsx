@@ -43,7 +43,6 @@ export function PasswordReset() {
   const { data: resetHistoryData, isLoading: isLoadingHistory } = useQuery({
     queryKey: ['passwordResetHistory'],
     queryFn: adminApi.getPasswordResetHistory,
-    refetchInterval: 30000, // Refetch every 30 seconds
   });
 
   const resetHistory = resetHistoryData?.history || [];
@@ -55,7 +55,6 @@ export function TransactionHistory() {
       status: status === "all" ? undefined : status,
       type: type === "all" ? undefined : type
     }),
-    refetchInterval: 30000, // Refetch every 30 seconds
   });
 
   const transactions = data?.transactions || [];
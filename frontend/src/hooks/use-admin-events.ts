@@ -0,0 +1,55 @@
+import { useEffect } from 'react';
+import { useQueryClient } from '@tanstack/react-query';
+import { adminApi } from '@/services/api';
+
+// Queries to refetch when an event of each type arrives
+const INVALIDATES: Record<string, string[][]> = {
+  'transaction.created': [['adminTransactions']],
+  'transaction.approved': [['adminTransactions']],
+  'transaction.rejected': [['adminTransactions']],
+  'transactions.approved': [['adminTransactions']],
+  'transactions.rejected': [['adminTransactions']],
+  'user.registered': [['adminUsers'], ['adminVerifications']],
+  'user.verified': [['adminUsers'], ['adminVerifications']],
+  'users.verified': [['adminUsers'], ['adminVerifications']],
+  'user.deleted': [['adminUsers'], ['adminVerifications']],
+  'investment.created': [['adminUsers']],
+  'investment.closed': [['adminUsers']],
+  'password_reset.created': [['passwordResetHistory']],
+};
+
+type StatsDelta = Record<string, number>;
+
+/**
+ * Subscribes to /api/admin/events while mounted. List queries are
+ * invalidated per event type and stat deltas are applied to the cached
+ * admin stats without a refetch. EventSource reconnects by itself and the
+ * server replays what was missed from Last-Event-ID.
+ */
+export function useAdminEvents() {
+  const queryClient = useQueryClient();
+
+  useEffect(() => {
+    const source = new EventSource(adminApi.eventsUrl(), { withCredentials: true });
+
+    Object.entries(INVALIDATES).forEach(([type, queryKeys]) => {
+      source.addEventListener(type, (event) => {
+        queryKeys.forEach((queryKey) => queryClient.invalidateQueries({ queryKey }));
+
+        const { stats } = JSON.parse((event as MessageEvent).data) as { stats?: StatsDelta };
+        if (stats && Object.keys(stats).length > 0) {
+          queryClient.setQueryData(['adminStats'], (current: Record<string, unknown> | undefined) => {
+            if (!current) return current;
+            const next = { ...current };
+            Object.entries(stats).forEach(([key, delta]) => {
+              if (typeof next[key] === 'number') next[key] = (next[key] as number) + delta;
+            });
+            return next;
+          });
+        }
+      });
+    });
+
+    return () => source.close();
+  }, [queryClient]);
+}
@@ -3,6 +3,7 @@ import { useQuery, useQueryClient } from '@tanstack/react-query';
 import { Card, CardHeader, CardTitle, CardContent } from '@/components/ui/card';
 import { Tabs, TabsContent, TabsList, TabsTrigger } from '@/components/ui/tabs';
 import { useToast } from '@/hooks/use-toast';
+import { useAdminEvents } from '@/hooks/use-admin-events';
 import { Badge } from '@/components/ui/badge';
 import { adminApi } from '@/services/api';
 import { PasswordReset } from '@/components/admin/PasswordReset';
@@ -43,6 +44,9 @@ export default function AdminDashboard() {
   const queryClient = useQueryClient();
   const [activeTab, setActiveTab] = useState("users");
 
+  // Live updates instead of polling
+  useAdminEvents();
+
   // Fetch admin stats
   const { data: adminStats, isLoading: isStatsLoading } = useQuery({
     queryKey: ['adminStats'],
@@ -159,6 +159,9 @@ export const referralApi = {
 };
 
 export const adminApi = {
+  // Server-Sent Events feed of admin-relevant changes (see useAdminEvents)
+  eventsUrl: () => `${API_URL}/admin/events`,
+
   getPendingTransactions: async () => {
     const response = await fetch(`${API_URL}/admin/transactions/pending`, {
       credentials: 'include'